@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+"""
+Streaming tremor features of accelerometer recordings
+
+Python counterpart of calc.tremor in extract_tremor.R for long or live
+recordings. Samples (time, x, y, z) are read in chunks and never held in
+full: the vector magnitude is cut into Hann-tapered Welch segments (50%
+overlap) as they complete, and every sliding window is the Welch average of
+the segments it contains, so memory is bounded by one window.
+
+Per window and per recording:
+    meanamp_welch  mean amplitude spectral density sqrt(PSD) in the band (default 4-7 Hz)
+    band_power     PSD integrated over the band
+    rms            mean of sqrt((x^2 + y^2 + z^2) / 3), as in calc.tremor
+The metadata columns (sub, mA, cond, side, contact) are parsed from the file
+name with the same character positions as calc.tremor. meanamp_welch is a
+Welch estimate and not numerically comparable with the whole-recording FFT
+meanamp of calc.tremor, so by default the recording table goes to
+tremor_welch.csv and not to the tremor.csv read by the plots and results
+scripts. With --tremor-schema the recording table has exactly the columns
+of tremor.csv (meanamp_welch written as meanamp, no band_power) and goes to
+tremor.csv unless --output is given, so those scripts can read it; their
+meanamp thresholds and scales then refer to the Welch estimate.
+
+Per-window rows are appended to <windows-dir>/<recording>_windows.csv as
+soon as a window is complete; with --follow a file that is still being
+written is read until no new samples arrive for --idle-timeout seconds.
+
+Usage:
+    streaming_tremor.py [files ...] [--data-dir ../data] [--output tremor_welch.csv] [--windows-dir windows]
+                        [--tremor-schema] [--window 10 --step 5 --segment 2 --band 4 7] [--workers N] [--follow]
+"""
+
+import io
+import os
+import csv
+import time
+import fnmatch
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from scipy.signal import get_window
+
+def parse_metadata(fname):
+    """sub, mA, cond, side and contact from the file name, with the substr positions of calc.tremor"""
+    def pos(pattern):                    # 1-based first match as R's gregexpr, -1 if absent
+        i = fname.find(pattern)
+        return i + 1 if i >= 0 else -1
+
+    def substr(start, stop):             # R's substr
+        start = max(start, 1)
+        return fname[start-1:stop] if stop >= start else ""
+
+    ma, data, stn = pos("mA"), pos("data"), pos("stn")
+    return {'sub': substr(data + 5, stn - 2),
+            'mA': substr(ma - 3, ma - 1),
+            'cond': substr(ma + 3, ma + 4),
+            'side': substr(stn + 3, stn + 3),
+            'contact': substr(stn + 6, stn + 7).replace("_", "")}
+
+class TremorStream:
+    """
+    Sliding-window Welch band power and RMS of a stream of samples.
+    push() takes the next samples and returns the windows completed by them,
+    summary() the features of everything pushed so far.
+    """
+
+    def __init__(self, fs, window=10.0, step=5.0, segment=2.0, band=(4, 7)):
+        self.fs = fs
+        self.hop = max(int(round(segment * fs / 2)), 1)            # segments overlap by 50%
+        self.seg = 2 * self.hop
+        self.win_segs = max(int(round((window * fs - self.seg) / self.hop)) + 1, 1)
+        self.step_segs = max(int(round(step * fs / self.hop)), 1)
+
+        self.taper = get_window('hann', self.seg)
+        self.scale = 1 / (fs * np.sum(self.taper ** 2))
+        self.freqs = np.fft.rfftfreq(self.seg, 1 / fs)
+        self.in_band = (self.freqs >= band[0]) & (self.freqs <= band[1])
+        self.df = fs / self.seg
+
+        self.d = np.empty(0)             # magnitudes from the start of the next segment
+        self.r = np.empty(0)             # rms terms and times of the current block
+        self.t = np.empty(0)
+        self.n_seg = 0                   # segments computed
+        self.n_block = 0                 # blocks (hop samples) completed
+        self.segs = deque()              # (index, PSD) of segments still needed by a window
+        self.blocks = deque()            # (index, rms sum, count, first time, last time)
+        self.next_window = 0
+
+        self.psd_sum = np.zeros(len(self.freqs))
+        self.rms_sum = 0.0
+        self.rms_count = 0
+
+    def _psd(self, frames):
+        """one-sided PSD of every frame (n x seg), as scipy.signal.welch per segment"""
+        frames = frames - frames.mean(axis=1, keepdims=True)
+        P = np.abs(np.fft.rfft(frames * self.taper, axis=1)) ** 2 * self.scale
+        P[:, 1:-1] *= 2                  # seg is even, the last bin is Nyquist
+        return P
+
+    def _features(self, psd):
+        band = psd[self.in_band]
+        return np.mean(np.sqrt(band)) if band.size else np.nan, np.sum(band) * self.df
+
+    def push(self, t, x, y, z):
+        """adds samples, returns a list of completed windows"""
+        d = np.sqrt(x ** 2 + y ** 2 + z ** 2)
+        r = np.sqrt((x ** 2 + y ** 2 + z ** 2) / 3)
+        valid = ~np.isnan(r)
+        self.rms_sum += np.sum(r[valid])
+        self.rms_count += np.count_nonzero(valid)
+
+        # Welch segments that are complete
+        self.d = np.concatenate([self.d, d])
+        if len(self.d) >= self.seg:
+            k = (len(self.d) - self.seg) // self.hop + 1
+            frames = np.lib.stride_tricks.sliding_window_view(self.d, self.seg)[::self.hop][:k]
+            P = self._psd(frames)
+            self.psd_sum += P.sum(axis=0)
+            self.segs.extend(zip(range(self.n_seg, self.n_seg + k), P))
+            self.n_seg += k
+            self.d = self.d[k * self.hop:]
+
+        # rms sums and times per block of hop samples
+        self.r = np.concatenate([self.r, r])
+        self.t = np.concatenate([self.t, t])
+        n = len(self.r) // self.hop
+        if n:
+            rb = self.r[:n * self.hop].reshape(n, self.hop)
+            tb = self.t[:n * self.hop].reshape(n, self.hop)
+            sums = np.nansum(rb, axis=1)
+            counts = np.count_nonzero(~np.isnan(rb), axis=1)
+            self.blocks.extend(zip(range(self.n_block, self.n_block + n), sums, counts, tb[:, 0], tb[:, -1]))
+            self.n_block += n
+            self.r = self.r[n * self.hop:]
+            self.t = self.t[n * self.hop:]
+
+        # window w holds segments [w*S, w*S + W) = samples of blocks [w*S, w*S + W + 1)
+        windows = []
+        while self.next_window * self.step_segs + self.win_segs <= self.n_seg:
+            first = self.next_window * self.step_segs
+            while self.segs and self.segs[0][0] < first:
+                self.segs.popleft()
+            while self.blocks and self.blocks[0][0] < first:
+                self.blocks.popleft()
+
+            psd = np.mean([P for j, P in self.segs if j < first + self.win_segs], axis=0)
+            blocks = [b for b in self.blocks if b[0] < first + self.win_segs + 1]
+            count = sum(b[2] for b in blocks)
+            meanamp, band_power = self._features(psd)
+            windows.append({'window': self.next_window, 't_start': blocks[0][3], 't_end': blocks[-1][4],
+                            'meanamp_welch': meanamp, 'band_power': band_power,
+                            'rms': sum(b[1] for b in blocks) / count if count else np.nan})
+            self.next_window += 1
+        return windows
+
+    def summary(self):
+        """recording features: Welch spectrum of all segments and rms of all samples"""
+        if self.n_seg:
+            meanamp, band_power = self._features(self.psd_sum / self.n_seg)
+        else:
+            meanamp = band_power = np.nan
+        return {'meanamp_welch': meanamp, 'rms': self.rms_sum / self.rms_count if self.rms_count else np.nan,
+                'band_power': band_power}
+
+def read_chunks(fname, block=1 << 22, follow=False, poll=1.0, idle_timeout=30.0):
+    """
+    Yields (time, x, y, z) arrays of the complete lines of every block of
+    bytes read. With follow the file is read as it grows until no new line
+    arrives for idle_timeout seconds.
+    """
+    idle = 0.0
+    with open(fname) as f:
+        header = ""
+        while not header.endswith("\n"):
+            header += f.readline()
+            if not header.endswith("\n"):
+                if not follow or idle >= idle_timeout:
+                    return
+                time.sleep(poll)
+                idle += poll
+        names = [c.strip().strip('"') for c in header.strip().split(",")]
+        cols = [names.index(c) for c in ("time", "x", "y", "z")]
+
+        rest = ""
+        while True:
+            text = f.read(block)
+            if not text:
+                if not follow or idle >= idle_timeout:
+                    break
+                time.sleep(poll)
+                idle += poll
+                continue
+            idle = 0.0
+
+            text = rest + text
+            cut = text.rfind("\n") + 1
+            text, rest = text[:cut], text[cut:]
+            if text.strip():
+                df = pd.read_csv(io.StringIO(text), header=None, usecols=cols)
+                yield tuple(df[c].to_numpy(dtype=float) for c in cols)
+
+        if rest.strip():                 # last line without newline
+            df = pd.read_csv(io.StringIO(rest), header=None, usecols=cols)
+            yield tuple(df[c].to_numpy(dtype=float) for c in cols)
+
+def process_file(fname, window=10.0, step=5.0, segment=2.0, band=(4, 7), fs=None, windows_dir=None,
+                 follow=False, idle_timeout=30.0):
+    """
+    Streams one recording, returns its features with the calc.tremor metadata.
+    fs defaults to 1/mean(diff(time)) of the first chunk.
+    """
+    meta = parse_metadata(fname)
+    stream = None
+    pending = []
+    out = writer = None
+    if windows_dir:
+        os.makedirs(windows_dir, exist_ok=True)
+        name = os.path.splitext(os.path.basename(fname))[0]
+        out = open(os.path.join(windows_dir, f"{name}_windows.csv"), "w", newline="")
+        writer = csv.DictWriter(out, fieldnames=list(meta) + ['window', 't_start', 't_end',
+                                                               'meanamp_welch', 'band_power', 'rms'])
+        writer.writeheader()
+
+    try:
+        for chunk in read_chunks(fname, follow=follow, idle_timeout=idle_timeout):
+            if stream is None:
+                # the sampling rate is estimated once enough samples have arrived
+                pending.append(chunk)
+                t = np.concatenate([c[0] for c in pending])
+                if fs is None and len(t) < 32:
+                    continue
+                rate = fs or (len(t) - 1) / (t[-1] - t[0])
+                stream = TremorStream(rate, window, step, segment, band)
+                chunk = tuple(np.concatenate([c[i] for c in pending]) for i in range(4))
+            for win in stream.push(*chunk):
+                if writer:
+                    writer.writerow({**meta, **win})
+            if out:
+                out.flush()
+    finally:
+        if out:
+            out.close()
+
+    if stream is None:                   # fewer than 32 samples
+        chunk = tuple(np.concatenate([c[i] for c in pending]) for i in range(4)) if pending else None
+        if chunk is None or len(chunk[0]) < 2:
+            return {**meta, 'meanamp_welch': np.nan, 'rms': np.nan, 'band_power': np.nan}
+        stream = TremorStream(fs or (len(chunk[0]) - 1) / (chunk[0][-1] - chunk[0][0]), window, step, segment, band)
+        stream.push(*chunk)
+    return {**meta, **stream.summary()}
+
+def find_files(data_dir):
+    """all *.csv files below data_dir (case-insensitive), as find -iname '*.csv'"""
+    files = []
+    for root, _, names in os.walk(data_dir):
+        files += [os.path.join(root, n) for n in names if fnmatch.fnmatch(n.lower(), "*.csv")]
+    return sorted(files)
+
+def process_files(files, output="tremor_welch.csv", workers=None, tremor_schema=False, **kwargs):
+    """
+    features of every recording in parallel, written with R row names like
+    write.csv; with tremor_schema in the columns of calc.tremor's tremor.csv
+    """
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(process_file, f, **kwargs) for f in files]
+        rows = []
+        for f, future in zip(files, futures):
+            rows.append(future.result())
+            print(f)
+
+    df = pd.DataFrame(rows, columns=['sub', 'mA', 'cond', 'side', 'contact', 'meanamp_welch', 'rms', 'band_power'])
+    if tremor_schema:
+        df = df.drop(columns='band_power').rename(columns={'meanamp_welch': 'meanamp'})
+    df.index = np.arange(1, len(df) + 1)                   # row names as written by R
+    df.to_csv(output, index_label="")
+    return df
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="streaming sliding-window tremor features of accelerometer csv files")
+    parser.add_argument("files", nargs="*", help="recordings (default: all csv files below --data-dir)")
+    parser.add_argument("--data-dir", default="../data")
+    parser.add_argument("--output", default=None,
+                        help="per-recording features (default: tremor_welch.csv, tremor.csv with --tremor-schema)")
+    parser.add_argument("--tremor-schema", action="store_true",
+                        help="write the columns of calc.tremor's tremor.csv, with the Welch estimate as meanamp")
+    parser.add_argument("--windows-dir", default=None, help="folder for the per-window features of every recording")
+    parser.add_argument("--window", type=float, default=10.0, help="window length in s")
+    parser.add_argument("--step", type=float, default=5.0, help="window step in s")
+    parser.add_argument("--segment", type=float, default=2.0, help="Welch segment length in s")
+    parser.add_argument("--band", type=float, nargs=2, default=[4, 7], help="tremor band in Hz")
+    parser.add_argument("--fs", type=float, default=None, help="sampling rate (default: from the time column)")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--follow", action="store_true", help="keep reading recordings that are still being written")
+    parser.add_argument("--idle-timeout", type=float, default=30.0, help="seconds without new samples that end --follow")
+    args = parser.parse_args()
+
+    files = args.files or find_files(args.data_dir)
+    output = args.output or ("tremor.csv" if args.tremor_schema else "tremor_welch.csv")
+    process_files(files, output, args.workers, args.tremor_schema, window=args.window, step=args.step,
+                  segment=args.segment, band=tuple(args.band), fs=args.fs, windows_dir=args.windows_dir,
+                  follow=args.follow, idle_timeout=args.idle_timeout)
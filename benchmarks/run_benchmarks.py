@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+"""
+Benchmark suite for the network and VTA stages
+
+Times each stage on synthetic inputs (see synthetic.py) at several matrix
+sizes and cohort sizes. Every case runs in a fresh process, so peak memory
+is not inflated by earlier cases, and records:
+    wall_s          wall time of the stage
+    peak_rss_mb     peak resident set size of the process after the stage
+    peak_alloc_mb   with --trace-alloc: peak memory allocated during the stage
+                    (tracemalloc, includes numpy), from a second run on fresh
+                    inputs so the tracing overhead stays out of wall_s
+Results are appended as JSON lines (one record per case, with git commit,
+host and library versions) so runs can be compared across commits.
+
+Usage:
+    run_benchmarks.py [--nodes 83 200 400] [--cohorts 1 8 32] [--stages ...] [--output results.jsonl] [--trace-alloc]
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import contextlib
+import platform
+import tempfile
+import tracemalloc
+import importlib
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.join(HERE, '..', 'imaging'))
+sys.path.insert(0, os.path.join(HERE, '..', 'plots'))
+
+import synthetic
+from stage_trace import maxrss_mb
+
+# stage -> (module, does it depend on the matrix size)
+STAGES = {
+    'symmetricize_matrix': ('network_metrics', True),
+    'calc_metrics': ('network_metrics', True),
+    'calc_metrics_batch': ('network_metrics', True),
+    'calc_metrics_sparse': ('network_metrics', True),
+    'extract_and_save_centroids': ('extract_coords', False),
+    'compute_centroids': ('roi_centroids', False),
+    'get_vta_center_of_mass': ('plot_figure_4', False),
+    'vta_index_build': ('vta_index', False),
+    'vta_index_center_of_mass': ('vta_index', False),
+}
+
+def prepare(stage, n_nodes, n_vats, workdir):
+    """write the synthetic inputs of one case (not timed), returns the arguments of the stage"""
+    if stage in ('symmetricize_matrix', 'calc_metrics', 'calc_metrics_batch', 'calc_metrics_sparse'):
+        imgdir = os.path.join(workdir, f"img_{n_nodes}_{n_vats}")
+        vats = synthetic.write_probtrackx_cohort(imgdir, n_vats, n_nodes)
+        return {'imgdir': imgdir, 'vats': vats}
+    if stage == 'extract_and_save_centroids':
+        return {'files': [synthetic.write_coordinate_dump(os.path.join(workdir, f"coords_{i}.txt"), seed=i)
+                          for i in range(n_vats)]}
+    if stage == 'compute_centroids':
+        return {'files': [synthetic.write_parcellation(os.path.join(workdir, f"parc_{i}.nii.gz"), seed=i)
+                          for i in range(n_vats)]}
+    if stage == 'get_vta_center_of_mass':
+        return {'files': synthetic.write_vtas(os.path.join(workdir, f"vtas_{n_vats}"), n_vats)}
+    if stage in ('vta_index_build', 'vta_index_center_of_mass'):
+        vta_root = os.path.join(workdir, f"derivatives_{n_vats}")
+        rng = np.random.default_rng(0)
+        for v in range(n_vats):
+            folder = os.path.join(vta_root, f"sub-subject{v // 8 + 1}", "stimulations", "MNI152NLin2009bAsym",
+                                  f"L_contact-{v % 8 + 1:02d}_amp-1.0mA")
+            os.makedirs(folder, exist_ok=True)
+            synthetic.nib.save(synthetic.nib.Nifti1Image(synthetic.vta_volume(rng), synthetic.MNI_AFFINE),
+                               os.path.join(folder, f"sub-subject{v // 8 + 1}_sim-binary_model-simbio_hemi-L_MNI_1mm.nii.gz"))
+        index = os.path.join(workdir, f"index_{n_vats}")
+        if stage == 'vta_index_center_of_mass':
+            from vta_index import build_index
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                build_index(vta_root, index)                 # only the lookups are timed
+        return {'vta_root': vta_root, 'index': index}
+    raise ValueError(f"unknown stage {stage}")
+
+def run_stage(stage, mod, args):
+    """the timed part of each stage, mod is the already imported stage module"""
+    if stage == 'symmetricize_matrix':
+        mats = [np.loadtxt(os.path.join(mod.stats_dir(args['imgdir'], s, v), "fdt_network_matrix"))
+                for s, v in args['vats']]
+        t0 = time.perf_counter()
+        for m in mats:
+            mod.symmetricize_matrix(m)
+        return time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    if stage == 'calc_metrics':
+        for s, v in args['vats']:
+            mod.calc_metrics(s, v, imgdir=args['imgdir'])
+    elif stage == 'calc_metrics_sparse':
+        for s, v in args['vats']:
+            mod.calc_metrics(s, v, imgdir=args['imgdir'], sparse=True)
+    elif stage == 'calc_metrics_batch':
+        mod.calc_metrics_batch(args['vats'], imgdir=args['imgdir'])
+    elif stage == 'extract_and_save_centroids':
+        for f in args['files']:
+            out = os.path.splitext(f)[0]
+            mod.extract_and_save_centroids(f, out + '_left.csv', out + '_right.csv', out + '_sub.csv')
+    elif stage == 'compute_centroids':
+        for f in args['files']:
+            mod.compute_centroids(f)
+    elif stage == 'get_vta_center_of_mass':
+        for f in args['files']:
+            mod.get_vta_center_of_mass(f)
+    elif stage == 'vta_index_build':
+        mod.build_index(args['vta_root'], args['index'])
+    elif stage == 'vta_index_center_of_mass':
+        index = mod.VTAIndex(args['index'])
+        for i in range(len(index)):
+            index.center_of_mass(i)
+    return time.perf_counter() - t0
+
+def run_case(stage, n_nodes, n_vats, workdir, trace_alloc=False):
+    """prepare and time one case, meant to run in a fresh process"""
+    record = {'stage': stage, 'n_nodes': n_nodes, 'n_vats': n_vats}
+    try:
+        mod = importlib.import_module(STAGES[stage][0])     # imports are not part of the timing
+        args = prepare(stage, n_nodes, n_vats, workdir)
+        devnull = open(os.devnull, 'w')
+        stdout, sys.stdout = sys.stdout, devnull          # stages print progress
+        try:
+            record['wall_s'] = run_stage(stage, mod, args)
+            record['peak_rss_mb'] = maxrss_mb()
+            if trace_alloc:
+                # tracemalloc slows Python-heavy stages several fold, so it only runs on a second copy
+                args = prepare(stage, n_nodes, n_vats, tempfile.mkdtemp(dir=workdir))
+                tracemalloc.start()
+                run_stage(stage, mod, args)
+                record['peak_alloc_mb'] = tracemalloc.get_traced_memory()[1] / 2**20
+                tracemalloc.stop()
+        finally:
+            sys.stdout = stdout
+            devnull.close()
+        record['status'] = 'ok'
+    except ImportError as e:
+        record['status'] = f'skipped: {e}'
+    except Exception as e:
+        record['status'] = f'failed: {type(e).__name__}: {e}'
+    return record
+
+def environment():
+    """metadata stored with every record"""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=HERE,
+                                capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {'commit': commit, 'host': socket.gethostname(), 'python': platform.python_version(),
+            'numpy': np.__version__, 'cpus': os.cpu_count(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+def run_benchmarks(stages, nodes, cohorts, output, trace_alloc=False):
+    env = environment()
+    ctx = multiprocessing.get_context('spawn')
+    with tempfile.TemporaryDirectory() as workdir, open(output, 'a') as out:
+        for stage in stages:
+            for n_nodes in (nodes if STAGES[stage][1] else [None]):
+                for n_vats in cohorts:
+                    with ProcessPoolExecutor(max_workers=1, mp_context=ctx) as pool:
+                        record = pool.submit(run_case, stage, n_nodes, n_vats, workdir, trace_alloc).result()
+                    record.update(env)
+                    out.write(json.dumps(record) + '\n')
+                    out.flush()
+
+                    if record['status'] == 'ok':
+                        alloc = f"  alloc {record['peak_alloc_mb']:8.1f} MB" if trace_alloc else ""
+                        print(f"{stage:28s} nodes={str(n_nodes):5s} vats={n_vats:<5d} "
+                              f"{record['wall_s']:9.3f} s  rss {record['peak_rss_mb']:8.1f} MB{alloc}")
+                    else:
+                        print(f"{stage:28s} nodes={str(n_nodes):5s} vats={n_vats:<5d} {record['status']}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="benchmark the network and VTA stages on synthetic data")
+    parser.add_argument("--stages", nargs="+", default=list(STAGES), choices=list(STAGES))
+    parser.add_argument("--nodes", type=int, nargs="+", default=[83, 200, 400])
+    parser.add_argument("--cohorts", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--output", default=os.path.join(HERE, "results.jsonl"))
+    parser.add_argument("--trace-alloc", action="store_true",
+                        help="also measure peak allocations with tracemalloc in a second, untimed run")
+    args = parser.parse_args()
+
+    run_benchmarks(args.stages, args.nodes, args.cohorts, args.output, args.trace_alloc)
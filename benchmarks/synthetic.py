@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+Synthetic inputs for the benchmarks
+
+Generates data with the layout and sizes of the real pipeline outputs, so
+stages can be timed without patient data:
+- probtrackx --network outputs (fdt_network_matrix, waytotal) in the
+  <imgdir>/<sub>/diffusion/stats/<vatdir>/ layout of network_metrics.py
+- binary VTAs on the 1 mm MNI grid (182 x 218 x 182)
+- Desikan coordinate dumps and label volumes
+"""
+
+import os
+import numpy as np
+import nibabel as nib
+
+MNI_SHAPE = (182, 218, 182)
+MNI_AFFINE = np.array([[-1., 0., 0., 90.],
+                       [0., 1., 0., -126.],
+                       [0., 0., 1., -72.],
+                       [0., 0., 0., 1.]])
+
+DESIKAN_IDS = ([8, 10, 11, 12, 13, 17, 18, 47, 49, 50, 51, 52, 53, 54]
+               + [i for i in range(1001, 1036) if i != 1004]
+               + [i for i in range(2001, 2036) if i != 2004])
+
+def network_matrix(n_nodes, rng, density=0.7):
+    """streamline counts between seeds, last row/column is the VAT"""
+    m = rng.poisson(50, (n_nodes, n_nodes)) * (rng.random((n_nodes, n_nodes)) < density)
+    np.fill_diagonal(m, 0)
+    return m
+
+def write_probtrackx_cohort(imgdir, n_vats, n_nodes, seed=0, vats_per_subject=8):
+    """fdt_network_matrix/waytotal pairs for n_vats VATs, returns the (sub, vatdir) pairs"""
+    rng = np.random.default_rng(seed)
+    vats = []
+    for v in range(n_vats):
+        sub = f"sub{v // vats_per_subject:03d}"
+        vatdir = f"{'LR'[v % 2]}_contact-{v % vats_per_subject // 2 + 1:02d}_amp-{1 + v % 3}.0mA+"
+        folder = os.path.join(imgdir, sub, "diffusion", "stats", vatdir)
+        os.makedirs(folder, exist_ok=True)
+        np.savetxt(os.path.join(folder, "fdt_network_matrix"), network_matrix(n_nodes, rng), fmt="%d")
+        np.savetxt(os.path.join(folder, "waytotal"), rng.integers(10000, 50000, n_nodes), fmt="%d")
+        vats.append((sub, vatdir))
+    return vats
+
+def vta_volume(rng, radius=4.0):
+    """binary spherical VTA of a few hundred voxels near the STN"""
+    centre = np.array([91 + rng.choice([-12, 12]), 110, 65]) + rng.normal(0, 2, 3)
+    lo = np.floor(centre - radius).astype(int)
+    hi = np.ceil(centre + radius).astype(int) + 1
+    ijk = np.mgrid[lo[0]:hi[0], lo[1]:hi[1], lo[2]:hi[2]]
+    inside = ((ijk - centre[:, None, None, None]) ** 2).sum(axis=0) <= radius ** 2
+
+    data = np.zeros(MNI_SHAPE, dtype=np.uint8)
+    data[lo[0]:hi[0], lo[1]:hi[1], lo[2]:hi[2]] = inside
+    return data
+
+def write_vtas(folder, n_vats, seed=0):
+    """n_vats binary VTA NIfTIs on the MNI grid, returns the file names"""
+    rng = np.random.default_rng(seed)
+    os.makedirs(folder, exist_ok=True)
+    files = []
+    for v in range(n_vats):
+        f = os.path.join(folder, f"vta_{v:04d}.nii.gz")
+        nib.save(nib.Nifti1Image(vta_volume(rng), MNI_AFFINE), f)
+        files.append(f)
+    return files
+
+def write_coordinate_dump(outfile, seed=0):
+    """desikan_supratent_gm_coords.txt: label ID and x, y, z per row"""
+    rng = np.random.default_rng(seed)
+    ids = np.array(DESIKAN_IDS)
+    np.savetxt(outfile, np.column_stack([ids, rng.uniform(-70, 70, (len(ids), 3))]), fmt="%d %.4f %.4f %.4f")
+    return outfile
+
+def write_parcellation(outfile, n_labels=len(DESIKAN_IDS), seed=0):
+    """label volume on the MNI grid with n_labels blocky regions inside an ellipsoid"""
+    rng = np.random.default_rng(seed)
+    ids = np.array(DESIKAN_IDS[:n_labels] if n_labels <= len(DESIKAN_IDS) else np.arange(1, n_labels + 1))
+    seeds = rng.uniform([20, 20, 20], [160, 200, 160], (len(ids), 3))
+
+    # nearest seed on a coarse grid, upsampled to 1 mm
+    coarse = np.mgrid[0:MNI_SHAPE[0]:4, 0:MNI_SHAPE[1]:4, 0:MNI_SHAPE[2]:4].reshape(3, -1).T
+    nearest = np.argmin(((coarse[:, None, :] - seeds[None]) ** 2).sum(axis=2), axis=1)
+    labels = ids[nearest].reshape([len(range(0, n, 4)) for n in MNI_SHAPE])
+    labels = labels.repeat(4, 0).repeat(4, 1).repeat(4, 2)[:MNI_SHAPE[0], :MNI_SHAPE[1], :MNI_SHAPE[2]]
+
+    ijk = np.indices(MNI_SHAPE, sparse=True)
+    centre = np.array(MNI_SHAPE) / 2
+    brain = sum(((a - c) / (c * 0.9)) ** 2 for a, c in zip(ijk, centre)) <= 1
+    nib.save(nib.Nifti1Image(np.where(brain, labels, 0).astype(np.int32), MNI_AFFINE), outfile)
+    return outfile
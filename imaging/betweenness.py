@@ -0,0 +1,403 @@
+#!/usr/bin/env python3
+"""
+Batched binary betweenness centrality
+
+Same algorithm as bct.betweenness_bin (Brandes 2001 / Kintali 2008 path
+counting with matrix products) for a whole stack of binary adjacency
+matrices (batch x N x N), e.g. all density thresholds of one VAT or many
+VATs. Path counts are only extended along shortest paths, level masks are
+kept as booleans and the dependency accumulation runs in place, which
+removes most of the full-matrix temporaries bct allocates per call.
+
+With numba installed, betweenness_bin_compiled runs Brandes' algorithm as
+a compiled loop: one breadth-first search per source over bitset rows of
+the adjacency matrix, counting paths and dependencies only along the edges
+of the shortest-path DAG. Its work grows with those edges instead of N^3
+per BFS level, so it wins on sparse graphs and loses on dense ones.
+betweenness_bin_sparse runs the matrix-product algorithm on one
+scipy.sparse matrix for a block of sources at a time.
+
+Speedup over bct.betweenness_bin per graph (crossover(), random undirected
+graphs, one core), with the engine that engine() picks:
+    nodes   1-2% density       5%             10-40%
+       83   13x compiled       1.5x dense     1.8-2.0x dense
+      200   3.6-9.3x compiled  1.5x dense     1.4-1.7x dense
+      400   3.3-8.2x compiled  1.3x dense     1.6-2.2x dense
+     1000   2.5-4.4x compiled  1.2x dense     1.3x dense
+Without numba the sparse engine takes the graphs of 400 and more nodes
+below 5% density (1.2-4x over bct, 1.1-2.9x over dense). The pipeline's
+thresholds keep 20-40% of the edges, where bct is already bound by the
+same N^3 matrix products as the dense engine and the compiled BFS is
+0.2-1.1x of bct: the 10x target is only reached on very sparse graphs.
+
+engine() routes every graph to the engine that was fastest for its size
+and density (COMPILED_MAX_DENSITY, SPARSE_MAX_DENSITY, SPARSE_MIN_NODES);
+betweenness_bin_batch and betweenness_bin apply it.
+
+Usage:
+    betweenness.py               validate every engine against bct.betweenness_bin
+    betweenness.py --crossover   time every engine over sizes and densities
+"""
+
+import time
+import argparse
+import numpy as np
+import scipy.sparse as sp
+try:
+    import numba
+except ImportError:                      # the compiled engine is optional
+    numba = None
+
+def _betweenness_stack(G):
+    """betweenness of a (batch x N x N) boolean stack, one matrix product per BFS level"""
+    n = G.shape[-1]
+    I = np.eye(n, dtype=bool)
+    A = G.astype(float)
+    AT = np.swapaxes(A, 1, 2)
+    unreached = ~(G | I)
+    NSP = A.copy()                       # number of shortest paths of any length
+    NSP[:, I] = 1
+    levels = [G]                         # levels[d-1]: pairs at distance d
+    NSPd = A                             # number of shortest paths of length d
+
+    # extending only the shortest paths of length d-1 gives the same counts as
+    # bct's walk counts but cannot overflow while deeper graphs of the stack finish
+    while True:
+        NSPd = np.matmul(NSPd, A)
+        NSPd *= unreached
+        new = NSPd > 0
+        if not new.any():
+            break
+        NSP += NSPd
+        unreached &= ~new
+        levels.append(new)
+
+    NSP[unreached] = 1                   # NSP for disconnected vertices is 1
+
+    # accumulate vertex on vertex dependencies from the longest paths down
+    DP = np.zeros(A.shape)
+    X = np.empty(A.shape)
+    for d in range(len(levels) - 1, 0, -1):
+        np.add(DP, 1, out=X)
+        X /= NSP
+        X *= levels[d]
+        DPd1 = np.matmul(X, AT)
+        DPd1 *= NSP
+        DPd1 *= levels[d - 1]
+        DP += DPd1
+
+    return np.sum(DP, axis=1)
+
+def betweenness_bin_batch(G, chunk=1):
+    """
+    Parameters:
+    -----------
+    G : (batch x N x N) or (N x N) array
+        binary directed/undirected connection matrices
+    chunk : int
+        number of dense matrices sharing one batched matrix product. Small
+        chunks keep the working set in cache and were fastest for
+        83-400 nodes on our machines
+
+    Returns:
+    --------
+    BC : (batch x N) or (N,) array
+        node betweenness centrality of every matrix, as bct.betweenness_bin.
+        Every matrix goes to the engine() for its density
+    """
+    G = np.asarray(G) != 0
+    single = G.ndim == 2
+    if single:
+        G = G[np.newaxis]
+    n = G.shape[-1]
+
+    edges = G.sum(axis=(1, 2)) - np.einsum('ijj->i', G)
+    engines = np.array([engine(n, e) for e in edges])
+    BC = np.zeros(G.shape[:2])
+    for i in np.flatnonzero(engines == 'compiled'):
+        BC[i] = betweenness_bin_compiled(G[i])
+    for i in np.flatnonzero(engines == 'sparse'):
+        BC[i] = betweenness_bin_sparse(sp.csr_matrix(G[i]))
+    dense = np.flatnonzero(engines == 'dense')
+    for i in range(0, len(dense), chunk):
+        BC[dense[i:i+chunk]] = _betweenness_stack(G[dense[i:i+chunk]])
+    return BC[0] if single else BC
+
+# measured cut-offs (module docstring, crossover()): below them the engine beat the dense one
+COMPILED_MAX_DENSITY = 0.05
+SPARSE_MAX_DENSITY = 0.05
+SPARSE_MIN_NODES = 400
+
+def engine(n_nodes, n_edges):
+    """
+    'compiled', 'sparse' or 'dense', the engine that was fastest for a graph
+    of this size (n_edges counts both directions). The sparse engine only
+    takes over where numba is missing
+    """
+    density = n_edges / max(n_nodes * (n_nodes - 1), 1)
+    if numba is not None and density < COMPILED_MAX_DENSITY:
+        return 'compiled'
+    if n_nodes >= SPARSE_MIN_NODES and density < SPARSE_MAX_DENSITY:
+        return 'sparse'
+    return 'dense'
+
+def betweenness_bin(A, block=64):
+    """betweenness of one binary graph (array or scipy.sparse matrix) with the engine() for its density"""
+    if sp.issparse(A):
+        A = sp.csr_matrix(A)
+        A.eliminate_zeros()
+        n_edges = A.nnz - np.count_nonzero(A.diagonal())
+    else:
+        A = np.asarray(A) != 0
+        n_edges = np.count_nonzero(A) - np.count_nonzero(np.diagonal(A))
+    name = engine(A.shape[0], n_edges)
+    if name == 'compiled':
+        return betweenness_bin_compiled(A)
+    if name == 'sparse':
+        return betweenness_bin_sparse(A, block)
+    return betweenness_bin_batch(A.toarray() if sp.issparse(A) else A)
+
+# index of the lowest set bit b of a 64-bit word: _BIT_INDEX[(b * _DEBRUIJN) >> 58]
+_DEBRUIJN = 0x03f79d71b4cb0a89
+_BIT_INDEX = np.zeros(64, dtype=np.int64)
+for _i in range(64):
+    _BIT_INDEX[((_DEBRUIJN << _i) & 0xFFFFFFFFFFFFFFFF) >> 58] = _i
+
+if numba is not None:
+    @numba.njit(cache=True)
+    def _bit_rows(rows, cols, n):
+        """out- and in-neighbour bitsets (N x words) of the edges rows -> cols, self-loops dropped"""
+        nw = (n + 63) // 64
+        out = np.zeros((n, nw), dtype=np.uint64)
+        inn = np.zeros((n, nw), dtype=np.uint64)
+        for e in range(len(rows)):
+            v, w = rows[e], cols[e]
+            if v != w:
+                out[v, w >> 6] |= np.uint64(1) << np.uint64(w & 63)
+                inn[w, v >> 6] |= np.uint64(1) << np.uint64(v & 63)
+        return out, inn
+
+    @numba.njit(cache=True)
+    def _brandes_bits(out, inn, bit_index):
+        """Brandes betweenness with one BFS per source, the BFS levels kept as bitsets"""
+        n, nw = out.shape
+        one = np.uint64(1)
+        debruijn = np.uint64(_DEBRUIJN)
+        shift = np.uint64(58)
+        BC = np.zeros(n)
+        sigma = np.zeros(n)                  # number of shortest paths from the source
+        coef = np.zeros(n)                   # (1 + dependency) / sigma
+        order = np.empty(n, dtype=np.int64)  # BFS order, level d is order[bounds[d]:bounds[d+1]]
+        bounds = np.zeros(n + 2, dtype=np.int64)
+        levels = np.zeros((n + 1, nw), dtype=np.uint64)
+        visited = np.zeros(nw, dtype=np.uint64)
+        new = np.zeros(nw, dtype=np.uint64)
+
+        for s in range(n):
+            levels[0, :] = 0
+            levels[0, s >> 6] = one << np.uint64(s & 63)
+            visited[:] = levels[0]
+            sigma[s] = 1.0
+            order[0] = s
+            bounds[1] = 1
+            n_levels = 1
+
+            while True:
+                new[:] = 0
+                for h in range(bounds[n_levels - 1], bounds[n_levels]):
+                    new |= out[order[h]]
+                new &= ~visited
+                if not new.any():
+                    break
+                visited |= new
+                levels[n_levels] = new
+                m = bounds[n_levels]
+                for k in range(nw):
+                    word = new[k]
+                    while word:
+                        low = word & (~word + one)
+                        word ^= low
+                        w = (k << 6) + bit_index[(low * debruijn) >> shift]
+                        order[m] = w
+                        m += 1
+                        # shortest paths to w come through its in-neighbours on the previous level
+                        paths = 0.0
+                        for j in range(nw):
+                            pred = inn[w, j] & levels[n_levels - 1, j]
+                            while pred:
+                                low = pred & (~pred + one)
+                                pred ^= low
+                                paths += sigma[(j << 6) + bit_index[(low * debruijn) >> shift]]
+                        sigma[w] = paths
+                n_levels += 1
+                bounds[n_levels] = m
+
+            # accumulate the dependencies from the deepest level up
+            for h in range(bounds[n_levels - 1], bounds[n_levels]):
+                coef[order[h]] = 1.0 / sigma[order[h]]
+            for d in range(n_levels - 2, -1, -1):
+                for h in range(bounds[d], bounds[d + 1]):
+                    v = order[h]
+                    dep = 0.0
+                    for j in range(nw):
+                        succ = out[v, j] & levels[d + 1, j]
+                        while succ:
+                            low = succ & (~succ + one)
+                            succ ^= low
+                            dep += coef[(j << 6) + bit_index[(low * debruijn) >> shift]]
+                    dep *= sigma[v]
+                    coef[v] = (1.0 + dep) / sigma[v]
+                    if v != s:
+                        BC[v] += dep
+        return BC
+
+def betweenness_bin_compiled(A):
+    """
+    Parameters:
+    -----------
+    A : (N x N) array or scipy.sparse matrix
+        binary directed/undirected connection matrix, non-zero entries are edges
+
+    Returns:
+    --------
+    BC : (N,) array
+        node betweenness centrality, as bct.betweenness_bin (needs numba)
+    """
+    if numba is None:
+        raise ImportError("betweenness_bin_compiled needs numba")
+    if sp.issparse(A):
+        A = A.tocoo()
+        rows, cols = A.row[A.data != 0], A.col[A.data != 0]
+    else:
+        rows, cols = np.nonzero(np.asarray(A))
+    out, inn = _bit_rows(rows.astype(np.int64), cols.astype(np.int64), A.shape[0])
+    return _brandes_bits(out, inn, _BIT_INDEX)
+
+def betweenness_bin_sparse(A, block=64):
+    """
+    Parameters:
+    -----------
+    A : (N x N) scipy.sparse matrix
+        binary directed/undirected connection matrix, stored entries are edges
+    block : int
+        number of sources whose breadth-first searches run together; the
+        working set is a few (block x N) arrays
+
+    Returns:
+    --------
+    BC : (N,) array
+        node betweenness centrality, as bct.betweenness_bin
+    """
+    A = sp.csr_matrix(A, dtype=float, copy=True)
+    A.data[:] = 1
+    n = A.shape[0]
+    BC = np.zeros(n)
+
+    for start in range(0, n, block):
+        src = np.arange(start, min(start + block, n))
+        rows = np.arange(len(src))
+
+        # row r of every block array belongs to source src[r]
+        NSPd = A[src].toarray()              # number of shortest paths of length d
+        unreached = NSPd == 0
+        unreached[rows, src] = False
+        NSP = NSPd.copy()                    # number of shortest paths of any length
+        NSP[rows, src] = 1
+        levels = [NSPd > 0]                  # levels[d-1]: targets at distance d
+
+        while True:
+            NSPd = (A.T @ NSPd.T).T          # NSPd @ A with the sparse operand first
+            NSPd *= unreached
+            new = NSPd > 0
+            if not new.any():
+                break
+            NSP += NSPd
+            unreached &= ~new
+            levels.append(new)
+
+        NSP[unreached] = 1                   # NSP for disconnected vertices is 1
+
+        # accumulate the dependencies of the block's sources from the longest paths down
+        DP = np.zeros(NSP.shape)
+        for d in range(len(levels) - 1, 0, -1):
+            X = (1 + DP) / NSP * levels[d]
+            DP += (A @ X.T).T * NSP * levels[d - 1]
+
+        BC += np.sum(DP, axis=0)
+
+    return BC
+
+def random_graphs(n_nodes, densities, seed=0):
+    """(len(densities) x N x N) random undirected binary graphs"""
+    rng = np.random.default_rng(seed)
+    G = np.zeros((len(densities), n_nodes, n_nodes), dtype=int)
+    for k, p in enumerate(densities):
+        upper = np.triu(rng.random((n_nodes, n_nodes)) < p, 1)
+        G[k] = upper | upper.T
+    return G
+
+def best_of(f, repeats):
+    """result of f and its fastest wall time over repeats calls"""
+    times = []
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        out = f()
+        times.append(time.perf_counter() - t0)
+    return out, min(times)
+
+def validate(n_nodes=83, n_mats=21, densities=(0.01, 0.4), repeats=5, seed=0):
+    """compare every engine against bct.betweenness_bin on random graphs and time the routed batch"""
+    import bct
+
+    G = random_graphs(n_nodes, np.geomspace(densities[0], densities[1], n_mats), seed)
+    directed = np.random.default_rng(seed).random((n_nodes, n_nodes)) < 0.05
+
+    ref, t_bct = best_of(lambda: np.array([bct.betweenness_bin(g) for g in G]), repeats)
+    bc, t_batch = best_of(lambda: betweenness_bin_batch(G), repeats)
+    results = {'batch': bc,
+               'dense': np.concatenate([_betweenness_stack(G[i:i+1] != 0) for i in range(len(G))]),
+               'sparse': np.array([betweenness_bin_sparse(sp.csr_matrix(g)) for g in G])}
+    if numba is not None:
+        results['compiled'] = np.array([betweenness_bin_compiled(g) for g in G])
+
+    diffs = {name: np.max(np.abs(r - ref)) for name, r in results.items()}
+    if numba is not None:
+        diffs['compiled, directed'] = np.max(np.abs(betweenness_bin_compiled(directed)
+                                                    - bct.betweenness_bin(directed.astype(int))))
+    print(f"{n_nodes} nodes x {n_mats} matrices at {densities[0]:.0%}-{densities[1]:.0%} density, max abs difference: "
+          + ", ".join(f"{name} {d:.3g}" for name, d in diffs.items()))
+    print(f"bct.betweenness_bin: {t_bct:.4f} s, batch: {t_batch:.4f} s ({t_bct / t_batch:.1f}x)"
+          + ("" if numba is not None else ", numba missing: no compiled engine"))
+    return all(d < 1e-8 * max(1, np.max(np.abs(ref))) for d in diffs.values())
+
+def crossover(nodes=(83, 200, 400, 1000), densities=(0.01, 0.02, 0.05, 0.1, 0.2, 0.3, 0.4), n_mats=3, seed=0):
+    """ms per graph of bct and every engine, and the speedup of the best engine over bct"""
+    import bct
+
+    engines = {'bct': lambda g: bct.betweenness_bin(g),
+               'dense': lambda g: _betweenness_stack(g[np.newaxis] != 0)[0],
+               'sparse': lambda g: betweenness_bin_sparse(sp.csr_matrix(g))}
+    if numba is not None:
+        engines['compiled'] = betweenness_bin_compiled
+        betweenness_bin_compiled(np.ones((2, 2)))          # compile outside the timing
+    print("nodes density " + " ".join(f"{name:>9s}" for name in engines) + "  best/bct  engine()")
+    for n in nodes:
+        for p in densities:
+            G = random_graphs(n, [p] * n_mats, seed)
+            ms = {name: best_of(lambda: [f(g) for g in G], 1 if n >= 400 else 3)[1] / n_mats * 1e3
+                  for name, f in engines.items()}
+            fastest = min(ms[name] for name in ms if name != 'bct')
+            print(f"{n:5d} {p:7.2f} " + " ".join(f"{t:9.2f}" for t in ms.values())
+                  + f"  {ms['bct'] / fastest:7.1f}x  {engine(n, p * n * (n - 1))}", flush=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="validate and time the betweenness engines against bct")
+    parser.add_argument("--crossover", action="store_true", help="time every engine over sizes and densities")
+    args = parser.parse_args()
+
+    if args.crossover:
+        crossover()
+    else:
+        ok = all([validate(n) for n in (83, 200)])
+        print("OK" if ok else "MISMATCH")
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+"""
+Memory-mapped connectivity tensor of the whole cohort
+
+Every fdt_network_matrix and waytotal is parsed once (via the .npy sidecars
+of network_metrics.load_text_cached) and stored in a cohort directory:
+    tensor.f32      raw streamline counts, float32, n_vats x N x N (C order)
+    waytotal.f32    waytotals, float32, n_vats x N
+    index.csv       one row per VAT: sub, side, contact, amp, vatdir and the
+                    mtimes of its inputs
+    meta.json       n_nodes
+The binary files are plain arrays without header, so new VATs are appended
+at the end; VATs whose inputs changed are overwritten in their slot. The
+index is only replaced after the data is written, and data past the last
+indexed VAT (an interrupted run) is cut off before the next append.
+
+vat_connectivity_matrix.csv (the VAT row of every matrix, as written by
+concatenate_vat_connectivities.sh) is exported from the tensor. The values
+are the same numbers, but the file is not byte-identical to the shell
+version:
+    - rows are sorted by subject and VAT folder instead of find's directory order
+    - values are written with up to 10 significant digits ('%.10g'), so the
+      integer counts probtrackx usually writes come out as the same text,
+      but counts it wrote in e-notation (1.23457e+06) are written in full
+    - float32 holds counts exactly only up to 2^24, larger ones are warned about
+compare checks an export against an older file for the same numbers up to row order.
+
+Usage:
+    cohort_tensor.py build  [--imgdir DIR] [--cohort-dir DIR] [--rebuild] [--workers N]
+    cohort_tensor.py export [--imgdir DIR] [--cohort-dir DIR] [--output CSV]
+    cohort_tensor.py compare OLD.csv NEW.csv
+"""
+
+import os
+import re
+import json
+import sys
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from network_metrics import IMGDIR, stats_dir, find_vats, load_text_cached
+
+VAT_FOLDER = re.compile(r"([LR])_contact-([0-9]+)_amp-([0-9.]+)mA\+")
+INDEX_COLUMNS = ['sub', 'side', 'contact', 'amp', 'vatdir', 'matrix_mtime_ns', 'waytotal_mtime_ns']
+
+def cohort_dir(imgdir, outdir=None):
+    return outdir or os.path.join(imgdir, "cohort_tensor")
+
+def input_files(imgdir, sub, vatdir):
+    folder = stats_dir(imgdir, sub, vatdir)
+    return os.path.join(folder, "fdt_network_matrix"), os.path.join(folder, "waytotal")
+
+def read_vat(imgdir, sub, vatdir):
+    """raw matrix and waytotal of one VAT as float32"""
+    netfile, wtfile = input_files(imgdir, sub, vatdir)
+    return load_text_cached(netfile).astype(np.float32), load_text_cached(wtfile).astype(np.float32)
+
+def read_index(outdir):
+    """index table and number of nodes of a cohort directory, (empty, None) if there is none"""
+    try:
+        index = pd.read_csv(os.path.join(outdir, "index.csv"),
+                            dtype={c: str for c in ('sub', 'side', 'contact', 'amp', 'vatdir')})
+        with open(os.path.join(outdir, "meta.json")) as f:
+            return index, json.load(f)['n_nodes']
+    except (OSError, ValueError, KeyError):
+        return pd.DataFrame(columns=INDEX_COLUMNS), None
+
+def _write_rows(path, rows, arrays, shape, n_indexed):
+    """writes arrays into the given rows of a headerless float32 file holding n_indexed rows of shape"""
+    size = int(np.prod(shape)) * 4
+    mode = "r+b" if os.path.exists(path) else "w+b"
+    with open(path, mode) as f:
+        f.truncate(n_indexed * size)             # drop data of an interrupted append
+        for row, a in zip(rows, arrays):
+            f.seek(row * size)
+            f.write(np.ascontiguousarray(a, dtype=np.float32).tobytes())
+
+def build_tensor(imgdir=IMGDIR, outdir=None, pattern="*+", exclude="*++", rebuild=False, workers=1):
+    """
+    Adds new and changed VATs under imgdir to the cohort tensor. VATs are
+    appended in the order of find_vats; all matrices must have the same size.
+    Returns the index table.
+    """
+    outdir = cohort_dir(imgdir, outdir)
+    os.makedirs(outdir, exist_ok=True)
+    index, n_nodes = (pd.DataFrame(columns=INDEX_COLUMNS), None) if rebuild else read_index(outdir)
+    n_indexed = len(index)
+    slots = {(s, v): i for i, (s, v) in enumerate(zip(index['sub'], index['vatdir']))}
+
+    todo = []
+    rows = index.to_dict('records')
+    for sub, vatdir in find_vats(imgdir, pattern, exclude):
+        match = VAT_FOLDER.search(vatdir)
+        if not match:
+            continue
+        mtimes = [os.stat(f).st_mtime_ns for f in input_files(imgdir, sub, vatdir)]
+        rec = dict(zip(INDEX_COLUMNS, (sub,) + match.groups() + (vatdir,) + tuple(mtimes)))
+
+        slot = slots.get((sub, vatdir))
+        if slot is None:
+            slot = len(rows)
+            rows.append(rec)
+        elif [int(rows[slot]['matrix_mtime_ns']), int(rows[slot]['waytotal_mtime_ns'])] == mtimes:
+            continue
+        todo.append((slot, sub, vatdir))
+        rows[slot] = rec
+
+    print(f"{len(todo)} VATs to parse, {len(rows) - len(todo)} unchanged")
+    if not todo:
+        return index
+
+    if workers == 1:
+        parsed = [read_vat(imgdir, sub, vatdir) for _, sub, vatdir in todo]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            parsed = list(pool.map(read_vat, *zip(*[(imgdir, sub, vatdir) for _, sub, vatdir in todo])))
+
+    shapes = set(m.shape for m, _ in parsed) | ({(n_nodes, n_nodes)} if n_nodes else set())
+    if len(shapes) > 1:
+        raise ValueError(f"matrices of different sizes {sorted(shapes)}, use one cohort directory per parcellation")
+    n_nodes = parsed[0][0].shape[0]
+
+    slots = [slot for slot, _, _ in todo]
+    _write_rows(os.path.join(outdir, "tensor.f32"), slots, [m for m, _ in parsed], (n_nodes, n_nodes), n_indexed)
+    _write_rows(os.path.join(outdir, "waytotal.f32"), slots, [wt for _, wt in parsed], (n_nodes,), n_indexed)
+
+    # the index goes last, so it never refers to data that was not written
+    index = pd.DataFrame(rows, columns=INDEX_COLUMNS)
+    for name, content in (("meta.json", lambda f: json.dump({'n_nodes': n_nodes}, f)),
+                          ("index.csv", lambda f: index.to_csv(f, index=False))):
+        tmpfile = os.path.join(outdir, name + ".tmp")
+        with open(tmpfile, "w") as f:
+            content(f)
+        os.replace(tmpfile, os.path.join(outdir, name))
+    return index
+
+def load_tensor(outdir, mode='r'):
+    """index table and memory-mapped tensor (n_vats x N x N) and waytotals (n_vats x N)"""
+    index, n_nodes = read_index(outdir)
+    if n_nodes is None:
+        raise FileNotFoundError(f"no cohort tensor in {outdir}, run cohort_tensor.py build first")
+    n = len(index)
+    tensor = np.memmap(os.path.join(outdir, "tensor.f32"), np.float32, mode, shape=(n, n_nodes, n_nodes))
+    waytotal = np.memmap(os.path.join(outdir, "waytotal.f32"), np.float32, mode, shape=(n, n_nodes))
+    return index, tensor, waytotal
+
+def export_vat_rows(outdir, outfile):
+    """vat_connectivity_matrix.csv: subject, side, contact, amp and the VAT (last) row of every matrix"""
+    index, tensor, _ = load_tensor(outdir)
+    if len(index) == 0:
+        raise ValueError(f"the cohort tensor in {outdir} holds no VATs, nothing to export")
+    order = index.sort_values(['sub', 'vatdir']).index.to_numpy()
+    vat_rows = np.asarray(tensor[order, -1, :], dtype=np.float64)   # only these rows are read
+
+    if np.any(np.abs(vat_rows) > 2**24):
+        print(f"warning: counts above 2^24 are not exact in float32 (max {np.abs(vat_rows).max():.0f})")
+
+    df = pd.DataFrame(vat_rows, columns=[str(i) for i in range(1, tensor.shape[1] + 1)])
+    df.insert(0, 'amp', index['amp'].to_numpy()[order])
+    df.insert(0, 'contact', index['contact'].to_numpy()[order])
+    df.insert(0, 'side', index['side'].to_numpy()[order])
+    df.insert(0, 'subject', index['sub'].to_numpy()[order])
+    df.to_csv(outfile, index=False, float_format='%.10g')
+    return df
+
+def compare_exports(old, new):
+    """True if two vat_connectivity_matrix.csv files hold the same rows and numbers, in any row order"""
+    keys = ['subject', 'side', 'contact', 'amp']
+    a, b = [pd.read_csv(f, dtype={k: str for k in keys}).sort_values(keys).reset_index(drop=True)
+            for f in (old, new)]
+    if list(a.columns) != list(b.columns) or not a[keys].equals(b[keys]):
+        return False
+    return bool(np.array_equal(a.drop(columns=keys).to_numpy(float), b.drop(columns=keys).to_numpy(float)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="memory-mapped cohort connectivity tensor")
+    sub = parser.add_subparsers(dest="command", required=True)
+    for name in ("build", "export"):
+        p = sub.add_parser(name)
+        p.add_argument("--imgdir", default=IMGDIR, help="imaging root containing the subject folders")
+        p.add_argument("--cohort-dir", default=None, help="tensor directory (default: <imgdir>/cohort_tensor)")
+        p.add_argument("--pattern", default="*+", help="VAT folders to include")
+        p.add_argument("--exclude", default="*++", help="VAT folders to exclude")
+        p.add_argument("--workers", type=int, default=1, help="processes parsing new matrices")
+        if name == "build":
+            p.add_argument("--rebuild", action="store_true", help="start a new tensor instead of appending")
+        else:
+            p.add_argument("--output", default="../results/vat_connectivity_matrix.csv")
+    p = sub.add_parser("compare", help="same rows and numbers as an earlier vat_connectivity_matrix.csv")
+    p.add_argument("old")
+    p.add_argument("new")
+    args = parser.parse_args()
+
+    if args.command == "compare":
+        same = compare_exports(args.old, args.new)
+        print("same rows and values" if same else "DIFFERENT")
+        sys.exit(0 if same else 1)
+
+    outdir = cohort_dir(args.imgdir, args.cohort_dir)
+    if args.command == "build":
+        build_tensor(args.imgdir, outdir, args.pattern, args.exclude, args.rebuild, args.workers)
+    else:
+        index = build_tensor(args.imgdir, outdir, args.pattern, args.exclude, workers=args.workers)
+        if len(index) == 0:
+            sys.exit(f"no VAT folders matching {args.pattern} (excluding {args.exclude}) with an "
+                     f"fdt_network_matrix under {args.imgdir}, nothing exported")
+        export_vat_rows(outdir, args.output)
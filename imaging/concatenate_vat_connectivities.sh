@@ -3,24 +3,9 @@
 basedir="../../tremorDBS/imaging_tremorDBS"
 outfile="../results/vat_connectivity_matrix.csv"
 
-# Output header
-echo "subject,side,contact,amp,$(seq -s, 1 83)" > $outfile
-
-find "$basedir" -type f -name "fdt_network_matrix" -path "*+/*" ! -path "*++/*" | while read -r file; do
-    folder=$(dirname "$file")
-    foldername=$(basename "$folder")
-
-    # Get subject folder (grandgrandparent of the "+" folder)
-    subject=$(basename "$(dirname "$(dirname "$(dirname "$folder")")")")
-
-    if [[ "$foldername" =~ ([LR])_contact-([0-9]+)_amp-([0-9.]+)mA\+ ]]; then
-	side="${BASH_REMATCH[1]}"
-	contact="${BASH_REMATCH[2]}"
-	amp="${BASH_REMATCH[3]}"
-
-	# Clean VAT line and remove trailing comma
-	vat_line=$(tail -n 1 "$file" | tr -s '[:space:]' ',' | sed 's/,$//')
-
-	echo "$subject,$side,$contact,$amp,$vat_line"
-    fi
-done >> $outfile
+# Parse new or changed fdt_network_matrix/waytotal pairs of the "+" VAT folders
+# into the cohort tensor (<basedir>/cohort_tensor) and export the VAT row of
+# every matrix as subject,side,contact,amp,1..83. Rows are sorted by subject
+# and VAT folder; the numbers are those of the old tail/tr concatenation, check
+# against an older file with: python cohort_tensor.py compare OLD.csv NEW.csv
+python cohort_tensor.py export --imgdir "$basedir" --output "$outfile" "$@"
@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+"""
+Create z-score normalised effectiveness maps
+
+In-memory version of create_effectiveness_maps.sh. Per-subject RMS mean/sd
+and the z-score weights -(RMS - mean) / sd are computed for all VTAs at once,
+every VTA is read once and only its non-zero voxels are added to float32
+weighted and unweighted sums, and the maps are written once at the end.
+The cohort can be split across worker processes whose partial sums are
+added up before the division.
+
+With --loso every VTA is instead scored (mean intensity value, as in
+extract_miv.sh) against the map built without its subject, derived from the
+total sums minus that subject's partial sums.
+
+Outputs (same names as the shell version) in output_dir:
+stats_{left,right}.csv, {weighted,nonweighted}_sum_{left,right}.nii.gz,
+mask_{left,right}.nii.gz, effectiveness_map_{left,right,combined}.nii.gz
+"""
+
+import os
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import nibabel as nib
+
+VTA_FILE = os.path.join("{vta_root}", "sub-subject{subnum}", "stimulations", "MNI152NLin2009bAsym",
+                        "{side}_contact-{contact:02d}_amp-{amp}mA",
+                        "sub-subject{subnum}_sim-binary_model-simbio_hemi-{side}_MNI_1mm.nii.gz")
+
+def read_tremor(tremor_file):
+    """read a tremor_{left,right}STN_final.csv (subnum, side, contact, amp, RMS) as strings"""
+    df = pd.read_csv(tremor_file, dtype=str, keep_default_na=False)
+    df = df.iloc[:, :5]
+    df.columns = ['subnum', 'side', 'contact', 'amp', 'rms']
+    return df
+
+def subject_stats(tremor):
+    """mean and sd of RMS per subject, sd of single or constant recordings set to 0.001"""
+    rms = pd.to_numeric(tremor['rms'], errors='coerce')
+    stats = rms.groupby(tremor['subnum']).agg(['mean', 'std']).dropna(subset=['mean'])
+    stats.columns = ['mean_rms', 'sd_rms']
+    stats.loc[stats['sd_rms'].isna() | (stats['sd_rms'] == 0), 'sd_rms'] = 0.001
+    return stats
+
+def zscore_weights(tremor, stats):
+    """-(RMS - mean) / sd per VTA; 0 for non-numeric RMS or subjects without stats"""
+    valid = tremor['rms'].str.fullmatch(r'[0-9.]+') & tremor['subnum'].isin(stats.index)
+    rms = pd.to_numeric(tremor['rms'].where(valid), errors='coerce')
+    mean = tremor['subnum'].map(stats['mean_rms'])
+    sd = tremor['subnum'].map(stats['sd_rms'])
+    return (-(rms - mean) / sd).fillna(0).to_numpy()
+
+def vta_table(tremor_file, side, vta_root):
+    """one row per tremor recording with its z-score weight and VTA file"""
+    tremor = read_tremor(tremor_file)
+    stats = subject_stats(tremor)
+    tremor['weight'] = zscore_weights(tremor, stats)
+
+    offset = 8 if side == 'R' else 0           # right contacts are 9-16 in the tremor tables
+    tremor['vta_file'] = [VTA_FILE.format(vta_root=vta_root, subnum=s, side=side,
+                                          contact=int(float(c)) - offset, amp=a)
+                          for s, c, a in zip(tremor['subnum'], tremor['contact'], tremor['amp'])]
+    return tremor, stats
+
+def load_vta(vta_file, shape=None):
+    """flat indices and values of the non-zero voxels of a VTA"""
+    img = nib.load(vta_file)
+    if shape is not None and img.shape[:3] != tuple(shape):
+        raise ValueError(f"{vta_file} has shape {img.shape}, expected {tuple(shape)}")
+    data = np.asanyarray(img.dataobj).reshape(-1)
+    idx = np.flatnonzero(data)
+    return idx, data[idx].astype(np.float32)
+
+def accumulate(vta_files, weights, shape):
+    """weighted and unweighted float32 sums of the given VTAs, missing files are skipped"""
+    weighted = np.zeros(int(np.prod(shape)), dtype=np.float32)
+    nonweighted = np.zeros(int(np.prod(shape)), dtype=np.float32)
+    n = 0
+    for vta_file, w in zip(vta_files, weights):
+        if not os.path.isfile(vta_file):
+            continue
+        idx, val = load_vta(vta_file, shape)
+        weighted[idx] += np.float32(w) * val
+        nonweighted[idx] += val
+        n += 1
+    return weighted, nonweighted, n
+
+def accumulate_parallel(vta_files, weights, shape, workers=1):
+    """accumulate over worker processes and add up their partial sums"""
+    if workers == 1 or len(vta_files) < 2:
+        return accumulate(vta_files, weights, shape)
+
+    parts = np.array_split(np.arange(len(vta_files)), workers)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(accumulate, [vta_files[i] for i in p], [weights[i] for i in p], shape)
+                   for p in parts if len(p)]
+        weighted, nonweighted, n = futures[0].result()
+        for future in futures[1:]:
+            w, nw, k = future.result()
+            weighted += w
+            nonweighted += nw
+            n += k
+    return weighted, nonweighted, n
+
+def effectiveness(weighted, nonweighted):
+    """weighted mean z-score per voxel, 0 outside the VTA coverage"""
+    emap = np.zeros_like(weighted)
+    np.divide(weighted, nonweighted, out=emap, where=nonweighted > 0)
+    return emap
+
+def _load_if_exists(args):
+    vta_file, shape = args
+    return load_vta(vta_file, shape) if os.path.isfile(vta_file) else None
+
+def load_vtas(vta_files, shape, workers=1):
+    """sparse (indices, values) of every VTA, None for missing files"""
+    jobs = [(f, shape) for f in vta_files]
+    if workers == 1:
+        return list(map(_load_if_exists, jobs))
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(_load_if_exists, jobs, chunksize=16))
+
+def loso_miv(vtas, weights, subjects, shape):
+    """
+    Leave-one-subject-out mean intensity value of every VTA.
+
+    Each VTA is scored against the map built without its subject,
+    (W_total - W_s) / (N_total - N_s), which only has to be evaluated on the
+    held-out subject's VTA voxels. Sums are kept in float64 so the
+    subtraction does not lose the small partial sums. NaN for missing VTAs.
+    """
+    size = int(np.prod(shape))
+    W = np.zeros(size)
+    N = np.zeros(size)
+    for vta, w in zip(vtas, weights):
+        if vta is not None:
+            W[vta[0]] += w * vta[1]
+            N[vta[0]] += vta[1]
+
+    miv = np.full(len(vtas), np.nan)
+    for rows in pd.Series(subjects).groupby(subjects).indices.values():
+        rows = [r for r in rows if vtas[r] is not None]
+        if not rows:
+            continue
+
+        # partial sums of the held-out subject on the union of its VTAs
+        union = np.unique(np.concatenate([vtas[r][0] for r in rows]))
+        Ws = np.zeros(len(union))
+        Ns = np.zeros(len(union))
+        for r in rows:
+            pos = np.searchsorted(union, vtas[r][0])
+            Ws[pos] += weights[r] * vtas[r][1]
+            Ns[pos] += vtas[r][1]
+
+        den = N[union] - Ns
+        emap = np.zeros(len(union))
+        np.divide(W[union] - Ws, den, out=emap, where=den > 0)
+
+        for r in rows:
+            if len(vtas[r][0]):
+                miv[r] = emap[np.searchsorted(union, vtas[r][0])].mean()
+    return miv
+
+def save_map(data, ref_img, outfile):
+    img = nib.Nifti1Image(data.reshape(ref_img.shape[:3]), ref_img.affine, ref_img.header)
+    img.set_data_dtype(data.dtype)
+    nib.save(img, outfile)
+
+def process_vtas(vta_root, output_dir, tremor_left_stn, tremor_right_stn, ref_mni, workers=1):
+    os.makedirs(output_dir, exist_ok=True)
+    ref_img = nib.load(ref_mni)
+    shape = ref_img.shape[:3]
+
+    emaps = []
+    for side, hemi, tremor_file in [('L', 'left', tremor_left_stn), ('R', 'right', tremor_right_stn)]:
+        tremor, stats = vta_table(tremor_file, side, vta_root)
+        stats.to_csv(os.path.join(output_dir, f"stats_{hemi}.csv"), index_label='subnum')
+
+        weighted, nonweighted, n = accumulate_parallel(list(tremor['vta_file']), list(tremor['weight']),
+                                                       shape, workers)
+        print(f"{hemi}: {n} of {len(tremor)} VTAs found")
+
+        emap = effectiveness(weighted, nonweighted)
+        save_map(weighted, ref_img, os.path.join(output_dir, f"weighted_sum_{hemi}.nii.gz"))
+        save_map(nonweighted, ref_img, os.path.join(output_dir, f"nonweighted_sum_{hemi}.nii.gz"))
+        save_map((nonweighted > 0).astype(np.float32), ref_img, os.path.join(output_dir, f"mask_{hemi}.nii.gz"))
+        save_map(emap, ref_img, os.path.join(output_dir, f"effectiveness_map_{hemi}.nii.gz"))
+        emaps.append(emap)
+
+    save_map(emaps[0] + emaps[1], ref_img, os.path.join(output_dir, "effectiveness_map_combined.nii.gz"))
+
+def process_loso(vta_root, tremor_left_stn, tremor_right_stn, ref_mni, output_left, output_right, workers=1):
+    """cross-validated MIV csvs in the format of extract_miv.sh (subnum,side,contact,amp,miv)"""
+    shape = nib.load(ref_mni).shape[:3]
+
+    for side, tremor_file, output in [('L', tremor_left_stn, output_left), ('R', tremor_right_stn, output_right)]:
+        tremor, _ = vta_table(tremor_file, side, vta_root)
+        vtas = load_vtas(list(tremor['vta_file']), shape, workers)
+        miv = loso_miv(vtas, tremor['weight'].to_numpy(), tremor['subnum'].to_numpy(), shape)
+
+        with open(output, "w") as f:
+            for row, vta, m in zip(tremor.itertuples(), vtas, miv):
+                if vta is None:
+                    continue
+                f.write(f"{row.subnum},{side},{row.contact},{row.amp},{0 if np.isnan(m) else f'{m:.6f}'}\n")
+        print(f"{side}: {sum(v is not None for v in vtas)} of {len(tremor)} VTAs scored")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="z-score normalised effectiveness maps")
+    parser.add_argument("--vta-root", default="path/to/leaddbs/derivatives")
+    parser.add_argument("--output-dir", default="path/to/output")
+    parser.add_argument("--tremor-left", default="path/to/tremor_leftSTN_final.csv")
+    parser.add_argument("--tremor-right", default="path/to/tremor_rightSTN_final.csv")
+    parser.add_argument("--ref-mni", default="path/to/MNI_1.nii")
+    parser.add_argument("--workers", type=int, default=1, help="worker processes per hemisphere")
+    parser.add_argument("--loso", action="store_true",
+                        help="write leave-one-subject-out MIV csvs instead of the maps")
+    parser.add_argument("--miv-left", default=None, help="LOSO output (default: <output-dir>/miv_loso_leftSTN.csv)")
+    parser.add_argument("--miv-right", default=None, help="LOSO output (default: <output-dir>/miv_loso_rightSTN.csv)")
+    args = parser.parse_args()
+
+    if args.loso:
+        os.makedirs(args.output_dir, exist_ok=True)
+        process_loso(args.vta_root, args.tremor_left, args.tremor_right, args.ref_mni,
+                     args.miv_left or os.path.join(args.output_dir, "miv_loso_leftSTN.csv"),
+                     args.miv_right or os.path.join(args.output_dir, "miv_loso_rightSTN.csv"),
+                     args.workers)
+    else:
+        process_vtas(args.vta_root, args.output_dir, args.tremor_left, args.tremor_right, args.ref_mni, args.workers)
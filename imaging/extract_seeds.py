@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""
+Seed masks of a parcellation in diffusion space
+
+Replaces one mri_binarize --match call per line of the seed list: the
+parcellation (aseg2diff.nii.gz) is read once, the voxels of all listed
+labels are grouped in one pass (a sort of the label positions), and the
+binary masks <output-dir>/<name>.nii.gz are written by worker processes.
+seeds.txt lists the masks in seed list order, as probtrackx expects.
+Labels missing from the parcellation give an empty mask, as with
+mri_binarize.
+
+Optionally all masks also go into one file for later stages:
+    --4d FILE      x * y * z * n_seeds uint8 volume, volume i = line i of seeds.txt
+    --labels FILE  int16 volume with the seeds.txt line (1-based) of every voxel, 0 elsewhere
+
+Usage:
+    extract_seeds.py --parcellation diffusion/aseg2diff.nii.gz --output-dir seeds
+                     [--seed-list desikan_seed_list.txt] [--workers N] [--4d FILE] [--labels FILE]
+"""
+
+import os
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import nibabel as nib
+
+SEED_LIST = os.path.join(os.path.dirname(os.path.abspath(__file__)), "desikan_seed_list.txt")
+
+def read_seed_list(seed_list=SEED_LIST):
+    """(label, name) of every line of a seed list"""
+    seeds = []
+    with open(seed_list) as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) >= 2:
+                seeds.append((int(fields[0]), fields[1]))
+    return seeds
+
+def split_labels(data, labels):
+    """flat (C order) voxel indices of every label, in the order of labels"""
+    labels = np.asarray(labels)
+    order = np.argsort(labels)
+    flat = np.asarray(data).reshape(-1)
+    pos = np.searchsorted(labels[order], flat)
+    pos[pos == len(labels)] = 0
+    hit = labels[order][pos] == flat                    # voxels carrying a listed label
+    voxels = np.flatnonzero(hit)
+    seed = order[pos[hit]]
+
+    by_seed = np.argsort(seed, kind='stable')
+    bounds = np.searchsorted(seed[by_seed], np.arange(len(labels) + 1))
+    return [voxels[by_seed[bounds[i]:bounds[i + 1]]] for i in range(len(labels))]
+
+_grid = {}
+
+def _init(shape, affine, header):
+    _grid.update(shape=shape, affine=affine, header=header)
+
+def write_mask(voxels, outfile):
+    """binary uint8 mask of the given flat voxel indices on the parcellation grid"""
+    data = np.zeros(int(np.prod(_grid['shape'])), dtype=np.uint8)
+    data[voxels] = 1
+    img = nib.Nifti1Image(data.reshape(_grid['shape']), _grid['affine'], _grid['header'])
+    img.set_data_dtype(np.uint8)
+    nib.save(img, outfile)
+    return outfile
+
+def extract_seeds(parcellation, output_dir, seed_list=SEED_LIST, workers=1, out_4d=None, out_labels=None):
+    """writes the seed masks and seeds.txt, returns the mask files"""
+    img = nib.load(parcellation)
+    data = np.asanyarray(img.dataobj)
+    if data.ndim > 3:
+        data = data.reshape(data.shape[:3])
+    data = np.rint(data).astype(np.int64)
+    shape = data.shape
+
+    seeds = read_seed_list(seed_list)
+    voxels = split_labels(data, [label for label, _ in seeds])
+    files = [os.path.join(output_dir, f"{name}.nii.gz") for _, name in seeds]
+    for (label, name), idx in zip(seeds, voxels):
+        if len(idx) == 0:
+            print(f"warning: label {label} ({name}) not in {parcellation}, empty mask")
+
+    os.makedirs(output_dir, exist_ok=True)
+    header = img.header.copy()
+    if workers == 1:
+        _init(shape, img.affine, header)
+        list(map(write_mask, voxels, files))
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init,
+                                 initargs=(shape, img.affine, header)) as pool:
+            list(pool.map(write_mask, voxels, files))
+
+    with open(os.path.join(output_dir, "seeds.txt"), "w") as f:
+        f.writelines(path + "\n" for path in files)
+
+    if out_4d:
+        stack = np.zeros((int(np.prod(shape)), len(seeds)), dtype=np.uint8)
+        for i, idx in enumerate(voxels):
+            stack[idx, i] = 1
+        nib.save(nib.Nifti1Image(stack.reshape(shape + (len(seeds),)), img.affine), out_4d)
+    if out_labels:
+        indexed = np.zeros(int(np.prod(shape)), dtype=np.int16)
+        for i, idx in enumerate(voxels):
+            indexed[idx] = i + 1
+        nib.save(nib.Nifti1Image(indexed.reshape(shape), img.affine), out_labels)
+    return files
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="binary seed masks of all labels of a seed list")
+    parser.add_argument("--parcellation", required=True, help="parcellation in diffusion space (aseg2diff.nii.gz)")
+    parser.add_argument("--output-dir", required=True, help="folder of the masks and seeds.txt")
+    parser.add_argument("--seed-list", default=SEED_LIST, help="label and name per line")
+    parser.add_argument("--workers", type=int, default=1, help="processes writing masks")
+    parser.add_argument("--4d", dest="out_4d", default=None, help="also write all masks as one 4D volume")
+    parser.add_argument("--labels", default=None, help="also write one volume of seeds.txt line numbers")
+    args = parser.parse_args()
+
+    files = extract_seeds(args.parcellation, args.output_dir, args.seed_list, args.workers, args.out_4d, args.labels)
+    print(f"{len(files)} seed masks in {args.output_dir}")
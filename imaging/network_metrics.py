@@ -1,12 +1,17 @@
 import os
-import sys
+import json
+import time
+import fnmatch
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import numpy as np
 import pandas as pd
-import bct
+import scipy.sparse as sp
+from betweenness import betweenness_bin_batch, betweenness_bin
+from weighted_metrics import LENGTHS, weighted_sweep_metrics
+from stage_trace import no_stage, stage_timer, write_trace
 
-# Get command-line arguments
-sub    = sys.argv[1]  # subject
-vatdir = sys.argv[2]  # VAT directory containing probtrackx output
+IMGDIR = "/home/armink/tremorDBS/imaging_tremorDBS"
 
 def symmetricize_matrix(M):
     M = M.copy()                        # Avoid modifying the original matrix
@@ -16,39 +21,349 @@ def symmetricize_matrix(M):
 
     return M_symmetric
 
-def calc_metrics(sub, vatdir, l_thr=60, u_thr=80):
+def stats_dir(imgdir, sub, vatdir):
+    """probtrackx output folder of one VAT"""
+    return os.path.join(imgdir, sub, "diffusion", "stats", vatdir)
+
+def load_text_cached(path):
+    """np.loadtxt with a binary <path>.npy sidecar, reparsed only if the text file is newer"""
+    sidecar = path + ".npy"
+    try:
+        if os.stat(sidecar).st_mtime_ns >= os.stat(path).st_mtime_ns:
+            return np.load(sidecar)
+    except (OSError, ValueError):
+        pass                                         # no or unreadable sidecar
+
+    data = np.loadtxt(path)
+    try:
+        tmpfile = sidecar + ".tmp"
+        with open(tmpfile, "wb") as f:
+            np.save(f, data)
+        os.replace(tmpfile, sidecar)
+    except OSError:
+        pass                                         # read-only tree, parse again next time
+    return data
+
+def load_matrix(sub, vatdir, imgdir=IMGDIR, stage=no_stage):
+    """loads the probtrackx network matrix of one VAT, normalized by waytotal and symmetricized"""
+    """stage is a stage_trace timer, each step is recorded under its own name"""
+    netfile = os.path.join(stats_dir(imgdir, sub, vatdir), "fdt_network_matrix")
+    wtfile  = os.path.join(stats_dir(imgdir, sub, vatdir), "waytotal")
+
+    with stage('loadtxt'):
+        m  = load_text_cached(netfile)               # load connectivities
+        wt = load_text_cached(wtfile)                # load waytotals
+    with stage('waytotal'):
+        m = m / wt.reshape(-1,1)                     # normalize by waytotal per row
+    with stage('symmetricize'):
+        return symmetricize_matrix(m)                # make matrix symmetric by averaging
+
+def threshold_sweep(M, thresh_list):
+    """binarizes a stack of matrices (n_vats x N x N) at every threshold in one vectorized pass"""
+    """returns the binary masks (n_vats x n_thr x N x N) and degrees (n_vats x n_thr x N)"""
+    M = np.asarray(M)
+    if M.ndim == 2:
+        M = M[np.newaxis]
+
+    # one partition of the edge weights per matrix yields the percentiles of all thresholds
+    cuts = np.percentile(M.reshape(M.shape[0], -1), thresh_list, axis=1).T
+    M_bin = ~(M[:, np.newaxis] < cuts[:, :, np.newaxis, np.newaxis])
+
+    deg = M_bin.sum(axis=2)                          # same as bct.degrees_und on every mask
+    return M_bin, deg
+
+def sweep_metrics(M, l_thr=60, u_thr=80, stage=no_stage):
+    """calculates degree/bc of a stack of matrices for every density between l_thr and u_thr"""
+    thresh_list = [i for i in range(l_thr, u_thr+1)]
+    with stage('threshold'):
+        M_bin, deg = threshold_sweep(M, thresh_list)
+
+    # every threshold of every VAT goes through the betweenness engine in one call
+    n = M_bin.shape[-1]
+    with stage('betweenness'):
+        bc = betweenness_bin_batch(M_bin.reshape(-1, n, n)).reshape(deg.shape)
+
+    return thresh_list, deg, bc
+
+def sparse_edges(m, thresh_list):
+    """percentile cut of every threshold and the edges at or above the lowest cut as CSR (weights kept)"""
+    """pairs with zero weight are never edges, the dense sweep only differs from this if a cut is <= 0"""
+    cuts = np.percentile(m, thresh_list)
+    if cuts.min() <= 0:
+        print(f"warning: percentile threshold {thresh_list[int(np.argmin(cuts))]} is {cuts.min():g}, "
+              f"unconnected pairs are not counted as edges in sparse mode")
+
+    rows, cols = np.nonzero(~(m < cuts.min()) & (m != 0))
+    return cuts, sp.csr_matrix((m[rows, cols], (rows, cols)), shape=m.shape)
+
+def sparse_sweep_metrics(m, l_thr=60, u_thr=80, block=64, stage=no_stage):
+    """same as sweep_metrics for one matrix, with the graph of every threshold kept as CSR"""
+    """the betweenness of every threshold goes to the engine that was fastest for its density
+    (betweenness.engine: compiled BFS below 5% with numba, dense engine above). The matrix itself
+    is still read densely, probtrackx writes it as dense text"""
+    thresh_list = [i for i in range(l_thr, u_thr+1)]
+    n = m.shape[0]
+    deg = np.zeros((1, len(thresh_list), n), dtype=int)
+    bc = np.zeros((1, len(thresh_list), n))
+
+    with stage('threshold'):
+        cuts, E = sparse_edges(m, thresh_list)
+        graphs = []
+        for t, cut in enumerate(cuts):
+            A = E.copy()
+            A.data = (~(A.data < cut)).astype(float) # same comparison as threshold_sweep
+            A.eliminate_zeros()
+            deg[0, t] = np.diff(A.indptr)            # edges per row = degree of the symmetric graph
+            graphs.append(A)
+
+    with stage('betweenness'):
+        for t, A in enumerate(graphs):
+            bc[0, t] = betweenness_bin(A, block)
+
+    return thresh_list, deg, bc
+
+def write_metrics(outfile, sub, thresh_list, deg, bc, weighted=None):
+    """saves degree/bc of one VAT (n_thr x N) in long format"""
+    """weighted is an optional (strength, bc_wei) pair of the same shape, added as columns"""
+    n_thr, n_nodes = deg.shape
+    df = pd.DataFrame({'sub': sub,
+                       'thresh': np.repeat(thresh_list, n_nodes),
+                       'node': np.tile(np.arange(1, n_nodes+1), n_thr),
+                       'deg': deg.ravel(),
+                       'bc': bc.ravel()})
+    if weighted is not None:
+        df['strength'] = weighted[0].ravel()
+        df['bc_wei'] = weighted[1].ravel()
+
+    # write next to the target and rename, so an interrupted run never leaves
+    # a partial csv that looks newer than its inputs
+    tmpfile = outfile + ".tmp"
+    df.to_csv(tmpfile, index=False)
+    os.replace(tmpfile, outfile)
+
+def calc_metrics(sub, vatdir, l_thr=60, u_thr=80, imgdir=IMGDIR, sparse=False, weighted=None, trace=None):
     """creates normalized matrices between user defined density limits"""
     """calculates degree/bc for each density and saves an array of these degrees per subject"""
     """default are 60th and 80th percentile = 20-40% density"""
-    
-    thresh_list = [i for i in range(l_thr, u_thr+1)]
-    imgdir = "/home/armink/tremorDBS/imaging_tremorDBS"
-    netfile = os.path.join(imgdir, sub, "diffusion", "stats", vatdir, "fdt_network_matrix")    
-    wtfile  = os.path.join(imgdir, sub, "diffusion", "stats", vatdir, "waytotal")    
-    outfile = os.path.join(imgdir, sub, "diffusion", "stats", vatdir, "network_metrics.csv")    
-
-    m  = np.loadtxt(netfile)                         # load connectivities
-    wt = np.loadtxt(wtfile)                          # load waytotals
-    m = m / wt.reshape(-1,1)                         # normalize by waytotal per row
-    m = symmetricize_matrix(m)                       # make matrix symmetric by averaging
-    
-    thresh_list = [i for i in range(l_thr, u_thr+1)]   # list of thresholds
-    node_list   = [i for i in range(1, m.shape[0]+1)]  # list of nodes for output
-    subdg = []; subbc = []; nodes = []; threshs = [];  # prepare output
-
-    for thr in thresh_list:
-       # calculate percentiles and binarize matrix based on threshold
-        m_bin = np.where(m < np.percentile(m, int(thr)), 0, 1)   
-
-        subdg.extend(bct.degrees_und(m_bin))     # calc and append degree
-        subbc.extend(bct.betweenness_bin(m_bin)) # calc and append betweenness
-        nodes.extend(node_list)
-        threshs.extend([thr for _ in range(m.shape[0])])
-       
-   # save to file
-    df = pd.DataFrame({'sub': sub, 'thresh': threshs, 'node': nodes, 'deg': subdg, 'bc': subbc})
-    df.to_csv(outfile, index=False)
-            
-
-print(vatdir)
-calc_metrics(sub, vatdir)
+    """sparse=True keeps graphs as CSR, betweenness engines as in betweenness.engine"""
+    """weighted='log' or 'inv' adds strength and betweenness on -log(w) or 1/w lengths"""
+    """trace appends per-stage wall time and memory to a JSON-lines file (see stage_trace.py)"""
+
+    outfile = os.path.join(stats_dir(imgdir, sub, vatdir), "network_metrics.csv")
+    records = [] if trace else None
+    stage = stage_timer(records, [(sub, vatdir)])
+
+    try:
+        m = load_matrix(sub, vatdir, imgdir, stage)
+        if sparse:
+            thresh_list, deg, bc = sparse_sweep_metrics(m, l_thr, u_thr, stage=stage)
+        else:
+            thresh_list, deg, bc = sweep_metrics(m, l_thr, u_thr, stage)
+        wei = None
+        if weighted:
+            with stage('weighted'):
+                wei = weighted_sweep_metrics(m, thresh_list, weighted)
+        with stage('write'):
+            write_metrics(outfile, sub, thresh_list, deg[0], bc[0], wei)
+    finally:
+        write_trace(trace, records)
+
+def calc_metrics_batch(vats, l_thr=60, u_thr=80, batch_size=64, imgdir=IMGDIR, sparse=False, weighted=None,
+                       trace=None):
+    """same as calc_metrics for a list of (sub, vatdir) pairs, stacking batch_size VATs per sweep"""
+    """returns (sub, vatdir, error) per VAT, error is None on success"""
+    """stages run on a stack are traced with their time split evenly over its VATs"""
+    status = []
+    if sparse:
+        # sparse graphs are not stacked, every VAT goes through its own sweep
+        for s, v in vats:
+            try:
+                calc_metrics(s, v, l_thr, u_thr, imgdir, sparse=True, weighted=weighted, trace=trace)
+                status.append((s, v, None))
+                print(v)
+            except Exception as e:
+                status.append((s, v, f"{type(e).__name__}: {e}"))
+        return status
+
+    records = [] if trace else None
+    for start in range(0, len(vats), batch_size):
+        loaded = {}
+        for s, v in vats[start:start+batch_size]:
+            try:
+                loaded[(s, v)] = load_matrix(s, v, imgdir, stage_timer(records, [(s, v)]))
+            except Exception as e:
+                status.append((s, v, f"{type(e).__name__}: {e}"))
+
+        # VATs of different parcellation sizes cannot share a stack
+        for shape in set(m.shape for m in loaded.values()):
+            chunk = [key for key, m in loaded.items() if m.shape == shape]
+            M = np.stack([loaded[key] for key in chunk])
+            try:
+                swept = sweep_metrics(M, l_thr, u_thr, stage_timer(records, chunk))
+            except Exception:
+                swept = None                         # sweep the VATs one by one to find the failing one
+
+            for i, (s, v) in enumerate(chunk):
+                stage = stage_timer(records, [(s, v)])
+                outfile = os.path.join(stats_dir(imgdir, s, v), "network_metrics.csv")
+                try:
+                    if swept is None:
+                        thresh_list, deg, bc = sweep_metrics(M[i], l_thr, u_thr, stage)
+                        deg, bc = deg[0], bc[0]
+                    else:
+                        thresh_list, deg, bc = swept[0], swept[1][i], swept[2][i]
+                    wei = None
+                    if weighted:
+                        with stage('weighted'):
+                            wei = weighted_sweep_metrics(M[i], thresh_list, weighted)
+                    with stage('write'):
+                        write_metrics(outfile, s, thresh_list, deg, bc, wei)
+                except Exception as e:
+                    status.append((s, v, f"{type(e).__name__}: {e}"))
+                    continue
+                status.append((s, v, None))
+                print(v)
+
+        write_trace(trace, records)                  # one append per batch
+        records = [] if trace else None
+
+    return status
+
+def find_vats(imgdir=IMGDIR, pattern="*+", exclude="*++"):
+    """
+    Discover all probtrackx outputs <imgdir>/<sub>/diffusion/stats/<vatdir>/fdt_network_matrix.
+    As in concatenate_vat_connectivities.sh only VAT folders matching pattern
+    (and not exclude) are kept. Returns a sorted list of (sub, vatdir) pairs.
+    """
+    vats = []
+    for sub in sorted(os.listdir(imgdir)):
+        statsdir = os.path.join(imgdir, sub, "diffusion", "stats")
+        if not os.path.isdir(statsdir):
+            continue
+        for vatdir in sorted(os.listdir(statsdir)):
+            if not fnmatch.fnmatch(vatdir, pattern) or (exclude and fnmatch.fnmatch(vatdir, exclude)):
+                continue
+            if os.path.isfile(os.path.join(statsdir, vatdir, "fdt_network_matrix")):
+                vats.append((sub, vatdir))
+    return vats
+
+def is_up_to_date(sub, vatdir, imgdir=IMGDIR):
+    """True if network_metrics.csv is newer than the network matrix and waytotal"""
+    folder = stats_dir(imgdir, sub, vatdir)
+    outfile = os.path.join(folder, "network_metrics.csv")
+    if not os.path.isfile(outfile):
+        return False
+    inputs = [os.path.join(folder, f) for f in ("fdt_network_matrix", "waytotal")]
+    return os.path.getmtime(outfile) > max(os.path.getmtime(f) for f in inputs if os.path.exists(f))
+
+def read_manifest(manifest):
+    """last recorded status per (sub, vatdir) from a JSON-lines manifest"""
+    records = {}
+    if os.path.isfile(manifest):
+        with open(manifest) as f:
+            for line in f:
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    continue                         # line cut off by an interrupted run
+                records[(rec['sub'], rec['vatdir'])] = rec
+    return records
+
+def run_cohort(imgdir=IMGDIR, workers=None, manifest=None, l_thr=60, u_thr=80,
+               batch_size=16, pattern="*+", exclude="*++", force=False, retry_failed=False, sparse=False,
+               weighted=None, trace=None):
+    """
+    Calculate network metrics for every VAT of the cohort over a process pool.
+
+    VATs whose network_metrics.csv is newer than their inputs are skipped.
+    Every finished VAT is appended to the manifest (default
+    <imgdir>/network_metrics_manifest.jsonl), so an interrupted run resumes
+    where it stopped; VATs that failed before are only retried with retry_failed.
+    With trace, per-stage timings of every VAT are appended to that JSON-lines
+    file; summarize them with stage_trace.py summarize.
+    """
+    manifest = manifest or os.path.join(imgdir, "network_metrics_manifest.jsonl")
+    records = read_manifest(manifest)
+
+    todo = []
+    n_fresh = n_failed = 0
+    for sub, vatdir in find_vats(imgdir, pattern, exclude):
+        rec = records.get((sub, vatdir))
+        if not force and is_up_to_date(sub, vatdir, imgdir):
+            n_fresh += 1
+        elif not force and not retry_failed and rec is not None and rec['status'] == 'failed':
+            n_failed += 1
+        else:
+            todo.append((sub, vatdir))
+
+    print(f"{len(todo)} VATs to process, {n_fresh} up to date, {n_failed} skipped after earlier failure")
+    chunks = [todo[i:i+batch_size] for i in range(0, len(todo), batch_size)]
+
+    t0 = time.time()
+    n_done = 0
+    with open(manifest, "a") as log:
+        def record(status):
+            nonlocal n_done
+            for sub, vatdir, error in status:
+                rec = {'sub': sub, 'vatdir': vatdir, 'status': 'done' if error is None else 'failed',
+                       'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+                if error is not None:
+                    rec['error'] = error
+                    print(f"FAILED {sub} {vatdir}: {error}")
+                log.write(json.dumps(rec) + "\n")
+                n_done += 1
+            log.flush()
+            print(f"{n_done}/{len(todo)} VATs, {time.time() - t0:.1f} s")
+
+        if workers == 1:
+            for chunk in chunks:
+                record(calc_metrics_batch(chunk, l_thr, u_thr, batch_size, imgdir, sparse, weighted,
+                                          trace))
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                futures = {pool.submit(calc_metrics_batch, chunk, l_thr, u_thr, batch_size, imgdir, sparse, weighted,
+                                       trace): chunk
+                           for chunk in chunks}
+                for future in as_completed(futures):
+                    try:
+                        status = future.result()
+                    except Exception as e:                 # the worker itself died
+                        chunk = futures[future]
+                        status = [(sub, vatdir, f"{type(e).__name__}: {e}") for sub, vatdir in chunk]
+                    record(status)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="degree/betweenness of probtrackx network matrices across densities")
+    parser.add_argument("sub", nargs="?", help="subject (single VAT mode)")
+    parser.add_argument("vatdir", nargs="?", help="VAT directory containing probtrackx output (single VAT mode)")
+    parser.add_argument("--imgdir", default=IMGDIR, help="imaging root containing the subject folders")
+    parser.add_argument("--cohort", action="store_true", help="process every VAT found under --imgdir")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: all cores)")
+    parser.add_argument("--batch-size", type=int, default=16, help="VATs per worker task")
+    parser.add_argument("--manifest", default=None, help="progress manifest (default: <imgdir>/network_metrics_manifest.jsonl)")
+    parser.add_argument("--pattern", default="*+", help="VAT folders to include")
+    parser.add_argument("--exclude", default="*++", help="VAT folders to exclude")
+    parser.add_argument("--force", action="store_true", help="recompute up-to-date VATs")
+    parser.add_argument("--retry-failed", action="store_true", help="retry VATs recorded as failed")
+    parser.add_argument("--l-thr", type=int, default=60)
+    parser.add_argument("--u-thr", type=int, default=80)
+    parser.add_argument("--sparse", action="store_true",
+                        help="CSR graphs, one threshold at a time instead of a dense stack "
+                             "(slower than the default at the usual 20-40%% densities)")
+    parser.add_argument("--weighted", choices=LENGTHS, default=None,
+                        help="add strength and weighted betweenness on -log(w) or 1/w edge lengths")
+    parser.add_argument("--trace", default=None,
+                        help="append per-stage wall time and memory per VAT to this JSON-lines file")
+    args = parser.parse_args()
+
+    if args.cohort:
+        run_cohort(args.imgdir, args.workers, args.manifest, args.l_thr, args.u_thr, args.batch_size,
+                   args.pattern, args.exclude, args.force, args.retry_failed, args.sparse, args.weighted,
+                   args.trace)
+    elif args.sub and args.vatdir:
+        print(args.vatdir)
+        calc_metrics(args.sub, args.vatdir, args.l_thr, args.u_thr, args.imgdir, args.sparse, args.weighted,
+                     args.trace)
+    else:
+        parser.error("give sub and vatdir, or --cohort")
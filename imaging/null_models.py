@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""
+Degree-preserving null models for network_metrics
+
+For every VAT and density threshold an ensemble of degree-preserving
+rewirings of the binarized network (bct.randmio_und, self-loops removed) is
+generated, and the betweenness of every null network is calculated. The rewirings
+of all VATs and thresholds are split into batches that run on a process
+pool, and the null betweenness of a batch goes through the batched
+betweenness engine in one call.
+
+Every null network has its own seed derived from (seed, sub, vatdir,
+threshold, null index), so ensembles are reproducible independent of the
+number of workers and the batch size.
+
+Adds columns to network_metrics.csv:
+    bc_norm   betweenness divided by the null ensemble mean
+    bc_z      (value - null mean) / null sd
+Rewiring preserves degrees exactly, so degree is not normalized. A
+network_metrics.csv written for other thresholds than the null ensembles
+is recalculated first.
+"""
+
+import os
+import zlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import bct
+from betweenness import betweenness_bin_batch
+from network_metrics import IMGDIR, stats_dir, load_matrix, threshold_sweep, calc_metrics, find_vats
+
+def null_seeds(seed, sub, vatdir, thr, n_null):
+    """one RandomState seed per null network of a VAT and threshold"""
+    key = zlib.crc32(f"{sub}/{vatdir}".encode())
+    return np.random.SeedSequence([seed, key, thr]).generate_state(n_null)
+
+def null_batch(G, seeds, itr=5):
+    """betweenness (n_seeds x N) of degree-preserving rewirings of a binary matrix"""
+    G = np.array(G, dtype=int)
+    np.fill_diagonal(G, 0)                           # randmio_und would rewire self-loops as edges
+    R = np.stack([bct.randmio_und(G, itr, seed=int(s))[0] for s in seeds])
+    return betweenness_bin_batch(R)
+
+def normalize(values, null):
+    """ratio to the null mean and z-score against the null ensemble (n_null x ...)"""
+    mean = null.mean(axis=0)
+    sd = null.std(axis=0, ddof=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        norm = np.where(mean > 0, values / mean, np.nan)
+        z = np.where(sd > 0, (values - mean) / sd, np.nan)
+    return norm, z
+
+def read_metrics(outfile, thresh_list, n_nodes):
+    """network_metrics.csv if it holds exactly the given thresholds and nodes in write_metrics order, else None"""
+    if not os.path.isfile(outfile):
+        return None
+    df = pd.read_csv(outfile, float_precision='round_trip')
+    expected = (np.repeat(thresh_list, n_nodes), np.tile(np.arange(1, n_nodes+1), len(thresh_list)))
+    if len(df) != len(expected[0]) or not (np.array_equal(df['thresh'], expected[0])
+                                           and np.array_equal(df['node'], expected[1])):
+        print(f"{outfile} was written for other thresholds or nodes, recalculating")
+        return None
+    return df
+
+def _null_chunk(pool, vats, imgdir, thresh_list, n_null, itr, seed, batch, l_thr, u_thr):
+    """null ensembles of a chunk of VATs, written into their network_metrics.csv"""
+
+    # one task per batch of null networks of one VAT and threshold
+    graphs = {}; tasks = []
+    for sub, vatdir in vats:
+        M_bin, _ = threshold_sweep(load_matrix(sub, vatdir, imgdir), thresh_list)
+        graphs[(sub, vatdir)] = M_bin[0]
+        for t, thr in enumerate(thresh_list):
+            seeds = null_seeds(seed, sub, vatdir, thr, n_null)
+            for start in range(0, n_null, batch):
+                tasks.append(((sub, vatdir), t, start, seeds[start:start+batch]))
+
+    null_bc = {key: np.zeros((n_null,) + G.shape[:2]) for key, G in graphs.items()}
+
+    futures = [pool.submit(null_batch, graphs[key][t], seeds, itr) for key, t, _, seeds in tasks]
+    for (key, t, start, seeds), future in zip(tasks, futures):
+        null_bc[key][start:start+len(seeds), t] = future.result()
+
+    for sub, vatdir in vats:
+        key = (sub, vatdir)
+        outfile = os.path.join(stats_dir(imgdir, sub, vatdir), "network_metrics.csv")
+        shape = graphs[key].shape[:2]
+        df = read_metrics(outfile, thresh_list, shape[1])
+        if df is None:
+            calc_metrics(sub, vatdir, l_thr, u_thr, imgdir)
+            df = read_metrics(outfile, thresh_list, shape[1])
+
+        bc_norm, bc_z = normalize(df['bc'].to_numpy(dtype=float).reshape(shape), null_bc[key])
+        df = df.drop(columns=['deg_norm', 'deg_z'], errors='ignore')  # written by earlier versions
+        df['bc_norm'] = bc_norm.ravel()
+        df['bc_z'] = bc_z.ravel()
+
+        tmpfile = outfile + ".tmp"
+        df.to_csv(tmpfile, index=False)
+        os.replace(tmpfile, outfile)
+        print(vatdir)
+
+def run_nulls(vats, imgdir=IMGDIR, n_null=100, itr=5, seed=0, batch=25, workers=None,
+              l_thr=60, u_thr=80, vat_chunk=16):
+    """
+    Add null-normalized columns to network_metrics.csv of every (sub, vatdir).
+    VATs are handled vat_chunk at a time to bound the memory of the ensembles;
+    missing network_metrics.csv files are calculated first.
+    """
+    thresh_list = [i for i in range(l_thr, u_thr+1)]
+    print(f"{len(vats)} VATs, {len(vats) * len(thresh_list) * n_null} null networks")
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for start in range(0, len(vats), vat_chunk):
+            _null_chunk(pool, vats[start:start+vat_chunk], imgdir, thresh_list,
+                        n_null, itr, seed, batch, l_thr, u_thr)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="degree-preserving null models for network_metrics.csv")
+    parser.add_argument("sub", nargs="?", help="subject (single VAT mode)")
+    parser.add_argument("vatdir", nargs="?", help="VAT directory containing probtrackx output (single VAT mode)")
+    parser.add_argument("--imgdir", default=IMGDIR)
+    parser.add_argument("--cohort", action="store_true", help="process every VAT found under --imgdir")
+    parser.add_argument("--n-null", type=int, default=100, help="null networks per VAT and threshold")
+    parser.add_argument("--itr", type=int, default=5, help="rewirings per edge")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--batch", type=int, default=25, help="null networks per worker task")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--l-thr", type=int, default=60)
+    parser.add_argument("--u-thr", type=int, default=80)
+    args = parser.parse_args()
+
+    if args.cohort:
+        vats = find_vats(args.imgdir)
+    elif args.sub and args.vatdir:
+        vats = [(args.sub, args.vatdir)]
+    else:
+        parser.error("give sub and vatdir, or --cohort")
+
+    run_nulls(vats, args.imgdir, args.n_null, args.itr, args.seed, args.batch, args.workers, args.l_thr, args.u_thr)
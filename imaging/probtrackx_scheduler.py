@@ -0,0 +1,333 @@
+#!/usr/bin/env python3
+"""
+Concurrent probtrackx scheduler
+
+Builds one job per (subject, VAT) for every *contact*bin.nii.gz below
+<subdir>/VAT, as run_probtrackx.sh does, but every job gets its own seed
+list (<subdir>/seeds/seeds_<vat_folder>.txt: seeds.txt plus the VAT), so any
+number of jobs of one or several subjects can run at the same time.
+
+- jobs whose fdt_network_matrix and waytotal are complete (one row/entry per
+  seed) are skipped, so an interrupted queue resumes where it stopped
+- at most --jobs jobs run at once, failed jobs are retried --retries times
+- every finished job is appended to a JSON-lines manifest, progress and a
+  final throughput report (jobs/hour, mean job time) are printed
+- jobs with the same VAT voxel set, seeds, masks and parameters as an
+  already tracked job get its outputs linked instead (tracking_cache.py)
+- jobs of subjects without seeds/seeds.txt (extract_seeds.sh not run) are
+  recorded as failed, the other jobs still run
+- failed jobs are listed at the end, but the exit status is 0 as with the
+  old run_probtrackx.sh loop, so MASTER.sh (set -e) carries on; with
+  --fail-on-error any failed job gives exit status 1
+
+Backends:
+    gpu     probtrackx2_gpu (as run_probtrackx.sh)
+    cpu     probtrackx2
+    mock    writes synthetic fdt_network_matrix/waytotal files, to test the
+            scheduler without FSL or a GPU
+
+Usage:
+    probtrackx_scheduler.py <subdir> [<subdir> ...] [--nsamples 30000 --steplength 0.75 --fibthresh 0.001]
+                            [--backend gpu|cpu|mock] [--jobs 4] [--retries 2]
+                            [--cache logs/tracking_cache.jsonl | --no-cache] [--cache-mode link|copy]
+                            [--fail-on-error]
+"""
+
+import os
+import sys
+import json
+import time
+import zlib
+import fnmatch
+import argparse
+import subprocess
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import numpy as np
+import tracking_cache
+
+Job = namedtuple('Job', 'sub subdir vat_file vat_folder outdir seeds_file')
+
+def find_jobs(subdirs):
+    """one job per *contact*bin.nii.gz below <subdir>/VAT, sorted by subject and VAT folder"""
+    jobs = []
+    for subdir in subdirs:
+        subdir = os.path.normpath(subdir)
+        for root, _, files in os.walk(os.path.join(subdir, "VAT")):
+            for f in sorted(fnmatch.filter(files, "*contact*bin.nii.gz")):
+                vat_folder = os.path.basename(root)
+                jobs.append(Job(sub=os.path.basename(subdir), subdir=subdir,
+                                vat_file=os.path.join(root, f), vat_folder=vat_folder,
+                                outdir=os.path.join(subdir, "diffusion", "stats", vat_folder),
+                                seeds_file=os.path.join(subdir, "seeds", f"seeds_{vat_folder}.txt")))
+    return sorted(jobs, key=lambda j: (j.sub, j.vat_folder))
+
+def seed_list(subdir):
+    """the subject's seed list written by extract_seeds.sh"""
+    return os.path.join(subdir, "seeds", "seeds.txt")
+
+def n_seeds(subdir):
+    """number of seeds in <subdir>/seeds/seeds.txt, without the VAT"""
+    with open(seed_list(subdir)) as f:
+        return sum(1 for line in f if line.strip())
+
+def write_seed_list(job):
+    """private seed list of a job: the subject's seeds followed by the VAT"""
+    with open(seed_list(job.subdir)) as f:
+        seeds = [line.strip() for line in f if line.strip()]
+    with open(job.seeds_file, "w") as f:
+        f.write("\n".join(seeds + [job.vat_file]) + "\n")
+
+def is_complete(job):
+    """True if the job's network matrix and waytotal exist and have one row/entry per seed and VAT"""
+    n = n_seeds(job.subdir) + 1
+    try:
+        m = np.loadtxt(os.path.join(job.outdir, "fdt_network_matrix"), ndmin=2)
+        wt = np.loadtxt(os.path.join(job.outdir, "waytotal"), ndmin=1)
+    except (OSError, ValueError):
+        return False
+    return m.shape == (n, n) and wt.shape == (n,)
+
+def probtrackx_command(job, nsamples, steplength, fibthresh, binary):
+    """probtrackx call of run_probtrackx.sh for one job"""
+    return [binary,
+            "-s", os.path.join(job.subdir, "diffusion.bedpostX", "merged"),
+            "-m", os.path.join(job.subdir, "diffusion", "nodif_brain_mask.nii.gz"),
+            "-x", job.seeds_file,
+            f"--dir={job.outdir}",
+            "--network",
+            "--opd",
+            "--ompl",
+            f"--waypoints={os.path.join(job.subdir, 'diffusion', 'pathmask.nii.gz')}",
+            f"--avoid={os.path.join(job.subdir, 'diffusion', 'avoid_mask.nii.gz')}",
+            "--modeuler",
+            f"--nsamples={nsamples}",
+            f"--steplength={steplength}",
+            f"--fibthresh={fibthresh}",
+            "--loopcheck"]
+
+def run_probtrackx(job, params, binary):
+    """runs probtrackx for one job, its output goes to <outdir>/probtrackx.log"""
+    cmd = probtrackx_command(job, params['nsamples'], params['steplength'], params['fibthresh'], binary)
+    with open(os.path.join(job.outdir, "probtrackx.log"), "w") as log:
+        proc = subprocess.run(cmd, stdout=log, stderr=subprocess.STDOUT)
+    if proc.returncode != 0:
+        raise RuntimeError(f"{binary} exited with {proc.returncode}, see {job.outdir}/probtrackx.log")
+
+def run_mock(job, params, attempt=0):
+    """
+    Stand-in for probtrackx: after mock_seconds writes a random streamline
+    count matrix and waytotals of the job's size. With mock_fail_rate jobs
+    fail at random (reproducibly per job and attempt) to exercise retries.
+    """
+    rng = np.random.default_rng([zlib.crc32(job.vat_file.encode()), attempt])
+    time.sleep(params.get('mock_seconds', 0))
+    if rng.random() < params.get('mock_fail_rate', 0):
+        raise RuntimeError("mock failure")
+
+    with open(job.seeds_file) as f:
+        n = sum(1 for line in f if line.strip())
+    m = rng.poisson(50, (n, n)) * (rng.random((n, n)) < 0.7)
+    np.fill_diagonal(m, 0)
+    for name, data in (("fdt_network_matrix", m), ("waytotal", rng.integers(10000, 50000, n))):
+        tmpfile = os.path.join(job.outdir, name + ".tmp")
+        np.savetxt(tmpfile, data, fmt="%d", delimiter="  ")
+        os.replace(tmpfile, os.path.join(job.outdir, name))
+
+BACKENDS = {
+    'gpu': lambda job, params, attempt: run_probtrackx(job, params, "probtrackx2_gpu"),
+    'cpu': lambda job, params, attempt: run_probtrackx(job, params, "probtrackx2"),
+    'mock': run_mock,
+}
+
+def failed_record(job, backend, error, attempts=0, seconds=0.0):
+    return {'sub': job.sub, 'vat_folder': job.vat_folder, 'backend': backend, 'status': 'failed',
+            'attempts': attempts, 'seconds': seconds, 'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'error': error}
+
+def run_job(job, backend, params, retries=2):
+    """runs one job with retries, returns its manifest record"""
+    try:
+        os.makedirs(job.outdir, exist_ok=True)
+        tracking_cache.unshare_outputs(job.outdir)   # never write through links into another VAT's outputs
+        write_seed_list(job)
+    except OSError as e:
+        return failed_record(job, backend, f"{type(e).__name__}: {e}")
+
+    t0 = time.time()
+    error = None
+    attempt = 0
+    for attempt in range(retries + 1):
+        try:
+            BACKENDS[backend](job, params, attempt)
+            if not is_complete(job):
+                raise RuntimeError("incomplete fdt_network_matrix/waytotal")
+            error = None
+            break
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+
+    seconds = round(time.time() - t0, 3)
+    if error is not None:
+        return failed_record(job, backend, error, attempt + 1, seconds)
+    return {'sub': job.sub, 'vat_folder': job.vat_folder, 'backend': backend, 'status': 'done',
+            'attempts': attempt + 1, 'seconds': seconds, 'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+def run_queue(subdirs, backend='gpu', jobs=1, retries=2, manifest="logs/probtrackx_manifest.jsonl",
+              force=False, cache="logs/tracking_cache.jsonl", cache_mode="link", **params):
+    """
+    Runs every (subject, VAT) job of the given subject folders, at most jobs
+    at a time. Jobs with complete outputs are skipped unless force.
+
+    With a cache file, jobs whose key is in the cache get the cached outputs
+    linked instead of being tracked (not with force), and of several queued
+    jobs with the same key only the first is tracked. Complete outputs of
+    skipped jobs are added to the cache. Jobs of subjects without a seed
+    list fail without running. Returns the manifest records of the jobs
+    that ran, failed or were served from the cache.
+    """
+    queue = find_jobs(subdirs)
+    no_seeds = [job for job in queue if not os.path.isfile(seed_list(job.subdir))]
+    queue = [job for job in queue if os.path.isfile(seed_list(job.subdir))]
+    todo = [job for job in queue if force or not is_complete(job)]
+    todo_set = set(todo)
+    print(f"{len(queue) + len(no_seeds)} jobs, {len(queue) - len(todo)} complete, {len(todo)} to run "
+          f"with {jobs} at a time ({backend})"
+          + (f", {len(no_seeds)} without seeds/seeds.txt" if no_seeds else ""))
+    for subdir in subdirs:
+        os.makedirs(os.path.join(subdir, "diffusion", "stats"), exist_ok=True)
+    if os.path.dirname(manifest):
+        os.makedirs(os.path.dirname(manifest), exist_ok=True)
+
+    keys, cached = {}, {}
+    if cache:
+        keys = {job: tracking_cache.job_key(job, backend, params) for job in queue}
+        cached = tracking_cache.read_cache(cache)
+        for job in queue:
+            if job not in todo_set and keys[job] and keys[job] not in cached:
+                cached[keys[job]] = tracking_cache.add_entry(cache, keys[job], job.outdir, None, backend)
+
+    def serve(job):
+        """links the cached outputs of the job's key, None if there are none"""
+        entry = cached.get(keys.get(job))
+        if force or entry is None or entry['outdir'] == os.path.abspath(job.outdir):
+            return None
+        if not is_complete(job._replace(outdir=entry['outdir'])):
+            return None                              # cached outputs were removed or are being rewritten
+        tracking_cache.link_outputs(entry['outdir'], job.outdir, cache_mode)
+        write_seed_list(job)
+        return {'sub': job.sub, 'vat_folder': job.vat_folder, 'backend': backend, 'status': 'cached',
+                'attempts': 0, 'seconds': 0.0, 'source': entry['outdir'], 'saved_seconds': entry['seconds'],
+                'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+    t0 = time.time()
+    records = []
+    with open(manifest, "a") as log, ThreadPoolExecutor(max_workers=jobs) as pool:
+        def finish(rec):
+            records.append(rec)
+            log.write(json.dumps(rec) + "\n")
+            log.flush()
+
+            elapsed = time.time() - t0
+            rate = len(records) / elapsed
+            eta = (n_total - len(records)) / rate if rate > 0 else float('nan')
+            msg = {'failed': f"FAILED {rec.get('error')}", 'cached': f"linked from {rec.get('source')}"
+                   }.get(rec['status'], f"{rec['seconds']:.1f} s")
+            print(f"{len(records)}/{n_total} {rec['sub']} {rec['vat_folder']}: {msg} "
+                  f"({rate * 3600:.1f} jobs/h, ETA {eta / 60:.1f} min)")
+
+        def submit(job):
+            pending[pool.submit(run_job, job, backend, params, retries)] = job
+
+        n_total = len(todo) + len(no_seeds)
+        for job in no_seeds:
+            finish(failed_record(job, backend,
+                                 f"no seed list {seed_list(job.subdir)}, run extract_seeds.sh first"))
+
+        # jobs sharing a key wait for the first one of them instead of tracking too
+        pending, waiting = {}, {}
+        for job in todo:
+            key = keys.get(job)
+            rec = serve(job)
+            if rec is not None:
+                finish(rec)
+            elif key is not None and not force and key in waiting:
+                waiting[key].append(job)
+            else:
+                if key is not None and not force:
+                    waiting[key] = []
+                submit(job)
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                job = pending.pop(future)
+                rec = future.result()
+                finish(rec)
+
+                key = keys.get(job)
+                if key is None:
+                    continue
+                if rec['status'] == 'done':
+                    cached[key] = tracking_cache.add_entry(cache, key, job.outdir, rec['seconds'], backend)
+                    for other in waiting.pop(key, []):
+                        rec = serve(other)
+                        if rec is not None:
+                            finish(rec)
+                        else:
+                            submit(other)
+                elif waiting.get(key):
+                    submit(waiting[key].pop(0))      # track the next job of the key instead
+                else:
+                    waiting.pop(key, None)
+
+    report(records, time.time() - t0)
+    return records
+
+def report(records, elapsed):
+    """throughput summary of one queue run"""
+    done = [r for r in records if r['status'] == 'done']
+    failed = [r for r in records if r['status'] == 'failed']
+    cached = [r for r in records if r['status'] == 'cached']
+    retried = sum(1 for r in records if r['attempts'] > 1)
+    print(f"\n{len(done)} done, {len(failed)} failed, {retried} needed retries, {elapsed:.1f} s wall")
+    if cached:
+        known = [r['saved_seconds'] for r in cached if r['saved_seconds'] is not None]
+        print(f"{len(cached)} tracking runs served from the cache, {sum(known) / 3600:.2f} tracking hours saved"
+              + (f" ({len(cached) - len(known)} runs of unknown duration not counted)"
+                 if len(known) < len(cached) else ""))
+    if done:
+        seconds = np.array([r['seconds'] for r in done])
+        print(f"job time mean {seconds.mean():.1f} s, max {seconds.max():.1f} s; "
+              f"throughput {len(done) / elapsed * 3600:.1f} jobs/h, "
+              f"{seconds.sum() / elapsed:.2f} jobs running on average")
+    for r in failed:
+        print(f"FAILED {r['sub']} {r['vat_folder']}: {r['error']}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="run probtrackx for every (subject, VAT) with bounded concurrency")
+    parser.add_argument("subdirs", nargs="+", help="subject folders (containing VAT/, seeds/, diffusion/)")
+    parser.add_argument("--nsamples", type=int, default=30000)
+    parser.add_argument("--steplength", type=float, default=0.75)
+    parser.add_argument("--fibthresh", type=float, default=0.001)
+    parser.add_argument("--backend", choices=list(BACKENDS), default="gpu")
+    parser.add_argument("--jobs", type=int, default=1, help="jobs running at the same time")
+    parser.add_argument("--retries", type=int, default=2, help="retries of a failed job")
+    parser.add_argument("--manifest", default="logs/probtrackx_manifest.jsonl")
+    parser.add_argument("--force", action="store_true", help="rerun jobs with complete outputs")
+    parser.add_argument("--cache", default="logs/tracking_cache.jsonl", help="tracking cache file")
+    parser.add_argument("--no-cache", action="store_true", help="track every job, do not use or fill the cache")
+    parser.add_argument("--cache-mode", choices=["link", "copy"], default="link",
+                        help="hard link or copy cached outputs")
+    parser.add_argument("--mock-seconds", type=float, default=0.0, help="runtime of a mock job")
+    parser.add_argument("--mock-fail-rate", type=float, default=0.0, help="fraction of failing mock attempts")
+    parser.add_argument("--fail-on-error", action="store_true",
+                        help="exit with status 1 if any job failed (default: 0, failures are listed)")
+    args = parser.parse_args()
+
+    records = run_queue(args.subdirs, args.backend, args.jobs, args.retries, args.manifest, args.force,
+                        None if args.no_cache else args.cache, args.cache_mode,
+                        nsamples=args.nsamples, steplength=args.steplength, fibthresh=args.fibthresh,
+                        mock_seconds=args.mock_seconds, mock_fail_rate=args.mock_fail_rate)
+    failed = any(r['status'] == 'failed' for r in records)
+    sys.exit(1 if failed and args.fail_on_error else 0)
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+"""
+Per-stage timing and memory traces of network_metrics runs
+
+network_metrics.py --trace <file> records one JSON line per VAT and stage
+(loadtxt, waytotal, symmetricize, threshold, betweenness, weighted, write):
+    sub, vatdir, stage   which VAT and stage
+    wall_s               wall time of the stage; stages that run on a stack
+                         of VATs are split evenly, n_shared says over how many
+    maxrss_mb            peak resident set size of the process so far (ru_maxrss)
+    maxrss_delta_mb      how much the stage raised that peak, 0 for stages that
+                         stay below the peak of earlier ones
+    rss_mb               resident set size after the stage (Linux only)
+    peak_alloc_mb        with STAGE_TRACE_ALLOC=1 in the environment: peak memory
+                         allocated during the stage above what was allocated at
+                         its start (tracemalloc, includes numpy arrays). Off by
+                         default, tracing slows pandas-heavy stages (write) ~6x
+    pid, time
+Workers append their lines to the same file, one write per VAT batch.
+
+Usage:
+    stage_trace.py summarize <trace.jsonl> [--top 10]
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+import pandas as pd
+
+TRACE_ALLOC = os.environ.get('STAGE_TRACE_ALLOC') == '1'
+
+def _status_mb(field):
+    """a field of /proc/self/status (VmRSS) in MB, None if not available"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) / 2**10
+    except OSError:
+        pass
+    return None
+
+def maxrss_mb():
+    """peak RSS of the process so far (ru_maxrss is in bytes on macOS, kB elsewhere)"""
+    r = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return r / 2**20 if sys.platform == 'darwin' else r / 2**10
+
+def no_stage(name):
+    """stage timer that records nothing"""
+    return nullcontext()
+
+def stage_timer(records, vats):
+    """
+    Returns stage(name), a context manager that appends one record per
+    (sub, vatdir) in vats to records. With records None nothing is measured.
+    With TRACE_ALLOC tracemalloc is started (and left running) to measure allocations.
+    """
+    if records is None:
+        return no_stage
+    if TRACE_ALLOC and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+    @contextmanager
+    def stage(name):
+        if TRACE_ALLOC:
+            start = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+        maxrss_start = maxrss_mb()
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - t0
+            maxrss = maxrss_mb()
+            rec = {'stage': name, 'wall_s': wall / len(vats), 'n_shared': len(vats),
+                   'maxrss_mb': maxrss, 'maxrss_delta_mb': maxrss - maxrss_start,
+                   'rss_mb': _status_mb('VmRSS'), 'pid': os.getpid(),
+                   'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+            if TRACE_ALLOC:
+                rec['peak_alloc_mb'] = (tracemalloc.get_traced_memory()[1] - start) / 2**20
+            for sub, vatdir in vats:
+                records.append({'sub': sub, 'vatdir': vatdir, **rec})
+    return stage
+
+def write_trace(trace, records):
+    """appends records to the JSON-lines trace file in a single write"""
+    if trace and records:
+        with open(trace, 'a') as f:
+            f.write(''.join(json.dumps(r) + '\n' for r in records))
+
+def read_trace(trace):
+    """trace file as a DataFrame, skipping lines cut off by an interrupted run"""
+    records = []
+    with open(trace) as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                continue
+    return pd.DataFrame(records)
+
+def summarize(trace, top=10):
+    """
+    Cohort summary of a trace: per stage the total and share of the wall
+    time, p50/p95/max per VAT and p50/p95/max of the memory measure (peak
+    allocation if traced, else the rise of the peak RSS), and the top slowest
+    VATs with their slowest stage. Returns (stages, slowest).
+    """
+    df = read_trace(trace)
+    if df.empty:
+        raise ValueError(f"no records in {trace}")
+    memory = next(c for c in ('peak_alloc_mb', 'maxrss_delta_mb', 'peak_rss_mb') if c in df)
+    prefix = {'peak_alloc_mb': 'alloc', 'maxrss_delta_mb': 'maxrss_delta', 'peak_rss_mb': 'rss'}[memory]
+
+    # a VAT that was run more than once only counts with its last run
+    df['run'] = df.groupby(['sub', 'vatdir', 'stage']).cumcount(ascending=False)
+    df = df[df['run'] == 0]
+
+    g = df.groupby('stage')
+    stages = pd.DataFrame({'n_vats': g['wall_s'].size(),
+                           'total_s': g['wall_s'].sum(),
+                           'wall_p50_s': g['wall_s'].quantile(0.5),
+                           'wall_p95_s': g['wall_s'].quantile(0.95),
+                           'wall_max_s': g['wall_s'].max(),
+                           f'{prefix}_p50_mb': g[memory].quantile(0.5),
+                           f'{prefix}_p95_mb': g[memory].quantile(0.95),
+                           f'{prefix}_max_mb': g[memory].max()})
+    stages.insert(2, 'share', stages['total_s'] / stages['total_s'].sum())
+    stages = stages.sort_values('total_s', ascending=False)
+
+    per_vat = df.pivot_table(index=['sub', 'vatdir'], columns='stage', values='wall_s', aggfunc='sum')
+    slowest = pd.DataFrame({'total_s': per_vat.sum(axis=1),
+                            'slowest_stage': per_vat.idxmax(axis=1),
+                            'slowest_stage_s': per_vat.max(axis=1),
+                            memory: df.groupby(['sub', 'vatdir'])[memory].max()})
+    slowest = slowest.sort_values('total_s', ascending=False).head(top).reset_index()
+
+    return stages, slowest
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="summarize network_metrics stage traces")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("summarize", help="hot stages and slowest VATs of a cohort trace")
+    p.add_argument("trace", help="JSON-lines trace written by network_metrics.py --trace")
+    p.add_argument("--top", type=int, default=10, help="number of slowest VATs to list")
+    args = parser.parse_args()
+
+    stages, slowest = summarize(args.trace, args.top)
+    with pd.option_context('display.width', 200, 'display.max_columns', None, 'display.precision', 4):
+        print(f"{stages['n_vats'].max()} VATs, {stages['total_s'].sum():.1f} s in traced stages\n")
+        print(stages.to_string())
+        print(f"\n{len(slowest)} slowest VATs\n")
+        print(slowest.to_string(index=False))
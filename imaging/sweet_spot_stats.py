@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+"""
+Voxelwise sweet-spot statistics with permutation inference
+
+For every voxel covered by at least --min-vtas VTAs of a hemisphere, a
+two-sample t-statistic compares the tremor improvement (the z-score
+weights of create_effectiveness_maps.sh, -(RMS - mean) / sd per subject)
+of the VTAs covering the voxel with that of all other VTAs. Significance
+comes from permutations of the improvement scores: uncorrected p-values
+per voxel and FWE-corrected p-values from the maximum |t| over all voxels
+of each permutation.
+
+Only the covered voxels are held, as a sparse voxel x VTA incidence
+matrix. Every t-statistic needs only the in-group sum and sum of squares
+of the scores (the totals do not change under permutation), so a chunk of
+voxels is evaluated for a chunk of permutations with two sparse-dense
+products. The incidence matrix is handed to each worker process once,
+the tasks are voxel ranges. Permutations are not shipped: every block of
+perm_block permutations is drawn from its own seed (seed, block), so all
+workers regenerate the same permutations, which the max-statistic needs.
+
+Outputs (in the grid of --ref-mni, as the effectiveness maps) in output_dir:
+sweet_spot_{t,p,pfwe,n}_{left,right}.nii.gz  t-statistic (0 outside the
+tested voxels), uncorrected and FWE-corrected two-sided p (1 outside) and
+number of covering VTAs
+
+Usage:
+    sweet_spot_stats.py --vta-root DIR --tremor-left CSV --tremor-right CSV --ref-mni MNI_1.nii
+                        --output-dir DIR [--min-vtas 5] [--n-perm 5000] [--workers N]
+    sweet_spot_stats.py --validate
+"""
+
+import os
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+import nibabel as nib
+from effectiveness_maps import vta_table, load_vtas, save_map
+
+def coverage_matrix(vtas, min_vtas=5):
+    """
+    voxel x VTA binary CSR incidence of the voxels covered by at least
+    min_vtas VTAs and left uncovered by at least 2, with their flat indices
+    """
+    if len(vtas) == 0:
+        raise ValueError("no VTAs with a tremor score, nothing to test")
+    cols = [np.full(len(v[0]), j) for j, v in enumerate(vtas)]
+    flat = np.concatenate([v[0][v[1] > 0] for v in vtas])
+    cols = np.concatenate([c[v[1] > 0] for c, v in zip(cols, vtas)])
+    voxels, rows, counts = np.unique(flat, return_inverse=True, return_counts=True)
+    X = sp.csr_matrix((np.ones(len(flat)), (rows.ravel(), cols)), shape=(len(voxels), len(vtas)))
+
+    keep = (counts >= min_vtas) & (len(vtas) - counts >= 2)
+    return X[keep], voxels[keep]
+
+def t_statistics(S1, Q1, n1, n, T, Q):
+    """
+    pooled two-sample t of the n1 scores in a group (sum S1, sum of squares
+    Q1) against the rest, from the totals T and Q of all n scores
+    """
+    n1 = n1[:, np.newaxis]
+    n0 = n - n1
+    S0 = T - S1
+    ss = (Q1 - S1 ** 2 / n1) + ((Q - Q1) - S0 ** 2 / n0)
+    se = np.sqrt(np.maximum(ss, 0) / (n - 2) * (1 / n1 + 1 / n0))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = np.where(se > 0, (S1 / n1 - S0 / n0) / se, 0)
+    return t
+
+def permutation_block(n, count, seed=0, block=0, groups=None):
+    """
+    count x n index matrix of permutation block number block, drawn from
+    its own seed; with groups, scores only move within a group
+    """
+    rng = np.random.default_rng(np.random.SeedSequence([seed, block]))
+    perms = np.tile(np.arange(n), (count, 1))
+    if groups is None:
+        return rng.permuted(perms, axis=1)
+    for rows in pd.Series(groups).groupby(groups).indices.values():
+        perms[:, rows] = rng.permuted(perms[:, rows], axis=1)
+    return perms
+
+def permutations(n, n_perm, seed=0, groups=None, perm_block=256):
+    """all n_perm x n permutations of sweet_spot_stats, as the workers draw them block by block"""
+    blocks = [permutation_block(n, min(perm_block, n_perm - p0), seed, b, groups)
+              for b, p0 in enumerate(range(0, n_perm, perm_block))]
+    return np.concatenate(blocks) if blocks else np.zeros((0, n), dtype=int)
+
+_shared = {}
+
+def _init(X, y, n_perm, seed, groups, perm_block):
+    """stores the incidence matrix, scores and permutation settings once per worker"""
+    _shared.update(X=X, y=y, n_perm=n_perm, seed=seed, groups=groups, perm_block=perm_block)
+
+def _voxel_chunk(bounds):
+    """observed t, exceedance counts and per-permutation max |t| of a range of voxels"""
+    start, stop = bounds
+    X, y = _shared['X'][start:stop], _shared['y']
+    n_perm, perm_block = _shared['n_perm'], _shared['perm_block']
+    n = len(y)
+    n1 = np.asarray(X.sum(axis=1)).ravel()
+    T, Q = y.sum(), (y ** 2).sum()
+
+    t_obs = t_statistics(X @ y[:, np.newaxis], X @ (y ** 2)[:, np.newaxis], n1, n, T, Q)[:, 0]
+    exceed = np.zeros(stop - start, dtype=np.int64)
+    max_t = np.zeros(n_perm)
+    for b, p0 in enumerate(range(0, n_perm, perm_block)):
+        perms = permutation_block(n, min(perm_block, n_perm - p0), _shared['seed'], b, _shared['groups'])
+        Y = y[perms.T]                                          # n x block permuted scores
+        t = np.abs(t_statistics(X @ Y, X @ Y ** 2, n1, n, T, Q))
+        exceed += np.sum(t >= np.abs(t_obs)[:, np.newaxis] - 1e-12, axis=1)
+        max_t[p0:p0 + t.shape[1]] = t.max(axis=0)
+    return t_obs, exceed, max_t
+
+def sweet_spot_stats(X, y, n_perm=5000, seed=0, groups=None, chunk=2000, perm_block=256, workers=1):
+    """
+    t-statistic, uncorrected and FWE-corrected permutation p-values of
+    every voxel (row) of the incidence matrix X for the scores y
+    """
+    bounds = [(s, min(s + chunk, X.shape[0])) for s in range(0, X.shape[0], chunk)]
+    if not bounds:                       # no voxel reached min_vtas
+        return np.zeros(0), np.ones(0), np.ones(0)
+    initargs = (X, y, n_perm, seed, groups, perm_block)
+    if workers == 1:
+        _init(*initargs)
+        results = list(map(_voxel_chunk, bounds))
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init, initargs=initargs) as pool:
+            results = list(pool.map(_voxel_chunk, bounds))
+
+    t = np.concatenate([r[0] for r in results])
+    p = (1 + np.concatenate([r[1] for r in results])) / (1 + n_perm)
+    max_t = np.max([r[2] for r in results], axis=0)
+    p_fwe = (1 + np.sum(max_t[np.newaxis, :] >= np.abs(t)[:, np.newaxis] - 1e-12, axis=1)) / (1 + n_perm)
+    return t, p, p_fwe
+
+def process_side(vta_root, tremor_file, side, ref_img, output_dir, min_vtas=5, n_perm=5000, seed=0,
+                 within_subject=False, chunk=2000, workers=1):
+    hemi = 'left' if side == 'L' else 'right'
+    shape = ref_img.shape[:3]
+    tremor, _ = vta_table(tremor_file, side, vta_root)
+    valid = pd.to_numeric(tremor['rms'], errors='coerce').notna().to_numpy()
+    vtas = load_vtas(list(tremor['vta_file']), shape, workers)
+    rows = [i for i, v in enumerate(vtas) if v is not None and valid[i]]
+    print(f"{hemi}: {len(rows)} of {len(tremor)} VTAs with a tremor score")
+
+    # a side without tested voxels still gets its maps (t 0, p 1), so the other side runs
+    if rows:
+        X, voxels = coverage_matrix([vtas[i] for i in rows], min_vtas)
+    else:
+        X, voxels = sp.csr_matrix((0, 0)), np.zeros(0, dtype=np.int64)
+    y = tremor['weight'].to_numpy(dtype=float)[rows]
+    groups = tremor['subnum'].to_numpy()[rows] if within_subject else None
+    print(f"{hemi}: {len(voxels)} voxels covered by at least {min_vtas} VTAs")
+    if len(voxels) == 0:
+        print(f"warning: no voxel of the {hemi} side can be tested, its maps are empty")
+    t, p, p_fwe = sweet_spot_stats(X, y, n_perm, seed, groups, chunk, workers=workers)
+
+    size = int(np.prod(shape))
+    for name, values, fill in [('t', t, 0), ('p', p, 1), ('pfwe', p_fwe, 1),
+                               ('n', np.asarray(X.sum(axis=1)).ravel(), 0)]:
+        data = np.full(size, fill, dtype=np.float32)
+        data[voxels] = values
+        save_map(data, ref_img, os.path.join(output_dir, f"sweet_spot_{name}_{hemi}.nii.gz"))
+    print(f"{hemi}: {np.sum(p_fwe < 0.05)} voxels with FWE-corrected p < 0.05")
+
+def validate(n=30, n_voxels=60, n_perm=99, seed=0):
+    """
+    checks on random VTAs: t and p against scipy's pooled t-test over the
+    same permutations, the same results for 1 and 2 workers, and empty
+    results when no voxel reaches min_vtas
+    """
+    from scipy import stats
+
+    rng = np.random.default_rng(seed)
+    vtas = [(np.sort(rng.choice(n_voxels, n_voxels // 3, replace=False)), np.ones(n_voxels // 3))
+            for _ in range(n)]
+    y = rng.normal(size=n)
+    X, voxels = coverage_matrix(vtas, 5)
+    t, p, p_fwe = sweet_spot_stats(X, y, n_perm, seed, chunk=64, perm_block=50)
+    same = all(np.array_equal(a, b) for a, b in
+               zip((t, p, p_fwe), sweet_spot_stats(X, y, n_perm, seed, chunk=100, perm_block=50, workers=2)))
+
+    covered = X.toarray() > 0
+    def t_ref(scores):
+        return np.array([stats.ttest_ind(scores[c], scores[~c]).statistic for c in covered])
+    null = np.abs([t_ref(y[perm]) for perm in permutations(n, n_perm, seed, perm_block=50)])
+    p_ref = (1 + np.sum(null >= np.abs(t) - 1e-12, axis=0)) / (1 + n_perm)
+    p_fwe_ref = (1 + np.sum(null.max(axis=1)[:, np.newaxis] >= np.abs(t) - 1e-12, axis=0)) / (1 + n_perm)
+    exact = np.allclose(t, t_ref(y)) and np.array_equal(p, p_ref) and np.array_equal(p_fwe, p_fwe_ref)
+
+    X_empty, _ = coverage_matrix(vtas, n + 1)
+    empty = all(len(r) == 0 for r in sweet_spot_stats(X_empty, y, n_perm, seed))
+
+    print(f"{len(voxels)} voxels, {n} VTAs: matches scipy: {exact}, same with 2 workers: {same}, "
+          f"no testable voxel: {empty}")
+    return exact and same and empty
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="voxelwise sweet-spot t-statistics with permutation inference")
+    parser.add_argument("--vta-root", default="path/to/leaddbs/derivatives")
+    parser.add_argument("--output-dir", default="path/to/output")
+    parser.add_argument("--tremor-left", default="path/to/tremor_leftSTN_final.csv")
+    parser.add_argument("--tremor-right", default="path/to/tremor_rightSTN_final.csv")
+    parser.add_argument("--ref-mni", default="path/to/MNI_1.nii")
+    parser.add_argument("--min-vtas", type=int, default=5, help="minimum number of VTAs covering a tested voxel")
+    parser.add_argument("--n-perm", type=int, default=5000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--within-subject", action="store_true", help="permute scores within subjects only")
+    parser.add_argument("--chunk", type=int, default=2000, help="voxels per task")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--validate", action="store_true", help="check the statistics on random VTAs and exit")
+    args = parser.parse_args()
+
+    if args.validate:
+        print("OK" if validate() else "MISMATCH")
+        raise SystemExit
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    ref_img = nib.load(args.ref_mni)
+    for side, tremor_file in [('L', args.tremor_left), ('R', args.tremor_right)]:
+        process_side(args.vta_root, tremor_file, side, ref_img, args.output_dir, args.min_vtas, args.n_perm,
+                     args.seed, args.within_subject, args.chunk, args.workers)
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+"""
+Content-addressed cache of probtrackx outputs
+
+Many VATs of one subject (different amplitudes or contacts) are identical
+once binarized and resampled into diffusion space, and tracking them again
+gives the same result up to sampling noise. A tracking job is keyed by a
+SHA-256 hash of
+    - the VAT voxel set (non-zero voxels, grid shape and affine)
+    - the seed masks of the seed list (file contents)
+    - brain, waypoint and avoid masks (file contents)
+    - the bedpostX samples (path, size and mtime, they are too large to read)
+    - nsamples, steplength, fibthresh and the backend
+The cache is a JSON-lines file of key -> output folder and tracking time.
+A job whose key is known gets the outputs of that folder hard linked (or
+copied) into its own stats/<vatdir> folder instead of being tracked.
+
+Usage:
+    tracking_cache.py report [--cache logs/tracking_cache.jsonl] [--manifest logs/probtrackx_manifest.jsonl]
+"""
+
+import os
+import json
+import glob
+import time
+import shutil
+import fnmatch
+import hashlib
+import argparse
+import numpy as np
+import nibabel as nib
+
+# files of an output folder that are not probtrackx outputs and never shared
+DERIVED = ["network_metrics.csv", "*.npy", "*.tmp"]
+
+_digests = {}
+
+def file_digest(path):
+    """SHA-256 of a file's content, memoized by path, size and mtime"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return f"missing:{path}"
+    memo = (os.path.realpath(path), st.st_size, st.st_mtime_ns)
+    if memo not in _digests:
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                h.update(block)
+        _digests[memo] = h.hexdigest()
+    return _digests[memo]
+
+def file_identity(path):
+    """path, size and mtime of a file too large to hash"""
+    try:
+        st = os.stat(path)
+        return f"{os.path.realpath(path)}:{st.st_size}:{st.st_mtime_ns}"
+    except OSError:
+        return f"missing:{path}"
+
+def vat_digest(vat_file):
+    """SHA-256 of the binarized voxel set of a VAT with its grid"""
+    img = nib.load(vat_file)
+    data = np.asanyarray(img.dataobj)
+    h = hashlib.sha256()
+    h.update(np.asarray(data.shape, dtype=np.int64).tobytes())
+    h.update(np.round(img.affine, 4).astype(np.float64).tobytes())
+    h.update(np.flatnonzero(data > 0).astype(np.int64).tobytes())
+    return h.hexdigest()
+
+def job_key(job, backend, params):
+    """cache key of a scheduler job (probtrackx_scheduler.Job), None if its VAT or seed list is unreadable"""
+    try:
+        vat = vat_digest(job.vat_file)
+    except Exception as e:
+        print(f"warning: not caching {job.sub} {job.vat_folder}, cannot read VAT ({type(e).__name__}: {e})")
+        return None
+
+    try:
+        with open(os.path.join(job.subdir, "seeds", "seeds.txt")) as f:
+            seeds = [line.strip() for line in f if line.strip()]
+    except OSError as e:
+        print(f"warning: not caching {job.sub} {job.vat_folder}, cannot read its seed list ({e})")
+        return None
+    diffusion = os.path.join(job.subdir, "diffusion")
+    parts = {
+        'vat': vat,
+        'seeds': [file_digest(s) for s in seeds],
+        'masks': [file_digest(os.path.join(diffusion, f))
+                  for f in ("nodif_brain_mask.nii.gz", "pathmask.nii.gz", "avoid_mask.nii.gz")],
+        'samples': [file_identity(f) for f in sorted(glob.glob(os.path.join(job.subdir, "diffusion.bedpostX", "merged*")))],
+        'params': [params.get('nsamples'), params.get('steplength'), params.get('fibthresh'), backend],
+    }
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode()).hexdigest()
+
+def read_cache(cache):
+    """key -> last cache entry from the JSON-lines cache file"""
+    entries = {}
+    if os.path.isfile(cache):
+        with open(cache) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue                         # line cut off by an interrupted run
+                entries[entry['key']] = entry
+    return entries
+
+def add_entry(cache, key, outdir, seconds, backend):
+    """records the outputs of key, seconds is the tracking time (None if not known)"""
+    entry = {'key': key, 'outdir': os.path.abspath(outdir), 'seconds': seconds, 'backend': backend,
+             'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+    if os.path.dirname(cache):
+        os.makedirs(os.path.dirname(cache), exist_ok=True)
+    with open(cache, "a") as f:
+        f.write(json.dumps(entry) + "\n")
+    return entry
+
+def output_files(outdir):
+    """probtrackx outputs of a folder, without files derived from them"""
+    return [f for f in sorted(os.listdir(outdir))
+            if os.path.isfile(os.path.join(outdir, f)) and not any(fnmatch.fnmatch(f, p) for p in DERIVED)]
+
+def link_outputs(source, outdir, mode="link"):
+    """hard links (mode 'link', copies across file systems) or copies the outputs of source into outdir"""
+    os.makedirs(outdir, exist_ok=True)
+    for f in output_files(source):
+        src, dst = os.path.join(source, f), os.path.join(outdir, f)
+        if os.path.lexists(dst):
+            os.unlink(dst)
+        if mode == "link":
+            try:
+                os.link(src, dst)
+                continue
+            except OSError:
+                pass
+        shutil.copy2(src, dst)
+
+def unshare_outputs(outdir):
+    """removes hard-linked outputs of a folder before it is tracked again, so the source is not overwritten"""
+    if os.path.isdir(outdir):
+        for f in output_files(outdir):
+            path = os.path.join(outdir, f)
+            if os.stat(path).st_nlink > 1:
+                os.unlink(path)
+
+def savings(manifest):
+    """tracking runs and hours served from the cache, from a scheduler manifest"""
+    runs, seconds, unknown = 0, 0.0, 0
+    if os.path.isfile(manifest):
+        with open(manifest) as f:
+            for line in f:
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    continue
+                if rec.get('status') == 'cached':
+                    runs += 1
+                    if rec.get('saved_seconds') is None:
+                        unknown += 1
+                    else:
+                        seconds += rec['saved_seconds']
+    return runs, seconds / 3600, unknown
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="tracking cache statistics")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("report", help="entries of the cache and tracking saved so far")
+    p.add_argument("--cache", default="logs/tracking_cache.jsonl")
+    p.add_argument("--manifest", default="logs/probtrackx_manifest.jsonl")
+    args = parser.parse_args()
+
+    entries = read_cache(args.cache)
+    runs, hours, unknown = savings(args.manifest)
+    print(f"{len(entries)} cached tracking results")
+    print(f"{runs} tracking runs served from the cache, {hours:.2f} tracking hours saved"
+          + (f" ({unknown} runs of unknown duration not counted)" if unknown else ""))
@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+"""
+Sparse VTA voxel store
+
+A VTA covers a few hundred voxels of a ~7 million voxel MNI volume. This
+indexer reads every binary lead-dbs VTA once and stores it as int32 flat
+voxel indices (C order) plus bounding box, grid shape and affine, keyed by
+subject, side, contact and amplitude. Centre of mass, volume (fslstats -V)
+and masked means of other maps (fslstats -k ... -m) are then served from
+the index without reading the gzip NIfTIs again. A map must be on the grid
+(shape and affine) stored for the VTA, masked_mean raises otherwise.
+
+Index directory layout:
+    index.csv    one row per VTA (key, source file and mtime, offset/count
+                 into voxels.npy, bounding box, grid shape, voxel volume)
+    voxels.npy   int32 flat voxel indices of all VTAs, concatenated
+    affines.npy  (n_vtas x 4 x 4) voxel to MNI affines
+
+Usage:
+    vta_index.py build   --vta-root DIR --index DIR [--suffix _MNI_1mm] [--workers N]
+                         (vta_size.sh reads the *_MNI.nii.gz VTAs: build a second index with --suffix _MNI)
+    vta_index.py volumes --index DIR --tremor ordered_tremor.csv --output-dir DIR
+    vta_index.py miv     --index DIR --tremor tremor_leftSTN_final.csv --map effectiveness_map_left.nii.gz --side L --output miv_leftSTN.csv
+"""
+
+import os
+import re
+import glob
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import nibabel as nib
+
+VTA_GLOB = os.path.join("sub-subject*", "stimulations", "MNI152NLin2009bAsym", "*_contact-*_amp-*mA",
+                        "sub-subject*_sim-binary_model-simbio_hemi-*{suffix}.nii.gz")
+VTA_KEY = re.compile(r"sub-subject(?P<subject>[^/]+)/stimulations/MNI152NLin2009bAsym/"
+                     r"(?P<side>[LR])_contact-(?P<contact>\d+)_amp-(?P<amp>[0-9.]+)mA/")
+
+def read_vta(vta_file):
+    """flat voxel indices, bounding box, shape and affine of the non-zero voxels of a NIfTI"""
+    img = nib.load(vta_file)
+    shape = img.shape[:3]
+    idx = np.flatnonzero(np.asanyarray(img.dataobj).reshape(-1)).astype(np.int32)
+
+    bbox = np.zeros(6, dtype=int)
+    if len(idx):
+        ijk = np.unravel_index(idx, shape)
+        bbox = np.array([f(a) for a in ijk for f in (np.min, np.max)])
+    return idx, bbox, shape, img.affine
+
+def build_index(vta_root, index_dir, suffix="_MNI_1mm", workers=1):
+    """
+    Index all VTAs under a lead-dbs derivatives folder. VTAs already in an
+    existing index with an unchanged mtime are copied over instead of re-read.
+    """
+    files = sorted(glob.glob(os.path.join(vta_root, VTA_GLOB.format(suffix=suffix))))
+
+    old = VTAIndex(index_dir) if os.path.isfile(os.path.join(index_dir, "index.csv")) else None
+    old_rows = {} if old is None else {f: i for i, f in enumerate(old.table['file'])}
+
+    rows = []; todo = []
+    for f in files:
+        key = VTA_KEY.search(f.replace(os.sep, "/"))
+        if key is None:
+            continue
+        row = {'subject': key['subject'], 'side': key['side'], 'contact': int(key['contact']),
+               'amp': key['amp'], 'file': f, 'mtime': os.stat(f).st_mtime_ns}
+        rows.append(row)
+        i = old_rows.get(f)
+        if i is None or old.table['mtime'].iloc[i] != row['mtime']:
+            todo.append(f)
+
+    print(f"{len(rows)} VTAs, {len(todo)} to read")
+    if workers == 1:
+        read = dict(zip(todo, map(read_vta, todo)))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            read = dict(zip(todo, pool.map(read_vta, todo, chunksize=16)))
+
+    voxels = []; affines = []; start = 0
+    for row in rows:
+        f = row['file']
+        if f in read:
+            idx, bbox, shape, affine = read[f]
+        else:
+            i = old_rows[f]
+            idx = old.voxels(i)
+            bbox = old.table.iloc[i][['i0', 'i1', 'j0', 'j1', 'k0', 'k1']].to_numpy()
+            shape = tuple(old.table.iloc[i][['nx', 'ny', 'nz']])
+            affine = old.affines[i]
+
+        row.update(start=start, count=len(idx),
+                   i0=bbox[0], i1=bbox[1], j0=bbox[2], j1=bbox[3], k0=bbox[4], k1=bbox[5],
+                   nx=shape[0], ny=shape[1], nz=shape[2],
+                   voxvol=abs(np.linalg.det(affine[:3, :3])))
+        voxels.append(np.asarray(idx, dtype=np.int32))
+        affines.append(affine)
+        start += len(idx)
+
+    os.makedirs(index_dir, exist_ok=True)
+    voxels = np.concatenate(voxels) if voxels else np.zeros(0, dtype=np.int32)
+    affines = np.array(affines) if affines else np.zeros((0, 4, 4))
+
+    # write next to the old index and rename, the old voxels.npy may still be memory mapped
+    for name, arr in [("voxels.npy", voxels), ("affines.npy", affines)]:
+        np.save(os.path.join(index_dir, "tmp_" + name), arr)
+        os.replace(os.path.join(index_dir, "tmp_" + name), os.path.join(index_dir, name))
+    pd.DataFrame(rows).to_csv(os.path.join(index_dir, "index.csv"), index=False)
+
+class VTAIndex:
+    """read access to an index written by build_index"""
+
+    def __init__(self, index_dir):
+        self.table = pd.read_csv(os.path.join(index_dir, "index.csv"), dtype={'subject': str, 'amp': str})
+        self._voxels = np.load(os.path.join(index_dir, "voxels.npy"), mmap_mode='r')
+        self.affines = np.load(os.path.join(index_dir, "affines.npy"))
+        self._keys = {(s, d, c, a): i for i, (s, d, c, a) in
+                      enumerate(zip(self.table['subject'], self.table['side'], self.table['contact'], self.table['amp']))}
+
+    def __len__(self):
+        return len(self.table)
+
+    def lookup(self, subject, side, contact, amp):
+        """row of a VTA (lead-dbs contact numbering), None if not indexed"""
+        return self._keys.get((str(subject), side, int(contact), str(amp)))
+
+    def voxels(self, i):
+        """flat voxel indices of VTA i"""
+        row = self.table.iloc[i]
+        return np.asarray(self._voxels[row['start']:row['start'] + row['count']])
+
+    def shape(self, i):
+        return tuple(int(n) for n in self.table.iloc[i][['nx', 'ny', 'nz']])
+
+    def volume(self, i):
+        """voxel count and volume in mm^3, as fslstats -V"""
+        row = self.table.iloc[i]
+        return int(row['count']), row['count'] * row['voxvol']
+
+    def center_of_mass(self, rows):
+        """MNI centre of the union of the voxels of one or more VTAs on the same grid"""
+        rows = np.atleast_1d(rows)
+        if any(not np.allclose(self.affines[i], self.affines[rows[0]]) for i in rows):
+            raise ValueError("VTAs are on different grids")
+        idx = np.unique(np.concatenate([self.voxels(i) for i in rows]))
+        if len(idx) == 0:
+            return None
+        centre = np.array(np.unravel_index(idx, self.shape(rows[0]))).mean(axis=1)
+        return tuple(float(x) for x in nib.affines.apply_affine(self.affines[rows[0]], centre))
+
+    def check_grid(self, i, shape, affine):
+        """raises a ValueError unless a map of the given shape and affine is on the grid of VTA i"""
+        if tuple(shape[:3]) != self.shape(i):
+            problem = f"shape {tuple(shape[:3])} differs from {self.shape(i)}"
+        elif not np.allclose(affine, self.affines[i], atol=1e-4):
+            problem = "affine differs"
+        else:
+            return
+        raise ValueError(f"map is not on the grid of VTA {self.table['file'].iloc[i]} ({problem}), "
+                         "resample it to the VTA grid first")
+
+    def masked_mean(self, i, data, shape, affine):
+        """
+        mean of a flat (C order) map with grid shape and affine over the voxels
+        of VTA i, as fslstats <map> -k <vta> -m
+        """
+        self.check_grid(i, shape, affine)
+        idx = self.voxels(i)
+        return float(np.mean(data[idx])) if len(idx) else np.nan
+
+def vta_volumes(index, ordered_tremor, output_dir):
+    """
+    Index version of results/vta_size.sh: one row per unique VTA in
+    ordered_tremor.csv (row_id, subnum, contact, mA, cond, side, ...),
+    appended to {left,right}_vta_volumes.csv as subject,side,contact,amp,volume
+    """
+    df = pd.read_csv(ordered_tremor, dtype=str, keep_default_na=False)
+    df = df.iloc[:, [1, 5, 2, 3]]
+    df.columns = ['subject', 'side', 'contact', 'amp']
+    df = df.drop_duplicates().sort_values(['subject', 'side', 'contact', 'amp'])
+
+    os.makedirs(output_dir, exist_ok=True)
+    out = {'L': [], 'R': []}
+    for subject, side, contact, amp in df.itertuples(index=False):
+        if side not in out:
+            continue
+        i = index.lookup(subject, side, contact, amp)
+        if i is None:
+            continue
+        volume = index.volume(i)[1]
+        if volume > 0:
+            out[side].append(f"{subject},{side},{contact},{amp},{volume:.6f}\n")
+
+    for side, name in [('L', 'left'), ('R', 'right')]:
+        with open(os.path.join(output_dir, f"{name}_vta_volumes.csv"), "a") as f:
+            f.writelines(out[side])
+        print(f"{name}: {len(out[side])} VTAs")
+
+def vta_miv(index, tremor_file, map_file, side, output):
+    """
+    Index version of extract_miv.sh: mean of the effectiveness map within every
+    VTA of a tremor_{left,right}STN_final.csv, appended to output as
+    subnum,side,contact,amp,miv (right contacts 9-16 map to lead-dbs 1-8)
+    """
+    img = nib.load(map_file)
+    data = np.asanyarray(img.dataobj)
+    data = data.reshape(data.shape[:3] if data.ndim > 3 else data.shape).reshape(-1)
+    df = pd.read_csv(tremor_file, dtype=str, keep_default_na=False)
+
+    offset = 8 if side == 'R' else 0
+    lines = []
+    for subnum, contact, amp in zip(df.iloc[:, 0], df.iloc[:, 2], df.iloc[:, 3]):
+        i = index.lookup(subnum, side, int(float(contact)) - offset, amp)
+        if i is None:
+            continue
+        miv = index.masked_mean(i, data, img.shape, img.affine)
+        lines.append(f"{subnum},{side},{contact},{amp},{0 if np.isnan(miv) else f'{miv:.6f}'}\n")
+
+    with open(output, "a") as f:
+        f.writelines(lines)
+    return len(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="sparse VTA voxel store")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("build", help="index all VTAs under a lead-dbs derivatives folder")
+    p.add_argument("--vta-root", required=True)
+    p.add_argument("--index", required=True)
+    p.add_argument("--suffix", default="_MNI_1mm", help="VTA file suffix, _MNI_1mm or _MNI")
+    p.add_argument("--workers", type=int, default=1)
+
+    p = sub.add_parser("volumes", help="VTA volumes per hemisphere (vta_size.sh)")
+    p.add_argument("--index", required=True)
+    p.add_argument("--tremor", required=True, help="ordered_tremor.csv")
+    p.add_argument("--output-dir", required=True)
+
+    p = sub.add_parser("miv", help="mean effectiveness within each VTA (extract_miv.sh)")
+    p.add_argument("--index", required=True)
+    p.add_argument("--tremor", required=True, help="tremor_{left,right}STN_final.csv")
+    p.add_argument("--map", required=True, help="effectiveness map of the same side")
+    p.add_argument("--side", required=True, choices=['L', 'R'])
+    p.add_argument("--output", required=True)
+
+    args = parser.parse_args()
+    if args.command == "build":
+        build_index(args.vta_root, args.index, args.suffix, args.workers)
+    elif args.command == "volumes":
+        vta_volumes(VTAIndex(args.index), args.tremor, args.output_dir)
+    elif args.command == "miv":
+        print(vta_miv(VTAIndex(args.index), args.tremor, args.map, args.side, args.output), "VTAs")
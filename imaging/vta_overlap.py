@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""
+All-pairs VTA overlap (Dice / Jaccard)
+
+The VTAs of a sparse VTA index (vta_index.py) form one binary incidence
+matrix A (n_vtas x covered voxels, CSR). The voxel counts of all pairwise
+intersections are A @ A.T, computed for blocks of rows at a time so only
+a block x n_vtas slab is dense in memory; Dice (2|a & b| / (|a| + |b|)) and
+Jaccard (|a & b| / |a | b|) follow from the intersections and the VTA sizes.
+This replaces fslmaths -mul / fslstats -V for every pair.
+
+Outputs in output_dir:
+    lookup.csv                row, subject, side, contact, amp, voxels
+    {dice,jaccard}.npy        float32 n_vtas x n_vtas (row/column = lookup row)
+    intersection.npy          int32 voxel counts, with --metrics intersection
+
+Usage:
+    vta_overlap.py matrix --index DIR --output-dir DIR [--vta-root DIR] [--side L|R]
+                          [--metrics dice jaccard] [--block 512]
+    vta_overlap.py pairs  --output-dir DIR [--metric dice] [--min 0.95] [--output pairs.csv]
+"""
+
+import os
+import argparse
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from vta_index import VTAIndex, build_index
+
+METRICS = ('dice', 'jaccard', 'intersection')
+
+def incidence_matrix(index, rows):
+    """binary CSR matrix of the given VTAs over the voxels covered by any of them"""
+    if any(not np.allclose(index.affines[i], index.affines[rows[0]]) or index.shape(i) != index.shape(rows[0])
+           for i in rows):
+        raise ValueError("VTAs are on different grids, select them with --side or build one index per grid")
+    voxels = [index.voxels(i) for i in rows]
+    counts = np.array([len(v) for v in voxels])
+    flat = np.concatenate(voxels) if len(voxels) else np.zeros(0, dtype=np.int32)
+    covered, columns = np.unique(flat, return_inverse=True)     # compress to covered voxels
+    indptr = np.concatenate([[0], np.cumsum(counts)])
+    data = np.ones(len(flat), dtype=np.int32)
+    return sp.csr_matrix((data, columns.ravel(), indptr), shape=(len(rows), len(covered)))
+
+def overlap_matrices(A, output_dir, metrics=('dice', 'jaccard'), block=512):
+    """
+    Writes the requested metrics of all row pairs of A to <metric>.npy,
+    block rows at a time. Empty VTAs overlap with nothing (0, and 0 with
+    themselves).
+    """
+    n = A.shape[0]
+    size = np.asarray(A.sum(axis=1)).ravel().astype(np.float64)
+    AT = A.T.tocsc()
+    out = {m: np.lib.format.open_memmap(os.path.join(output_dir, f"tmp_{m}.npy"), mode='w+',
+                                        dtype=np.int32 if m == 'intersection' else np.float32, shape=(n, n))
+           for m in metrics}
+
+    for start in range(0, n, block):
+        stop = min(start + block, n)
+        inter = (A[start:stop] @ AT).toarray().astype(np.float64)
+        pair_sum = size[start:stop, np.newaxis] + size[np.newaxis, :]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if 'dice' in out:
+                out['dice'][start:stop] = np.where(pair_sum > 0, 2 * inter / pair_sum, 0)
+            if 'jaccard' in out:
+                union = pair_sum - inter
+                out['jaccard'][start:stop] = np.where(union > 0, inter / union, 0)
+        if 'intersection' in out:
+            out['intersection'][start:stop] = inter
+
+    # the dict holds the last reference to each memmap, dropping it closes the file before the rename
+    for m in list(out):
+        arr = out.pop(m)
+        arr.flush()
+        del arr
+        os.replace(os.path.join(output_dir, f"tmp_{m}.npy"), os.path.join(output_dir, f"{m}.npy"))
+
+def vta_overlap(index, output_dir, side=None, metrics=('dice', 'jaccard'), block=512):
+    """overlap matrices and lookup table of all VTAs of an index (of one side)"""
+    table = index.table
+    rows = np.flatnonzero(table['side'] == side) if side else np.arange(len(table))
+    if len(rows) == 0:
+        raise ValueError("no VTAs selected")
+
+    os.makedirs(output_dir, exist_ok=True)
+    A = incidence_matrix(index, rows)
+    overlap_matrices(A, output_dir, metrics, block)
+
+    lookup = table.iloc[rows][['subject', 'side', 'contact', 'amp', 'count']].rename(columns={'count': 'voxels'})
+    lookup.insert(0, 'row', np.arange(len(rows)))
+    lookup.to_csv(os.path.join(output_dir, "lookup.csv"), index=False)
+    print(f"{len(rows)} VTAs over {A.shape[1]} covered voxels")
+    return lookup
+
+def overlapping_pairs(output_dir, metric='dice', threshold=0.95):
+    """pairs of different VTAs with metric >= threshold, e.g. near-duplicate fields"""
+    lookup = pd.read_csv(os.path.join(output_dir, "lookup.csv"), dtype={'subject': str, 'amp': str})
+    values = np.load(os.path.join(output_dir, f"{metric}.npy"), mmap_mode='r')
+    i, j = [], []
+    for start in range(0, len(values), 1024):
+        bi, bj = np.nonzero(np.asarray(values[start:start + 1024]) >= threshold)
+        keep = bi + start < bj                                    # upper triangle
+        i.append(bi[keep] + start); j.append(bj[keep])
+    i = np.concatenate(i); j = np.concatenate(j)
+
+    a = lookup.iloc[i].reset_index(drop=True).add_suffix('_a')
+    b = lookup.iloc[j].reset_index(drop=True).add_suffix('_b')
+    pairs = pd.concat([a, b], axis=1)
+    pairs[metric] = np.asarray(values[i, j]) if len(i) else []
+    return pairs.sort_values(metric, ascending=False)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="all-pairs VTA overlap")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("matrix", help="overlap matrices of all VTAs of an index")
+    p.add_argument("--index", required=True, help="sparse VTA index (vta_index.py)")
+    p.add_argument("--vta-root", default=None, help="build or update the index from this folder first")
+    p.add_argument("--suffix", default="_MNI_1mm", help="VTA file suffix when building the index")
+    p.add_argument("--output-dir", required=True)
+    p.add_argument("--side", choices=['L', 'R'], default=None)
+    p.add_argument("--metrics", nargs="+", choices=METRICS, default=['dice', 'jaccard'])
+    p.add_argument("--block", type=int, default=512, help="VTAs per block of the sparse product")
+    p.add_argument("--workers", type=int, default=1, help="processes reading VTAs when building the index")
+
+    p = sub.add_parser("pairs", help="list pairs of VTAs above an overlap threshold")
+    p.add_argument("--output-dir", required=True, help="folder of the overlap matrices")
+    p.add_argument("--metric", choices=METRICS[:2], default='dice')
+    p.add_argument("--min", type=float, default=0.95)
+    p.add_argument("--output", default=None, help="CSV file (default: print)")
+
+    args = parser.parse_args()
+    if args.command == "matrix":
+        if args.vta_root:
+            build_index(args.vta_root, args.index, args.suffix, args.workers)
+        vta_overlap(VTAIndex(args.index), args.output_dir, args.side, args.metrics, args.block)
+    else:
+        pairs = overlapping_pairs(args.output_dir, args.metric, args.min)
+        if args.output:
+            pairs.to_csv(args.output, index=False)
+        else:
+            print(pairs.to_string(index=False))
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 """
 Extract Desikan Parcellation ROI Centroids from desikan_supratent_gm_coords.txt file
+or directly from a parcellation NIfTI (see roi_centroids.py)
 
 """
 
@@ -15,7 +16,8 @@ def extract_and_save_centroids(input_file='desikan_supratent_gm_coords.txt',
     Parameters:
     -----------
     input_file : str
-        Path to the input coordinate file
+        Path to the input coordinate file, or a parcellation NIfTI whose
+        label centroids are computed (and cached) with roi_centroids
     output_left : str
         Output CSV file for left hemisphere cortical ROIs (1001-1035)
     output_right : str
@@ -116,7 +118,11 @@ def extract_and_save_centroids(input_file='desikan_supratent_gm_coords.txt',
     
     # Load the coordinate file
     print(f"Loading coordinates from: {input_file}")
-    data = np.loadtxt(input_file)
+    if input_file.endswith(('.nii', '.nii.gz')):
+        from roi_centroids import load_centroids
+        data = load_centroids(input_file)[['ROI_ID', 'x', 'y', 'z']].to_numpy()
+    else:
+        data = np.loadtxt(input_file)
     
     # Separate into different categories
     left_cortical = []
@@ -175,5 +181,9 @@ def extract_and_save_centroids(input_file='desikan_supratent_gm_coords.txt',
 
 
 if __name__ == "__main__":
-    df_left, df_right, df_subcortical = extract_and_save_centroids()
+    import sys
+    if len(sys.argv) > 1:
+        df_left, df_right, df_subcortical = extract_and_save_centroids(sys.argv[1])
+    else:
+        df_left, df_right, df_subcortical = extract_and_save_centroids()
     print("Extraction complete.")
@@ -7,6 +7,12 @@ VTA centres and brain ROIs, coloured by PLS loading strength.
 Separate visualisations are created for left and right hemispheres.
 """
 
+import os
+import sys
+import json
+import argparse
+import itertools
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
@@ -16,37 +22,95 @@ from nilearn import plotting, image
 from nilearn.image import coord_transform
 import matplotlib.gridspec as gridspec
 
-def get_roi_coordinates():
-    """Load MNI co-ordinates for ROIs from CSV files"""
-    df_left = pd.read_csv('desikan_left_centroids_mni.csv')
-    df_right = pd.read_csv('desikan_right_centroids_mni.csv')
-    df_subcortical = pd.read_csv('desikan_subcortical_centroids_mni.csv')
-    
-    roi_coords = {}
-    
-    for _, row in df_left.iterrows():
-        roi_name = row['ROI_name'].replace('ctx-lh-', 'l-')
-        roi_coords[roi_name] = [row['x'], row['y'], row['z']]
-    
-    for _, row in df_right.iterrows():
-        roi_name = row['ROI_name'].replace('ctx-rh-', 'r-')
-        roi_coords[roi_name] = [row['x'], row['y'], row['z']]
-    
-    for _, row in df_subcortical.iterrows():
-        roi_name = row['ROI_name'].replace('Left-', 'l-').replace('Right-', 'r-')
-        roi_coords[roi_name] = [row['x'], row['y'], row['z']]
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'imaging'))
+
+def get_roi_coordinates(parcellation=None):
+    """
+    Load MNI co-ordinates for ROIs. With a parcellation NIfTI the centroids of
+    all its labels (including the cerebellum) are computed or taken from its
+    cached centroid table, otherwise they are read from the Desikan CSV files.
+    """
+    if parcellation is not None:
+        from roi_centroids import load_centroids, roi_coordinates
+        return roi_coordinates(load_centroids(parcellation))
+
+    df = pd.concat([pd.read_csv('desikan_left_centroids_mni.csv'),
+                    pd.read_csv('desikan_right_centroids_mni.csv'),
+                    pd.read_csv('desikan_subcortical_centroids_mni.csv')])
+    names = (df['ROI_name'].str.replace('ctx-lh-', 'l-', regex=False)
+                           .str.replace('ctx-rh-', 'r-', regex=False)
+                           .str.replace('Left-', 'l-', regex=False)
+                           .str.replace('Right-', 'r-', regex=False))
+    roi_coords = dict(zip(names, df[['x', 'y', 'z']].to_numpy().tolist()))
     
     roi_coords['l-Cerebellum-Cortex'] = [-28, -60, -32]
     roi_coords['r-Cerebellum-Cortex'] = [28, -60, -32]
     
     return roi_coords
 
-def get_vta_center_of_mass(vta_file):
-    """Extract centre of mass from VTA NIfTI file"""
+def get_vta_centres(vta_file_left, vta_file_right, vta_index=None, tremor_files=None,
+                    cache_file='vta_centres_cache.json'):
+    """
+    VTA centres of both hemispheres, cached on disk. A cache entry is reused
+    while the summed VTA maps (or the index and tremor tables) have not changed
+    since it was written. tremor_files are the (left, right) tremor tables the
+    sum maps were built from, needed with vta_index.
+    """
+    if vta_index is not None:
+        if tremor_files is None:
+            raise ValueError("the VTA index needs the tremor tables of the nonweighted sum maps")
+        sources = [os.path.join(vta_index, 'index.csv')] + list(tremor_files)
+    else:
+        sources = [vta_file_left, vta_file_right]
+    key = '|'.join(f'{os.path.abspath(f)}:{os.stat(f).st_mtime_ns}' for f in sources)
+
+    cache = {}
+    if os.path.isfile(cache_file):
+        with open(cache_file) as f:
+            cache = json.load(f)
+    if key not in cache:
+        tremor_files = tremor_files or (None, None)
+        cache[key] = {'L': get_vta_center_of_mass(vta_file_left, vta_index, 'L', tremor_files[0]),
+                      'R': get_vta_center_of_mass(vta_file_right, vta_index, 'R', tremor_files[1])}
+        cache[key] = {side: None if c is None else [float(x) for x in c] for side, c in cache[key].items()}
+        with open(cache_file, 'w') as f:
+            json.dump(cache, f, indent=1)
+
+    return cache[key]['L'], cache[key]['R']
+
+def tremor_table_rows(index, tremor_file, side):
+    """
+    index rows of the VTAs of a tremor_{left,right}STN_final.csv, i.e. the
+    VTAs create_effectiveness_maps.sh adds to the nonweighted sum map of
+    that side (right contacts 9-16 map to lead-dbs 1-8, missing VTAs are skipped)
+    """
+    from effectiveness_maps import read_tremor
+    tremor = read_tremor(tremor_file)
+    offset = 8 if side == 'R' else 0
+    rows = [index.lookup(s, side, int(float(c)) - offset, a)
+            for s, c, a in zip(tremor['subnum'], tremor['contact'], tremor['amp'])]
+    return np.unique([r for r in rows if r is not None]).astype(int)
+
+def get_vta_center_of_mass(vta_file, vta_index=None, side=None, tremor_file=None):
+    """
+    Extract centre of mass from VTA NIfTI file.
+
+    With vta_index (a directory written by imaging/vta_index.py build) and
+    the tremor table the sum map was built from, the centre of the union of
+    the VTAs listed in that table is taken from the sparse index instead.
+    That union is the non-zero region of the nonweighted sum map, so no
+    volume has to be read (check_vta_centres compares both).
+    """
+    if vta_index is not None:
+        from vta_index import VTAIndex
+        index = VTAIndex(vta_index)
+        rows = tremor_table_rows(index, tremor_file, side)
+        return index.center_of_mass(rows) if len(rows) else None
+
     vta_img = nib.load(vta_file)
-    vta_data = vta_img.get_fdata()
+    vta_data = np.asanyarray(vta_img.dataobj)
     
-    coords = np.where(vta_data > 0)
+    coords = np.nonzero(vta_data > 0)
     if len(coords[0]) == 0:
         return None
     
@@ -55,29 +119,158 @@ def get_vta_center_of_mass(vta_file):
     
     return centre_mni
 
-def create_separate_hemisphere_plot():
+def check_vta_centres(vta_file_left, vta_file_right, vta_index, tremor_files, tol=1e-3):
+    """centres from the sum maps and from the index, True if they agree within tol mm"""
+    ok = True
+    for side, vta_file, tremor_file in [('L', vta_file_left, tremor_files[0]),
+                                        ('R', vta_file_right, tremor_files[1])]:
+        dense = get_vta_center_of_mass(vta_file)
+        indexed = get_vta_center_of_mass(vta_file, vta_index, side, tremor_file)
+        if dense is None or indexed is None:
+            same = dense is None and indexed is None
+        else:
+            same = np.allclose(dense, indexed, atol=tol)
+        print(f"{side}: sum map {dense}, index {indexed}{'' if same else '  MISMATCH'}")
+        ok &= same
+    return ok
+
+def plot_hemisphere(fig, gs, row, rois, comp_col, vta_coord, roi_coordinates, cmap, titles, right_titles=False):
+    """
+    Plot one hemisphere (one row of 3 orthogonal views) and return the colourbar data.
+
+    Nodes are the VTA centre and the selected ROIs, edges connect the VTA
+    (node 0) to each ROI with its absolute loading as strength.
+    """
+    rois = rois[rois['name'].isin(roi_coordinates.keys())]
+    loadings = np.abs(rois[comp_col].to_numpy(dtype=float))
+    coords = np.array([vta_coord] + [roi_coordinates[name] for name in rois['name']])
+    n_nodes = len(coords)
+
+    # Create adjacency matrix: connect VTA (node 0) to each ROI with loading strength
+    adjacency = np.zeros((n_nodes, n_nodes))
+    adjacency[0, 1:] = loadings
+    adjacency[1:, 0] = loadings
+
+    # Normalise loading values for colour scaling
+    lmin = np.percentile(loadings, 2) if len(loadings) > 0 else 0
+    lmax = np.percentile(loadings, 98) if len(loadings) > 0 else 1
+
+    # Set node colours and sizes: VTA in grey, ROIs in colour gradient
+    norm_strength = (loadings - lmin) / (lmax - lmin) if lmax > lmin else np.zeros_like(loadings)
+    node_colors = ['#808080'] + [cmap(v) for v in np.clip(norm_strength, 0, 1)]
+    node_sizes = [150] + [80] * len(loadings)
+
+    # Scale edge colours based on loading strength
+    values = adjacency[adjacency > 0]
+    vmin = np.percentile(values, 2) if len(values) > 0 else 0
+    vmax = np.percentile(values, 98) if len(values) > 0 else 1
+
+    cbar_data = None
+    for i, (view, title) in enumerate(zip(['x', 'y', 'z'], titles)):
+        ax = fig.add_subplot(gs[row, i])
+
+        # Plot connections (edges)
+        if np.any(adjacency > 0):
+            plotting.plot_connectome(
+                adjacency,
+                coords,
+                node_color='none',
+                node_size=0,
+                edge_cmap=cmap,
+                edge_vmin=vmin,
+                edge_vmax=vmax,
+                edge_threshold=0,
+                edge_kwargs={'linewidth': 5},
+                axes=ax,
+                display_mode=view,
+                colorbar=False
+            )
+            if i == 0:
+                cbar_data = (values, cmap, vmin, vmax)
+
+        # Plot nodes (VTA and ROIs)
+        plotting.plot_connectome(
+            np.zeros_like(adjacency),
+            coords,
+            node_color=node_colors,
+            node_size=node_sizes,
+            axes=ax,
+            display_mode=view,
+            colorbar=False
+        )
+
+        if right_titles and i >= 1:
+            ax.set_title(title, fontsize=12, fontweight='bold', pad=20)
+        else:
+            ax.set_title(title, fontsize=12, fontweight='bold', y=1.05)
+
+    return cbar_data
+
+def add_colourbar(fig, ax_spec, cbar_data, label):
+    values, cmap, vmin, vmax = cbar_data
+    cbar_ax = fig.add_subplot(ax_spec)
+    sm = plt.cm.ScalarMappable(cmap=cmap, norm=plt.Normalize(vmin=vmin, vmax=vmax))
+    sm.set_array([])
+    cbar = plt.colorbar(sm, cax=cbar_ax)
+    cbar.set_label(label, fontsize=10, fontweight='bold')
+    cbar.ax.tick_params(labelsize=8)
+    tick_values = np.linspace(vmin, vmax, 5)
+    cbar.set_ticks(tick_values)
+    cbar.set_ticklabels([f'{val:.3f}' for val in tick_values])
+
+def load_component(component, pls_results=None, min_bsr=None, alpha=None, rank_by='loading'):
+    """
+    ROI loadings of one component, sorted by decreasing importance, with the
+    columns name and 'Comp <c>'. Without pls_results they are read from the
+    R output component_<c>_sorted_both.csv. With the pls_results.csv of
+    results/pls_connectivity.py ROIs can be restricted to stable
+    (|bootstrap ratio| >= min_bsr) and significant (permutation p < alpha)
+    loadings and ranked by 'loading', 'bsr' or 'p'.
+    """
+    comp_col = f'Comp {component}'
+    if pls_results is None:
+        return pd.read_csv(f'component_{component}_sorted_both.csv')
+
+    df = pd.read_csv(pls_results)
+    df = df[df['component'] == component].copy()
+    if min_bsr is not None:
+        df = df[df['bootstrap_ratio'].abs() >= min_bsr]
+    if alpha is not None:
+        df = df[df['p_perm'] < alpha]
+    keys = {'loading': df['loading'].abs(), 'bsr': df['bootstrap_ratio'].abs(), 'p': -df['p_perm']}
+    df = df.assign(_rank=keys[rank_by]).sort_values('_rank', ascending=False)
+    return df.rename(columns={'loading': comp_col}).drop(columns='_rank')
+
+def create_separate_hemisphere_plot(component=1, top_k=8, vta_index=None, roi_coordinates=None,
+                                    vta_coords=None, outprefix=None, selection=None, tremor_files=None):
     """
     Create glass brain plots showing VTA-ROI connectivity for both hemispheres.
-    
+    VTA centres come from the sparse VTA index if one is given. ROI and VTA
+    co-ordinates can be passed in to skip loading them again. tremor_files are
+    the (left, right) tremor tables of the sum maps, needed with vta_index. selection holds
+    the keyword arguments of load_component (PLS results file and thresholds).
+
     The plot shows:
-    - Top 8 ROIs per hemisphere based on PLS Component 1 loadings
+    - Top k ROIs per hemisphere based on the PLS component loadings
     - Connections from VTA centre to each ROI
     - Edge thickness/colour represents loading strength
     - Orange colourmap for left hemisphere, blue for right hemisphere
     """
-    # Load PLS component data and select top 8 ROIs per hemisphere
-    pls_data = pd.read_csv('component_1_sorted_both.csv')
-    left_rois = pls_data[pls_data['name'].str.startswith('l-')].head(8)
-    right_rois = pls_data[pls_data['name'].str.startswith('r-')].head(8)
+    # Load PLS component data and select top k ROIs per hemisphere
+    comp_col = f'Comp {component}'
+    pls_data = load_component(component, **(selection or {}))
+    left_rois = pls_data[pls_data['name'].str.startswith('l-')].head(top_k)
+    right_rois = pls_data[pls_data['name'].str.startswith('r-')].head(top_k)
     
     # Load VTA files and extract centre of mass co-ordinates
-    vta_file_left = '../sweet_spot/nonweighted_sum_left.nii.gz'
-    vta_file_right = '../sweet_spot/nonweighted_sum_right.nii.gz'
-    vta_coord_left = get_vta_center_of_mass(vta_file_left)
-    vta_coord_right = get_vta_center_of_mass(vta_file_right)
+    if vta_coords is None:
+        vta_coords = get_vta_centres('../sweet_spot/nonweighted_sum_left.nii.gz',
+                                     '../sweet_spot/nonweighted_sum_right.nii.gz', vta_index, tremor_files)
+    vta_coord_left, vta_coord_right = vta_coords
     
     # Load ROI co-ordinates from Desikan atlas
-    roi_coordinates = get_roi_coordinates()
+    if roi_coordinates is None:
+        roi_coordinates = get_roi_coordinates()
     
     # Create  colourmaps
     orange_cmap = LinearSegmentedColormap.from_list('orange', ['#FFD580', '#FF9933', '#E67300', '#993D00'], N=256)
@@ -87,195 +280,23 @@ def create_separate_hemisphere_plot():
     fig = plt.figure(figsize=(20, 16))
     gs = fig.add_gridspec(2, 4, width_ratios=[1, 1, 1, 0.15], hspace=0.4, wspace=0.1)
     
-    views = ['x', 'y', 'z']
     left_titles = ['Left Hemisphere - X view', 'Left Hemisphere - Y view', 'Left Hemisphere - Z view']
     right_titles = ['Right Hemisphere - X view', 'Right Hemisphere - Y view', 'Right Hemisphere - Z view']
-    left_cbar_data = None
-    right_cbar_data = None
     
-    # Plot left hemisphere (top row) - 3 orthogonal views
-    for i, (view, title) in enumerate(zip(views, left_titles)):
-        ax = fig.add_subplot(gs[0, i])
-        
-        # Prepare node co-ordinates: VTA centre + top 8 ROIs
-        left_coords = [vta_coord_left]
-        left_node_names = ['VTA_L']
-        for _, roi in left_rois.iterrows():
-            roi_name = roi['name']
-            if roi_name in roi_coordinates:
-                left_coords.append(roi_coordinates[roi_name])
-                left_node_names.append(roi_name)
-        
-        left_coords = np.array(left_coords)
-        n_left_nodes = len(left_coords)
-        
-        # Create adjacency matrix: connect VTA (node 0) to each ROI with loading strength
-        left_adjacency = np.zeros((n_left_nodes, n_left_nodes))
-        for j in range(1, n_left_nodes):
-            roi_idx = j - 1
-            loading_strength = abs(left_rois.iloc[roi_idx]['Comp 1'])
-            left_adjacency[0, j] = loading_strength
-            left_adjacency[j, 0] = loading_strength
-        
-        # Normalise loading values for colour scaling
-        left_loadings = [abs(roi['Comp 1']) for _, roi in left_rois.iterrows()]
-        left_min = np.percentile(left_loadings, 2) if len(left_loadings) > 0 else 0
-        left_max = np.percentile(left_loadings, 98) if len(left_loadings) > 0 else 1
-        
-        # Set node colours and sizes: VTA in grey, ROIs in orange gradient
-        left_node_colors = ['#808080']
-        left_node_sizes = [150]
-        for _, roi in left_rois.iterrows():
-            loading_strength = abs(roi['Comp 1'])
-            norm_strength = (loading_strength - left_min) / (left_max - left_min) if left_max > left_min else 0
-            norm_strength = np.clip(norm_strength, 0, 1)
-            color = orange_cmap(norm_strength)
-            left_node_colors.append(color)
-            left_node_sizes.append(80)
-        
-        # Scale edge colours based on loading strength
-        left_values = left_adjacency[left_adjacency > 0]
-        left_vmin = np.percentile(left_values, 2) if len(left_values) > 0 else 0
-        left_vmax = np.percentile(left_values, 98) if len(left_values) > 0 else 1
-        
-        # Plot connections (edges)
-        if np.any(left_adjacency > 0):
-            plotting.plot_connectome(
-                left_adjacency,
-                left_coords,
-                node_color='none',
-                node_size=0,
-                edge_cmap=orange_cmap,
-                edge_vmin=left_vmin,
-                edge_vmax=left_vmax,
-                edge_threshold=0,
-                edge_kwargs={'linewidth': 5},
-                axes=ax,
-                display_mode=view,
-                colorbar=False
-            )
-            if i == 0:
-                left_cbar_data = (left_values, orange_cmap, left_vmin, left_vmax)
-        
-        # Plot nodes (VTA and ROIs)
-        plotting.plot_connectome(
-            np.zeros_like(left_adjacency),
-            left_coords,
-            node_color=left_node_colors,
-            node_size=left_node_sizes,
-            axes=ax,
-            display_mode=view,
-            colorbar=False
-        )
-        
-        ax.set_title(title, fontsize=12, fontweight='bold', y=1.05)
-    
-    # Plot right hemisphere (bottom row) - same as left
-    for i, (view, title) in enumerate(zip(views, right_titles)):
-        ax = fig.add_subplot(gs[1, i])
-        
-        right_coords = [vta_coord_right]
-        right_node_names = ['VTA_R']
-        for _, roi in right_rois.iterrows():
-            roi_name = roi['name']
-            if roi_name in roi_coordinates:
-                right_coords.append(roi_coordinates[roi_name])
-                right_node_names.append(roi_name)
-        
-        right_coords = np.array(right_coords)
-        n_right_nodes = len(right_coords)
-        
-        # Create adjacency matrix for right hemisphere
-        right_adjacency = np.zeros((n_right_nodes, n_right_nodes))
-        for j in range(1, n_right_nodes):
-            roi_idx = j - 1
-            loading_strength = abs(right_rois.iloc[roi_idx]['Comp 1'])
-            right_adjacency[0, j] = loading_strength
-            right_adjacency[j, 0] = loading_strength
-        
-        # Normalise loading values for colour scaling
-        right_loadings = [abs(roi['Comp 1']) for _, roi in right_rois.iterrows()]
-        right_min = np.percentile(right_loadings, 2) if len(right_loadings) > 0 else 0
-        right_max = np.percentile(right_loadings, 98) if len(right_loadings) > 0 else 1
-        
-        # Set node colours: VTA in grey, ROIs in blue gradient
-        right_node_colors = ['#808080']
-        right_node_sizes = [150]
-        for _, roi in right_rois.iterrows():
-            loading_strength = abs(roi['Comp 1'])
-            norm_strength = (loading_strength - right_min) / (right_max - right_min) if right_max > right_min else 0
-            norm_strength = np.clip(norm_strength, 0, 1)
-            color = blue_cmap(norm_strength)
-            right_node_colors.append(color)
-            right_node_sizes.append(80)
-        
-        # Scale edge colours
-        right_values = right_adjacency[right_adjacency > 0]
-        right_vmin = np.percentile(right_values, 2) if len(right_values) > 0 else 0
-        right_vmax = np.percentile(right_values, 98) if len(right_values) > 0 else 1
-        
-        # Plot connections
-        if np.any(right_adjacency > 0):
-            plotting.plot_connectome(
-                right_adjacency,
-                right_coords,
-                node_color='none',
-                node_size=0,
-                edge_cmap=blue_cmap,
-                edge_vmin=right_vmin,
-                edge_vmax=right_vmax,
-                edge_threshold=0,
-                edge_kwargs={'linewidth': 5},
-                axes=ax,
-                display_mode=view,
-                colorbar=False
-            )
-            if i == 0:
-                right_cbar_data = (right_values, blue_cmap, right_vmin, right_vmax)
-        
-        # Plot nodes
-        plotting.plot_connectome(
-            np.zeros_like(right_adjacency),
-            right_coords,
-            node_color=right_node_colors,
-            node_size=right_node_sizes,
-            axes=ax,
-            display_mode=view,
-            colorbar=False
-        )
-        
-        if i >= 1:
-            ax.set_title(title, fontsize=12, fontweight='bold', pad=20)
-        else:
-            ax.set_title(title, fontsize=12, fontweight='bold', y=1.05)
+    # Plot left hemisphere (top row) and right hemisphere (bottom row) - 3 orthogonal views each
+    left_cbar_data = plot_hemisphere(fig, gs, 0, left_rois, comp_col, vta_coord_left, roi_coordinates,
+                                     orange_cmap, left_titles)
+    right_cbar_data = plot_hemisphere(fig, gs, 1, right_rois, comp_col, vta_coord_right, roi_coordinates,
+                                      blue_cmap, right_titles, right_titles=True)
     
     # Add colourbars for both hemispheres
     if left_cbar_data is not None:
-        cbar_ax_left = fig.add_subplot(gs[0, 3])
-        left_values, left_cmap, left_vmin, left_vmax = left_cbar_data
-        sm_left = plt.cm.ScalarMappable(cmap=left_cmap, norm=plt.Normalize(vmin=left_vmin, vmax=left_vmax))
-        sm_left.set_array([])
-        cbar_left = plt.colorbar(sm_left, cax=cbar_ax_left)
-        cbar_left.set_label('Left Hemisphere\nPLS Loading', fontsize=10, fontweight='bold')
-        cbar_left.ax.tick_params(labelsize=8)
-        tick_values = np.linspace(left_vmin, left_vmax, 5)
-        cbar_left.set_ticks(tick_values)
-        cbar_left.set_ticklabels([f'{val:.3f}' for val in tick_values])
-    
+        add_colourbar(fig, gs[0, 3], left_cbar_data, 'Left Hemisphere\nPLS Loading')
     if right_cbar_data is not None:
-        cbar_ax_right = fig.add_subplot(gs[1, 3])
-        right_values, right_cmap, right_vmin, right_vmax = right_cbar_data
-        sm_right = plt.cm.ScalarMappable(cmap=right_cmap, norm=plt.Normalize(vmin=right_vmin, vmax=right_vmax))
-        sm_right.set_array([])
-        cbar_right = plt.colorbar(sm_right, cax=cbar_ax_right)
-        cbar_right.set_label('Right Hemisphere\nPLS Loading', fontsize=10, fontweight='bold')
-        cbar_right.ax.tick_params(labelsize=8)
-        tick_values = np.linspace(right_vmin, right_vmax, 5)
-        cbar_right.set_ticks(tick_values)
-        cbar_right.set_ticklabels([f'{val:.3f}' for val in tick_values])
+        add_colourbar(fig, gs[1, 3], right_cbar_data, 'Right Hemisphere\nPLS Loading')
     
     # Add title and legend
-    fig.suptitle('Component 1 Loadings: VTA-ROI Connectivity (Separate Hemispheres)', 
+    fig.suptitle(f'Component {component} Loadings: VTA-ROI Connectivity (Separate Hemispheres)', 
                  fontsize=16, fontweight='bold', y=0.95)
     
     legend_elements = [
@@ -293,8 +314,77 @@ def create_separate_hemisphere_plot():
     plt.tight_layout()
     plt.subplots_adjust(bottom=0.08)
     
-    plt.savefig('component1_separate_hemispheres.png', dpi=300, bbox_inches='tight')
-    plt.savefig('component1_separate_hemispheres.pdf', bbox_inches='tight')
+    outprefix = outprefix or f'component{component}_separate_hemispheres'
+    plt.savefig(f'{outprefix}.png', dpi=300, bbox_inches='tight')
+    plt.savefig(f'{outprefix}.pdf', bbox_inches='tight')
+    plt.close(fig)
+    return outprefix
+
+def _render(args):
+    component, top_k, roi_coordinates, vta_coords, selection = args
+    return create_separate_hemisphere_plot(component, top_k, roi_coordinates=roi_coordinates, vta_coords=vta_coords,
+                                           outprefix=f'component{component}_top{top_k}_separate_hemispheres',
+                                           selection=selection)
+
+def render_batch(components, top_ks, workers=None, vta_index=None, parcellation=None, selection=None,
+                 tremor_files=None):
+    """
+    Render the figure for every (component, top k) combination in worker processes.
+    VTA centres and ROI co-ordinates are loaded (or taken from the cache) once and
+    shared with all workers.
+    """
+    roi_coordinates = get_roi_coordinates(parcellation)
+    vta_coords = get_vta_centres('../sweet_spot/nonweighted_sum_left.nii.gz',
+                                 '../sweet_spot/nonweighted_sum_right.nii.gz', vta_index, tremor_files)
+
+    jobs = [(c, k, roi_coordinates, vta_coords, selection) for c, k in itertools.product(components, top_ks)]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for outprefix in pool.map(_render, jobs):
+            print(f'{outprefix}.png/.pdf')
 
 if __name__ == "__main__":
-    create_separate_hemisphere_plot()
+    parser = argparse.ArgumentParser(description="glass brain plots of PLS loadings")
+    parser.add_argument("--components", type=int, nargs="+", default=None,
+                        help="render these components in batch mode (component_<c>_sorted_both.csv)")
+    parser.add_argument("--top-k", type=int, nargs="+", default=[8], help="ROIs per hemisphere")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--vta-index", default=None, help="sparse VTA index (imaging/vta_index.py)")
+    parser.add_argument("--tremor-left", default=None,
+                        help="tremor_leftSTN_final.csv of the sum maps, selects the indexed VTAs")
+    parser.add_argument("--tremor-right", default=None,
+                        help="tremor_rightSTN_final.csv of the sum maps, selects the indexed VTAs")
+    parser.add_argument("--check-vta-centres", action="store_true",
+                        help="compare the VTA centres of the sum maps and the index and exit")
+    parser.add_argument("--parcellation", default=None,
+                        help="MNI parcellation to take ROI centroids from instead of the Desikan CSV files")
+    parser.add_argument("--pls-results", default=None,
+                        help="pls_results.csv of results/pls_connectivity.py instead of the R component files")
+    parser.add_argument("--min-bsr", type=float, default=None, help="minimum absolute bootstrap ratio")
+    parser.add_argument("--alpha", type=float, default=None, help="maximum permutation p-value")
+    parser.add_argument("--rank-by", choices=["loading", "bsr", "p"], default="loading")
+    args = parser.parse_args()
+
+    tremor_files = None
+    if args.vta_index is not None:
+        if args.tremor_left is None or args.tremor_right is None:
+            parser.error("--vta-index needs --tremor-left and --tremor-right")
+        tremor_files = (args.tremor_left, args.tremor_right)
+    if args.check_vta_centres:
+        if tremor_files is None:
+            parser.error("--check-vta-centres needs --vta-index, --tremor-left and --tremor-right")
+        sys.exit(0 if check_vta_centres('../sweet_spot/nonweighted_sum_left.nii.gz',
+                                        '../sweet_spot/nonweighted_sum_right.nii.gz',
+                                        args.vta_index, tremor_files) else 1)
+
+    selection = {'pls_results': args.pls_results, 'min_bsr': args.min_bsr, 'alpha': args.alpha,
+                 'rank_by': args.rank_by}
+    if args.pls_results is None and (args.min_bsr is not None or args.alpha is not None):
+        parser.error("--min-bsr and --alpha need --pls-results")
+
+    if args.components is None:
+        create_separate_hemisphere_plot(1, args.top_k[0], args.vta_index,
+                                        roi_coordinates=get_roi_coordinates(args.parcellation), selection=selection,
+                                        tremor_files=tremor_files)
+    else:
+        render_batch(args.components, args.top_k, args.workers, args.vta_index, args.parcellation, selection,
+                     tremor_files)
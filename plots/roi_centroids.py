@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""
+Compute ROI centroids directly from a parcellation volume
+
+All labels of an aparc+aseg / Desikan NIfTI (cortex, subcortex and
+cerebellum) are handled in one vectorised pass: label-wise bincounts of the
+voxel co-ordinates give every centroid at once, which is then mapped to
+world (MNI for MNI-space parcellations) co-ordinates with the affine.
+The result is cached as one table keyed by label ID next to the
+parcellation, so no external co-ordinate dump is needed for a new atlas or
+a subject-space parcellation.
+"""
+
+import os
+import sys
+import numpy as np
+import pandas as pd
+import nibabel as nib
+
+SEED_LIST = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'imaging', 'desikan_seed_list.txt')
+
+def read_label_names(seed_list=SEED_LIST):
+    """label ID -> name from a seed list (label ID and name per line)"""
+    names = {}
+    with open(seed_list) as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) >= 2:
+                names[int(fields[0])] = fields[1]
+    return names
+
+def compute_centroids(parc_file, label_names=None):
+    """
+    Centroid of every non-zero label of a parcellation.
+
+    Returns a DataFrame with ROI_ID, ROI_name, x, y, z (world co-ordinates)
+    and n_voxels, sorted by ROI_ID. Labels without a name are called label-<ID>.
+    """
+    img = nib.load(parc_file)
+    labels = np.asanyarray(img.dataobj).astype(np.int64)
+
+    ijk = np.nonzero(labels)
+    lab = labels[ijk]
+    counts = np.bincount(lab)
+    ids = np.flatnonzero(counts)
+    ids = ids[ids > 0]
+
+    centre = np.stack([np.bincount(lab, weights=c)[ids] for c in ijk], axis=1) / counts[ids, np.newaxis]
+    xyz = nib.affines.apply_affine(img.affine, centre)
+
+    label_names = read_label_names() if label_names is None else label_names
+    return pd.DataFrame({'ROI_ID': ids,
+                         'ROI_name': [label_names.get(i, f'label-{i}') for i in ids],
+                         'x': xyz[:, 0], 'y': xyz[:, 1], 'z': xyz[:, 2],
+                         'n_voxels': counts[ids]})
+
+def load_centroids(parc_file, cache_file=None, label_names=None):
+    """centroid table of a parcellation, recomputed only if the parcellation is newer than the cache"""
+    if cache_file is None:
+        base = os.path.basename(parc_file)
+        for ext in ('.nii.gz', '.nii', '.mgz'):
+            if base.endswith(ext):
+                base = base[:-len(ext)]
+        cache_file = os.path.join(os.path.dirname(parc_file), f'{base}_centroids.csv')
+
+    if os.path.isfile(cache_file) and os.path.getmtime(cache_file) >= os.path.getmtime(parc_file):
+        return pd.read_csv(cache_file)
+
+    table = compute_centroids(parc_file, label_names)
+    table.to_csv(cache_file, index=False)
+    return table
+
+def roi_coordinates(table):
+    """ROI name (l-/r- prefixed as in the PLS output) -> [x, y, z]"""
+    names = (table['ROI_name'].str.replace('ctx-lh-', 'l-', regex=False)
+                              .str.replace('ctx-rh-', 'r-', regex=False)
+                              .str.replace('Left-', 'l-', regex=False)
+                              .str.replace('Right-', 'r-', regex=False))
+    return dict(zip(names, table[['x', 'y', 'z']].to_numpy().tolist()))
+
+
+if __name__ == "__main__":
+    table = load_centroids(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else None)
+    print(f"{len(table)} labels")
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+"""
+PLS of VAT-ROI connectivity and tremor with permutation and bootstrap tests
+
+Python counterpart of the plsr() model in stats_connectivity_regression.R:
+the VAT x 82-ROI connectivity (log1p, z-scored per subject) predicts the
+subject-demeaned tremor RMS. Refits are run in batches: a whole stack of
+permuted or resampled data sets goes through one NIPALS pass, where the
+weights of every component of every refit come from one batched SVD of
+X'Y. Batches are spread over worker processes, each with its own seed
+derived from --seed, so results do not depend on the number of workers.
+
+- permutations of y give a p-value per component (variance of y explained)
+  and per ROI and component (absolute weight)
+- bootstrap resamples (of subjects by default, as the VATs of one subject
+  are not independent) give standard errors, bootstrap ratios
+  (loading / SE) and percentile intervals of the loadings. Resamples are
+  applied as row counts, so every resample keeps the shape of the data
+
+Outputs:
+    pls_results.csv      component, roi, name, loading, weight, boot_se,
+                         bootstrap_ratio, ci_low, ci_high, p_perm
+    pls_components.csv   component, r2_y, r2_y_cum, p_perm
+
+Usage:
+    pls_connectivity.py [--connectivity ../results/vat_connectivity_matrix.csv] [--tremor FILE]
+                        [--ncomp 5] [--n-perm 10000] [--n-boot 5000] [--workers N]
+"""
+
+import os
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+
+SEED_LIST = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'imaging', 'desikan_seed_list.txt')
+
+def roi_names(seed_list=SEED_LIST):
+    """ROI names of the connectivity columns in the l-/r- form of the PLS output files"""
+    with open(seed_list) as f:
+        names = [line.split()[1] for line in f if len(line.split()) >= 2]
+    return [n.replace('ctx-lh-', 'l-').replace('ctx-rh-', 'r-').replace('Left-', 'l-').replace('Right-', 'r-')
+            for n in names]
+
+def _scale(x):
+    """z-score ignoring constant vectors (my_scale in the R script)"""
+    if len(np.unique(x)) == 1:
+        return np.zeros(len(x))
+    return (x - x.mean()) / x.std(ddof=1)
+
+def prepare_data(conn_file, tremor_file, n_rois=82):
+    """
+    Merges connectivity and tremor as stats_connectivity_regression.R does.
+    Returns X (n x n_rois), y (n,) demeaned per subject and the subject of every row.
+    """
+    df = pd.read_csv(conn_file)
+    conn_cols = [str(i) for i in range(1, n_rois + 1)]          # drops the VAT self-connectivity column
+    df[conn_cols] = np.log1p(df[conn_cols])
+    df[conn_cols] = df.groupby('subject')[conn_cols].transform(lambda x: _scale(x.to_numpy(dtype=float)))
+    df['sub'] = df['subject'].astype(str).str.replace('subject', '', regex=False)
+
+    dft = pd.read_csv(tremor_file)
+    dft = dft[dft['side'].notna()].copy()                          # remove OFF measurements
+    dft['contact'] = np.where(dft['contact'] > 8, dft['contact'] - 8, dft['contact'])
+    dft['sub'] = dft['sub'].astype(str).str.replace('subject', '', regex=False)
+    dft['contraside'] = np.where(dft['side'] == 'L', 'R', 'L')
+    dft.columns = [c.replace('mA', 'amp') for c in dft.columns]
+
+    for d in (df, dft):
+        d['contact'] = d['contact'].astype(float)
+        d['amp'] = d['amp'].astype(float)
+    dfm = dft.merge(df, left_on=['sub', 'contraside', 'contact', 'amp'],
+                    right_on=['sub', 'side', 'contact', 'amp'], suffixes=('', '_vat'))
+
+    y = (dfm['rms'] - dfm.groupby('sub')['rms'].transform('mean')).to_numpy(dtype=float)
+    return dfm[conn_cols].to_numpy(dtype=float), y, dfm['sub'].to_numpy()
+
+def pls_batch(X, Y, ncomp=5):
+    """
+    NIPALS PLS regression of a batch of centred data sets X (B x n x p) and
+    Y (B x n x m), as plsr() without scaling. Returns the weights W and
+    X loadings P (B x p x ncomp) and the fraction of the variance of Y
+    explained by every component (B x ncomp).
+    """
+    X = np.array(X, dtype=float)
+    Y = np.array(Y, dtype=float)
+    B, n, p = X.shape
+    W = np.zeros((B, p, ncomp))
+    P = np.zeros((B, p, ncomp))
+    r2 = np.zeros((B, ncomp))
+    ssy = np.einsum('bnm,bnm->b', Y, Y)
+
+    for a in range(ncomp):
+        XtY = np.matmul(X.transpose(0, 2, 1), Y)                   # B x p x m
+        U, _, _ = np.linalg.svd(XtY, full_matrices=False)
+        w = U[:, :, 0]
+        sign = np.sign(np.einsum('bp,bp->b', w, XtY[:, :, 0]))     # same orientation as X'y
+        w *= np.where(sign == 0, 1, sign)[:, np.newaxis]
+
+        t = np.einsum('bnp,bp->bn', X, w)
+        tt = np.einsum('bn,bn->b', t, t)
+        tt[tt == 0] = np.inf                                        # exhausted data sets
+        ploading = np.einsum('bnp,bn->bp', X, t) / tt[:, np.newaxis]
+        q = np.einsum('bnm,bn->bm', Y, t) / tt[:, np.newaxis]
+
+        X -= t[:, :, np.newaxis] * ploading[:, np.newaxis, :]       # deflate
+        Y -= t[:, :, np.newaxis] * q[:, np.newaxis, :]
+        W[:, :, a] = w
+        P[:, :, a] = ploading
+        r2[:, a] = np.sum(q ** 2, axis=1) * np.where(np.isinf(tt), 0, tt) / ssy
+
+    return W, P, r2
+
+def _centre(X, y, counts):
+    """weighted centring with row counts (B x n), rows scaled by sqrt(count) (= duplicated rows)"""
+    total = counts.sum(axis=1, keepdims=True)
+    Xm = np.einsum('bn,np->bp', counts, X) / total
+    ym = counts @ y / total[:, 0]
+    s = np.sqrt(counts)[:, :, np.newaxis]
+    return (X[np.newaxis] - Xm[:, np.newaxis]) * s, (y[np.newaxis] - ym[:, np.newaxis])[:, :, np.newaxis] * s
+
+def fit(X, y, ncomp=5):
+    """PLS of the observed data, returns W, P (p x ncomp) and r2 (ncomp,)"""
+    W, P, r2 = pls_batch((X - X.mean(axis=0))[np.newaxis], (y - y.mean())[np.newaxis, :, np.newaxis], ncomp)
+    return W[0], P[0], r2[0]
+
+def permutation_batch(X, y, subjects, ncomp, seed, size, within_subject=False):
+    """weights and r2 of size refits with permuted y"""
+    rng = np.random.default_rng(seed)
+    n = len(y)
+    idx = np.empty((size, n), dtype=int)
+    for b in range(size):
+        if within_subject:
+            idx[b] = np.arange(n)
+            for s in np.unique(subjects):
+                rows = np.flatnonzero(subjects == s)
+                idx[b, rows] = rng.permutation(rows)
+        else:
+            idx[b] = rng.permutation(n)
+    Xc = np.broadcast_to(X - X.mean(axis=0), (size,) + X.shape)
+    yc = (y - y.mean())[idx][:, :, np.newaxis]
+    W, _, r2 = pls_batch(Xc, yc, ncomp)
+    return W, r2
+
+def bootstrap_batch(X, y, subjects, ncomp, seed, size, by_subject=True):
+    """weights and loadings of size refits on bootstrap resamples (of subjects or rows)"""
+    rng = np.random.default_rng(seed)
+    n = len(y)
+    if by_subject:
+        units, unit_of_row = np.unique(subjects, return_inverse=True)
+        draws = rng.integers(0, len(units), (size, len(units)))
+        counts = np.stack([np.bincount(d, minlength=len(units)) for d in draws])[:, unit_of_row]
+    else:
+        draws = rng.integers(0, n, (size, n))
+        counts = np.stack([np.bincount(d, minlength=n) for d in draws])
+    Xc, yc = _centre(X, y, counts.astype(float))
+    W, P, _ = pls_batch(Xc, yc, ncomp)
+    return W, P
+
+def _batches(kind, X, y, subjects, ncomp, n, batch, seed, workers, **kwargs):
+    """runs n refits of kind ('perm' or 'boot') in batches over a process pool"""
+    sizes = [min(batch, n - start) for start in range(0, n, batch)]
+    seeds = np.random.SeedSequence([seed, 0 if kind == 'perm' else 1]).spawn(len(sizes))
+    func = permutation_batch if kind == 'perm' else bootstrap_batch
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(func, X, y, subjects, ncomp, s, size, **kwargs) for s, size in zip(seeds, sizes)]
+        results = [f.result() for f in futures]
+    return [np.concatenate(parts) for parts in zip(*results)]
+
+def run_pls(X, y, subjects, names, ncomp=5, n_perm=10000, n_boot=5000, batch=250, seed=0, workers=None,
+            within_subject=False, by_subject=True):
+    """observed PLS with permutation and bootstrap statistics, returns (results, components) tables"""
+    W, P, r2 = fit(X, y, ncomp)
+
+    W_perm, r2_perm = _batches('perm', X, y, subjects, ncomp, n_perm, batch, seed, workers,
+                               within_subject=within_subject)
+    p_comp = (1 + np.sum(r2_perm >= r2, axis=0)) / (1 + n_perm)
+    p_roi = (1 + np.sum(np.abs(W_perm) >= np.abs(W), axis=0)) / (1 + n_perm)
+
+    W_boot, P_boot = _batches('boot', X, y, subjects, ncomp, n_boot, batch, seed, workers, by_subject=by_subject)
+    sign = np.sign(np.einsum('bpa,pa->ba', W_boot, W))            # align component orientation
+    P_boot *= np.where(sign == 0, 1, sign)[:, np.newaxis, :]
+    se = P_boot.std(axis=0, ddof=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        bsr = np.where(se > 0, P / se, np.nan)
+    lo, hi = np.percentile(P_boot, [2.5, 97.5], axis=0)
+
+    p, k = P.shape
+    results = pd.DataFrame({'component': np.repeat(np.arange(1, k + 1), p),
+                            'roi': np.tile(np.arange(1, p + 1), k),
+                            'name': np.tile(names, k),
+                            'loading': P.T.ravel(), 'weight': W.T.ravel(),
+                            'boot_se': se.T.ravel(), 'bootstrap_ratio': bsr.T.ravel(),
+                            'ci_low': lo.T.ravel(), 'ci_high': hi.T.ravel(),
+                            'p_perm': p_roi.T.ravel()})
+    components = pd.DataFrame({'component': np.arange(1, k + 1), 'r2_y': r2, 'r2_y_cum': np.cumsum(r2),
+                               'p_perm': p_comp})
+    return results, components
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="PLS of VAT-ROI connectivity and tremor with permutation/bootstrap tests")
+    parser.add_argument("--connectivity", default="../results/vat_connectivity_matrix.csv")
+    parser.add_argument("--tremor", default="../../tremorDBS/Subjects_tremorDBS/tremorallsubs_cleaned.csv")
+    parser.add_argument("--ncomp", type=int, default=5)
+    parser.add_argument("--n-perm", type=int, default=10000)
+    parser.add_argument("--n-boot", type=int, default=5000)
+    parser.add_argument("--batch", type=int, default=250, help="refits per batched SVD pass")
+    parser.add_argument("--seed", type=int, default=123)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--within-subject", action="store_true", help="permute y within subjects only")
+    parser.add_argument("--resample-rows", action="store_true", help="bootstrap VATs instead of subjects")
+    parser.add_argument("--outdir", default=".")
+    args = parser.parse_args()
+
+    X, y, subjects = prepare_data(args.connectivity, args.tremor)
+    print(f"{len(y)} VATs of {len(np.unique(subjects))} subjects, {X.shape[1]} ROIs")
+    results, components = run_pls(X, y, subjects, roi_names()[:X.shape[1]], args.ncomp, args.n_perm, args.n_boot,
+                                  args.batch, args.seed, args.workers, args.within_subject, not args.resample_rows)
+    results.to_csv(os.path.join(args.outdir, "pls_results.csv"), index=False)
+    components.to_csv(os.path.join(args.outdir, "pls_components.csv"), index=False)
+    print(components.to_string(index=False))